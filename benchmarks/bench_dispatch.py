@@ -0,0 +1,104 @@
+"""Micro-benchmark of event decoding and dispatch.
+
+Compares the registry of precompiled decoders used by the indexer with the
+previous approach (an `if` chain on the event key, then an `if` chain on the
+event name building a new `namedtuple` class for every event).
+
+    python benchmarks/bench_dispatch.py --events 200000
+"""
+import random
+import time
+from collections import namedtuple
+
+import click
+from apibara.starknet import felt
+from apibara.starknet.proto.starknet_pb2 import Event
+
+from swap.indexer.abi import decoders, from_uint256
+
+_sizes = {"PairCreated": 4, "Sync": 4, "Swap": 10, "Transfer": 4, "Mint": 5, "Burn": 6}
+# rough mix of events on mainnet
+_weights = {"PairCreated": 1, "Sync": 30, "Swap": 25, "Transfer": 30, "Mint": 7, "Burn": 7}
+
+
+def synthetic_events(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    names = list(_weights)
+    events = []
+    for name in rng.choices(names, weights=[_weights[n] for n in names], k=count):
+        events.append(
+            Event(
+                from_address=felt.from_int(rng.getrandbits(250)),
+                keys=[felt.from_int(decoders[name].key)],
+                data=[felt.from_int(rng.getrandbits(120)) for _ in range(_sizes[name])],
+            )
+        )
+    return events
+
+
+def _legacy_decode(event_name, data):
+    if event_name == 'PairCreated':
+        pair_created = namedtuple('pair_created', ['token0', 'token1', 'pair', 'total_pairs'])
+        return pair_created(felt.to_int(data[0]), felt.to_int(data[1]), felt.to_int(data[2]), felt.to_int(data[3]))
+    if event_name == 'Sync':
+        sync = namedtuple('sync', ['reserve0', 'reserve1'])
+        return sync(from_uint256(data[0], data[1]), from_uint256(data[2], data[3]))
+    if event_name == 'Swap':
+        swap = namedtuple('swap', ['sender', 'amount0_in', 'amount1_in', 'amount0_out', 'amount1_out', 'to'])
+        return swap(felt.to_int(data[0]), from_uint256(data[1], data[2]), from_uint256(data[3], data[4]), from_uint256(data[5], data[6]), from_uint256(data[7], data[8]), felt.to_int(data[9]))
+    if event_name == 'Transfer':
+        transfer = namedtuple('transfer', ['from_', 'to', 'value'])
+        return transfer(felt.to_int(data[0]), felt.to_int(data[1]), from_uint256(data[2], data[3]))
+    if event_name == 'Mint':
+        mint = namedtuple('mint', ['sender', 'amount0', 'amount1'])
+        return mint(felt.to_int(data[0]), from_uint256(data[1], data[2]), from_uint256(data[3], data[4]))
+    if event_name == 'Burn':
+        burn = namedtuple('burn', ['sender', 'amount0', 'amount1', 'to'])
+        return burn(felt.to_int(data[0]), from_uint256(data[1], data[2]), from_uint256(data[3], data[4]), felt.to_int(data[5]))
+
+
+_legacy_keys = [(felt.from_int(decoder.key), name) for name, decoder in decoders.items()]
+
+
+def legacy_dispatch(events):
+    for event in events:
+        # comparisons of protobuf field elements, as in the old `if` chain
+        for key, name in _legacy_keys:
+            if event.keys[0] == key:
+                _legacy_decode(name, event.data)
+                break
+
+
+def registry_dispatch(events):
+    handlers = {decoder.key: decoder for decoder in decoders.values()}
+    for event in events:
+        decoder = handlers.get(felt.to_int(event.keys[0]))
+        if decoder is not None:
+            decoder(event.data)
+
+
+def _measure(fn, events, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(events)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+@click.command()
+@click.option("--events", default=100_000, help="Number of synthetic events.")
+@click.option("--repeat", default=3, help="Runs of each implementation, the best is kept.")
+def main(events, repeat):
+    sample = synthetic_events(events)
+    for name, fn in [("legacy", legacy_dispatch), ("registry", registry_dispatch)]:
+        elapsed = _measure(fn, sample, repeat)
+        click.echo(
+            f"{name:>8}: {elapsed:.3f}s, {events / elapsed:,.0f} events/s, "
+            f"{elapsed / events * 1e6:.2f} us/event"
+        )
+
+
+if __name__ == "__main__":
+    main()
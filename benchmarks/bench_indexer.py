@@ -0,0 +1,225 @@
+"""Throughput of the indexer on synthetic DEX workloads.
+
+Generates a block stream (see `workload.py`), indexes it with
+`JediSwapIndexer` into MongoDB or in memory, and reports blocks/s,
+events/s, MongoDB operations per event and peak RSS. Results are written as
+JSON with the workload (including `--blocks`) and options, `--compare`
+prints the change against the results of another commit with the same
+workload and options.
+
+    PYTHONPATH=src python benchmarks/bench_indexer.py --blocks 500 --output before.json
+    PYTHONPATH=src python benchmarks/bench_indexer.py --blocks 500 --compare before.json
+"""
+import asyncio
+import json
+import resource
+import subprocess
+import sys
+import time
+from dataclasses import asdict
+from datetime import datetime, timezone
+from typing import Iterator, List
+
+import click
+from apibara.indexer.storage import IndexerStorage
+from apibara.starknet.proto.starknet_pb2 import Block
+
+from swap.indexer import JediSwapIndexer, create_context
+from swap.indexer.jediswap import _usdc
+from swap.indexer.log import configure_logging
+from swap.indexer.memory import MemoryIndexerStorage
+from swap.indexer.metrics import IndexerMetrics
+from swap.indexer.pipeline import PersistencePipeline, PipelinedIndexerStorage
+from swap.indexer.replay import replay_blocks
+from swap.indexer.rpcstub import RpcFixtures, RpcStub
+
+from workload import SyntheticRpc, Workload, WorkloadGenerator, token_decimals
+
+_compared = ["blocks_per_s", "events_per_s", "mongo_ops_per_event", "rpc_requests_per_block", "peak_rss_mb"]
+
+
+def _peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def _serve_stub(latency: float):
+    """A local stub node answering the token metadata of any contract, with
+    the decimals of `SyntheticRpc`."""
+    fixtures = RpcFixtures()
+    for contract, name, result in [
+        ("*", "name", ["0x54"]),
+        ("*", "symbol", ["0x54"]),
+        ("*", "decimals", [hex(token_decimals(0))]),
+        (hex(_usdc), "decimals", [hex(token_decimals(_usdc))]),
+        ("*", "totalSupply", [hex(10**27), "0x0"]),
+    ]:
+        fixtures.add_call({"contract_address": contract, "entry_point": name, "calldata": [], "result": result})
+    stub = RpcStub(fixtures, latency=latency)
+    runner = await stub.serve(port=0)
+    port = runner.addresses[0][1]
+    return f"http://127.0.0.1:{port}", runner
+
+
+def _timed(blocks: Iterator[Block], timings: List[float]) -> Iterator[Block]:
+    """Yields `blocks`, adding the time spent generating them to `timings`."""
+    while True:
+        start = time.perf_counter()
+        block = next(blocks, None)
+        timings.append(time.perf_counter() - start)
+        if block is None:
+            return
+        yield block
+
+
+async def run(workload: Workload, storage: str, mongo_url: str, pipeline_depth: int, rpc_latency_ms: float):
+    # blocks are generated while indexing, so that peak RSS is the
+    # indexer's, and their generation time is left out of the throughput
+    generator = WorkloadGenerator(workload)
+    generation: List[float] = []
+    blocks = _timed(generator.blocks(), generation)
+
+    pipeline = None
+    if storage == "memory":
+        indexer_storage = MemoryIndexerStorage()
+    elif pipeline_depth > 0:
+        pipeline = PersistencePipeline(pipeline_depth)
+        indexer_storage = PipelinedIndexerStorage(mongo_url, "swap-bench", pipeline)
+    else:
+        indexer_storage = IndexerStorage(mongo_url, "swap-bench")
+    indexer_storage.drop_database()
+
+    stub_runner = None
+    if rpc_latency_ms is not None:
+        stub_url, stub_runner = await _serve_stub(rpc_latency_ms / 1000)
+    metrics = IndexerMetrics()
+    # token metadata and contract calls are cached in memory only
+    context = create_context(
+        mongodb_url=None,
+        rpc_urls=[stub_url if stub_runner is not None else "http://localhost:9545"],
+        indexer_id="swap-bench",
+        metrics=metrics,
+    )
+    if stub_runner is None:
+        await context.rpc.close()
+        context.rpc = SyntheticRpc(head=generator.last_block)
+    indexer = JediSwapIndexer("swap-bench", pipeline)
+
+    start = time.perf_counter()
+    handled, events, _ = await replay_blocks(indexer, context, indexer_storage, blocks)
+    if pipeline is not None:
+        pipeline.drain()
+    elapsed = time.perf_counter() - start - sum(generation)
+
+    await context.rpc.close()
+    if stub_runner is not None:
+        await stub_runner.cleanup()
+
+    mongo_reads = metrics.mongo_reads.sum()
+    mongo_writes = metrics.mongo_writes.sum()
+    rpc_requests = metrics.rpc_requests.sum()
+    return {
+        "blocks": handled,
+        "events": events,
+        "generation_s": round(sum(generation), 3),
+        "elapsed_s": round(elapsed, 3),
+        "blocks_per_s": round(handled / elapsed, 1),
+        "events_per_s": round(events / elapsed, 1),
+        "mongo_reads_per_event": round(mongo_reads / events, 3),
+        "mongo_writes_per_event": round(mongo_writes / events, 3),
+        "mongo_ops_per_event": round((mongo_reads + mongo_writes) / events, 3),
+        "rpc_requests_per_block": round(rpc_requests / handled, 3),
+        "handler_ms": {
+            name: round(metrics.handler_seconds.sum(event=name) * 1000 / count, 3)
+            for name, count in (
+                (name, metrics.handler_seconds.count(event=name))
+                for name in ("PairCreated", "Transfer", "Sync", "Swap", "Mint", "Burn")
+            )
+            if count
+        },
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+    }
+
+
+def check_comparable(baseline: dict, workload: dict, options: dict):
+    """Raises if `baseline` was measured on another workload or with other
+    options: throughput depends on the number of blocks, among others."""
+    for key, current in (("workload", workload), ("options", options)):
+        stored = baseline.get(key) or {}
+        differ = [name for name in sorted({*stored, *current}) if stored.get(name) != current.get(name)]
+        if differ:
+            raise click.UsageError(
+                f"the baseline was measured with another {key} ({', '.join(differ)}), "
+                "run it again with the same options"
+            )
+
+
+def compare(baseline: dict, current: dict):
+    click.echo(f"{'':>24} {baseline.get('commit', '?'):>12} {current['commit']:>12}")
+    for key in _compared:
+        before = baseline["results"].get(key)
+        after = current["results"][key]
+        change = f"{(after - before) / before * 100:+.1f}%" if before else ""
+        click.echo(f"{key:>24} {before if before is not None else '-':>12} {after:>12} {change:>8}")
+
+
+@click.command()
+@click.option("--blocks", default=Workload.blocks, help="Blocks generated.")
+@click.option("--pairs", default=Workload.pairs, help="Pairs created in the first block.")
+@click.option("--swaps-per-block", default=Workload.swaps_per_block)
+@click.option("--liquidity-per-block", default=Workload.liquidity_per_block, help="Mints and burns per block.")
+@click.option("--mint-ratio", default=Workload.mint_ratio, type=click.FloatRange(0, 1), help="Fraction of mints among mints and burns.")
+@click.option("--lp-transfers-per-block", default=Workload.lp_transfers_per_block, help="Transfers of LP tokens between users per block.")
+@click.option("--new-pair-rate", default=Workload.new_pair_rate, type=click.FloatRange(min=0), help="Pairs created per block.")
+@click.option("--users", default=Workload.users)
+@click.option("--seed", default=Workload.seed)
+@click.option("--storage", default="memory", type=click.Choice(["memory", "mongo"]))
+@click.option("--mongo-url", default="mongodb://localhost:27017", help="With --storage mongo, the swap_bench database is dropped first.")
+@click.option("--pipeline-depth", default=0, type=click.IntRange(min=0), help="With --storage mongo, see `indexer --help`.")
+@click.option("--rpc-latency-ms", default=None, type=click.FloatRange(min=0), help="Serve contract calls from a local rpc stub with this latency, instead of in-process.")
+@click.option("--output", default=None, type=click.Path(dir_okay=False), help="Write the results to this JSON file.")
+@click.option("--compare", "baseline_path", default=None, type=click.Path(exists=True, dir_okay=False), help="Compare with results written by --output.")
+def main(storage, mongo_url, pipeline_depth, rpc_latency_ms, output, baseline_path, **workload_options):
+    if pipeline_depth > 0 and storage != "mongo":
+        raise click.UsageError("--pipeline-depth requires --storage mongo")
+    workload = Workload(**workload_options)
+    options = {
+        "storage": storage,
+        "pipeline_depth": pipeline_depth,
+        "rpc_latency_ms": rpc_latency_ms,
+    }
+    baseline = None
+    if baseline_path is not None:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        check_comparable(baseline, asdict(workload), options)
+    configure_logging("warning")
+    results = asyncio.run(run(workload, storage, mongo_url, pipeline_depth, rpc_latency_ms))
+    report = {
+        "commit": _commit(),
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "workload": asdict(workload),
+        "options": options,
+        "results": results,
+    }
+    click.echo(json.dumps(results, indent=1))
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=1)
+    if baseline is not None:
+        compare(baseline, report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+"""Synthetic block streams of DEX activity, for `bench_indexer.py`.
+
+Blocks contain the events JediSwap emits for each action: pairs created by
+the factory, then on each pair mints (`Transfer` of LP tokens from 0,
+`Sync`, `Mint`), burns (`Transfer` to the pair and from the pair to 0,
+`Sync`, `Burn`), swaps (`Sync`, `Swap`) and transfers of LP tokens between
+users. Reserves and LP balances are tracked, so that the events are
+consistent with each other.
+"""
+import math
+import random
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List
+
+from apibara.starknet import felt
+from apibara.starknet.proto.starknet_pb2 import Block, EventWithTransaction
+from starknet_py.cairo.felt import encode_shortstring
+from starknet_py.contract import ContractFunction
+
+from swap.indexer import FACTORY_ADDRESS, PAIR_CREATED_KEY
+from swap.indexer.factory import (BURN_KEY, MINT_KEY, SWAP_KEY, SYNC_KEY,
+                                  TRANSFER_KEY)
+from swap.indexer.jediswap import _eth, _eth_usdc_address, _usdc
+
+# locked by the first mint of a pair
+_minimum_liquidity = 1000
+_decimals = {_eth: 18, _usdc: 6}
+
+
+@dataclass
+class Workload:
+    blocks: int = 1000
+    # pairs created in the first block, including ETH/USDC
+    pairs: int = 20
+    swaps_per_block: int = 10
+    # mints and burns per block
+    liquidity_per_block: int = 2
+    # fraction of mints among mints and burns
+    mint_ratio: float = 0.6
+    # transfers of LP tokens between users per block
+    lp_transfers_per_block: int = 1
+    # pairs created per block after the first one, e.g. 0.1 for one every
+    # ten blocks on average
+    new_pair_rate: float = 0.05
+    users: int = 1000
+    seed: int = 0
+
+
+@dataclass
+class _Pair:
+    address: int
+    token0: int
+    token1: int
+    reserve0: int = 0
+    reserve1: int = 0
+    total_supply: int = 0
+    balances: Dict[int, int] = field(default_factory=dict)
+
+
+class WorkloadGenerator:
+    """Generates the blocks of `workload`, deterministically."""
+
+    def __init__(self, workload: Workload, first_block: int = 1, first_timestamp: int = 1680000000):
+        self._workload = workload
+        self._rng = random.Random(workload.seed)
+        self._first_block_number = first_block
+        self._block_number = first_block
+        self._timestamp = first_timestamp
+        self._tokens: List[int] = [_eth, _usdc]
+        # pairs with liquidity, and pairs waiting for their first mint
+        self._pairs: List[_Pair] = []
+        self._new_pairs: List[_Pair] = []
+        self._transaction = 0
+
+    def blocks(self) -> Iterator[Block]:
+        """Yields the blocks one at a time, so that they are not all held
+        in memory."""
+        yield self._first_block()
+        for _ in range(self._workload.blocks - 1):
+            yield self._next_block()
+
+    @property
+    def last_block(self) -> int:
+        return self._first_block_number + self._workload.blocks - 1
+
+    def _first_block(self) -> Block:
+        events = [self._create_pair(_eth, _usdc, int(_eth_usdc_address, 16))]
+        for _ in range(self._workload.pairs - 1):
+            events.append(self._create_pair(self._new_token(), self._quote_token()))
+        return self._block(events)
+
+    def _next_block(self) -> Block:
+        workload = self._workload
+        events = []
+        # first mint of the pairs created in the previous block
+        for pair in self._new_pairs:
+            events.extend(self._mint(pair, self._user(), initial=True))
+            self._pairs.append(pair)
+        self._new_pairs = []
+        actions = (
+            ["swap"] * workload.swaps_per_block
+            + ["liquidity"] * workload.liquidity_per_block
+            + ["lp_transfer"] * workload.lp_transfers_per_block
+        )
+        self._rng.shuffle(actions)
+        for action in actions:
+            pair = self._rng.choice(self._pairs)
+            if action == "swap":
+                events.extend(self._swap(pair))
+            elif action == "lp_transfer":
+                events.extend(self._lp_transfer(pair))
+            elif self._rng.random() < workload.mint_ratio or not pair.balances:
+                events.extend(self._mint(pair, self._user()))
+            else:
+                events.extend(self._burn(pair))
+        new_pairs = int(workload.new_pair_rate) + (
+            self._rng.random() < workload.new_pair_rate % 1
+        )
+        for _ in range(new_pairs):
+            events.append(self._create_pair(self._new_token(), self._quote_token()))
+        return self._block(events)
+
+    def _block(self, events: List[EventWithTransaction]) -> Block:
+        block = Block()
+        block.header.block_number = self._block_number
+        block.header.block_hash.CopyFrom(felt.from_int(0xB000000 + self._block_number))
+        block.header.parent_block_hash.CopyFrom(felt.from_int(0xB000000 + self._block_number - 1))
+        block.header.timestamp.FromSeconds(self._timestamp)
+        block.events.extend(events)
+        self._block_number += 1
+        self._timestamp += self._rng.randint(5, 60)
+        return block
+
+    def _create_pair(self, token_a: int, token_b: int, address: int = None) -> EventWithTransaction:
+        token0, token1 = sorted([token_a, token_b])
+        pair = _Pair(address or self._address(), token0, token1)
+        self._new_pairs.append(pair)
+        total_pairs = len(self._pairs) + len(self._new_pairs)
+        return _event(
+            felt.to_int(FACTORY_ADDRESS),
+            PAIR_CREATED_KEY,
+            [token0, token1, pair.address, total_pairs],
+            self._next_transaction(),
+        )
+
+    def _mint(self, pair: _Pair, user: int, initial: bool = False) -> List[EventWithTransaction]:
+        tx = self._next_transaction()
+        events = []
+        if initial or pair.total_supply == 0:
+            amount0 = self._amount(pair.token0, 100, 10_000)
+            amount1 = self._amount(pair.token1, 100, 10_000)
+            liquidity = math.isqrt(amount0 * amount1) - _minimum_liquidity
+            events.append(self._transfer_event(pair, 0, 1, _minimum_liquidity, tx))
+            pair.total_supply += _minimum_liquidity
+        else:
+            share = self._rng.uniform(0.001, 0.05)
+            amount0 = int(pair.reserve0 * share)
+            amount1 = int(pair.reserve1 * share)
+            liquidity = int(pair.total_supply * share)
+        events.append(self._transfer_event(pair, 0, user, liquidity, tx))
+        pair.total_supply += liquidity
+        pair.balances[user] = pair.balances.get(user, 0) + liquidity
+        pair.reserve0 += amount0
+        pair.reserve1 += amount1
+        events.append(self._sync_event(pair, tx))
+        events.append(_event(pair.address, MINT_KEY, [user, *_u256(amount0), *_u256(amount1)], tx))
+        return events
+
+    def _burn(self, pair: _Pair) -> List[EventWithTransaction]:
+        tx = self._next_transaction()
+        user = self._rng.choice(list(pair.balances))
+        liquidity = max(pair.balances[user] // 2, 1)
+        amount0 = pair.reserve0 * liquidity // pair.total_supply
+        amount1 = pair.reserve1 * liquidity // pair.total_supply
+        self._move_lp(pair, user, pair.address, liquidity)
+        events = [
+            self._transfer_event(pair, user, pair.address, liquidity, tx),
+            self._transfer_event(pair, pair.address, 0, liquidity, tx),
+        ]
+        pair.balances.pop(pair.address, None)
+        pair.total_supply -= liquidity
+        pair.reserve0 -= amount0
+        pair.reserve1 -= amount1
+        events.append(self._sync_event(pair, tx))
+        events.append(
+            _event(pair.address, BURN_KEY, [user, *_u256(amount0), *_u256(amount1), user], tx)
+        )
+        return events
+
+    def _swap(self, pair: _Pair) -> List[EventWithTransaction]:
+        tx = self._next_transaction()
+        user = self._user()
+        share = self._rng.uniform(0.0001, 0.01)
+        if self._rng.random() < 0.5:
+            amount0_in, amount1_in = int(pair.reserve0 * share), 0
+            amount0_out, amount1_out = 0, _amount_out(amount0_in, pair.reserve0, pair.reserve1)
+        else:
+            amount0_in, amount1_in = 0, int(pair.reserve1 * share)
+            amount0_out, amount1_out = _amount_out(amount1_in, pair.reserve1, pair.reserve0), 0
+        pair.reserve0 += amount0_in - amount0_out
+        pair.reserve1 += amount1_in - amount1_out
+        return [
+            self._sync_event(pair, tx),
+            _event(
+                pair.address,
+                SWAP_KEY,
+                [
+                    user,
+                    *_u256(amount0_in),
+                    *_u256(amount1_in),
+                    *_u256(amount0_out),
+                    *_u256(amount1_out),
+                    user,
+                ],
+                tx,
+            ),
+        ]
+
+    def _lp_transfer(self, pair: _Pair) -> List[EventWithTransaction]:
+        if not pair.balances:
+            return []
+        sender = self._rng.choice(list(pair.balances))
+        value = max(pair.balances[sender] // 3, 1)
+        recipient = self._user()
+        self._move_lp(pair, sender, recipient, value)
+        return [self._transfer_event(pair, sender, recipient, value, self._next_transaction())]
+
+    def _move_lp(self, pair: _Pair, sender: int, recipient: int, value: int):
+        pair.balances[sender] -= value
+        if pair.balances[sender] <= 0:
+            del pair.balances[sender]
+        pair.balances[recipient] = pair.balances.get(recipient, 0) + value
+
+    def _transfer_event(self, pair: _Pair, sender: int, recipient: int, value: int, tx: int):
+        return _event(pair.address, TRANSFER_KEY, [sender, recipient, *_u256(value)], tx)
+
+    def _sync_event(self, pair: _Pair, tx: int):
+        return _event(pair.address, SYNC_KEY, [*_u256(pair.reserve0), *_u256(pair.reserve1)], tx)
+
+    def _new_token(self) -> int:
+        token = self._address()
+        self._tokens.append(token)
+        return token
+
+    def _quote_token(self) -> int:
+        # most pairs are priced against ETH, like on mainnet
+        if self._rng.random() < 0.7:
+            return _eth
+        return self._rng.choice(self._tokens[:-1])
+
+    def _amount(self, token: int, low: int, high: int) -> int:
+        return self._rng.randint(low, high) * 10 ** token_decimals(token)
+
+    def _user(self) -> int:
+        return 0x05E000 + self._rng.randrange(self._workload.users)
+
+    def _address(self) -> int:
+        return self._rng.getrandbits(250)
+
+    def _next_transaction(self) -> int:
+        self._transaction += 1
+        return 0x7000000 + self._transaction
+
+
+def token_decimals(token: int) -> int:
+    return _decimals.get(token, 18)
+
+
+def _amount_out(amount_in: int, reserve_in: int, reserve_out: int) -> int:
+    amount_in_with_fee = amount_in * 997
+    return amount_in_with_fee * reserve_out // (reserve_in * 1000 + amount_in_with_fee)
+
+
+def _u256(value: int) -> List[int]:
+    return [value % (1 << 128), value >> 128]
+
+
+def _event(address: int, key, data: List[int], tx: int) -> EventWithTransaction:
+    event = EventWithTransaction()
+    event.transaction.meta.hash.CopyFrom(felt.from_int(tx))
+    event.event.from_address.CopyFrom(felt.from_int(address))
+    event.event.keys.append(key)
+    event.event.data.extend(felt.from_int(value) for value in data)
+    return event
+
+
+class SyntheticRpc:
+    """Answers the contract calls of the indexer for synthetic tokens,
+    without a node."""
+
+    _selectors = {
+        ContractFunction.get_selector(name): name
+        for name in ["name", "symbol", "decimals", "totalSupply", "balanceOf"]
+    }
+
+    def __init__(self, head: int = 0):
+        self.requests = 0
+        self._head = head
+
+    async def call_contract(self, call, block_hash=None, block_number=None) -> List[int]:
+        self.requests += 1
+        name = self._selectors.get(call.selector)
+        if name in ("name", "symbol"):
+            # like the fixtures of the rpc stub in `bench_indexer.py`
+            return [encode_shortstring("T")]
+        if name == "decimals":
+            return [token_decimals(call.to_addr)]
+        if name == "totalSupply":
+            return [10**27, 0]
+        if name == "balanceOf":
+            return [0, 0]
+        raise ValueError(f"unsupported selector {call.selector}")
+
+    async def get_block_number(self) -> int:
+        return self._head
+
+    async def get_block(self, *args, **kwargs):
+        return None
+
+    def metrics(self) -> List[dict]:
+        return []
+
+    async def close(self):
+        pass
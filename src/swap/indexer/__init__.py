@@ -1,41 +1,83 @@
+from contextlib import contextmanager
 from decimal import Decimal
+from functools import partial
+from typing import List, Optional
 
-import logging
 import asyncio
+import time
 
 from apibara.indexer import IndexerRunner, IndexerRunnerConfiguration, Info
 from apibara.indexer.indexer import IndexerConfiguration, Reconnect
+from apibara.indexer.storage import IndexerStorage
 from apibara.protocol.proto.stream_pb2 import Cursor, DataFinality
 from apibara.starknet import EventFilter, Filter, StarkNetIndexer, felt
 from apibara.starknet.cursor import starknet_cursor
 from apibara.starknet.proto.starknet_pb2 import Block, BlockHeader
-from starknet_py.net.full_node_client import FullNodeClient
+from pymongo import MongoClient
 from starknet_py.net.client_errors import ClientError
-from starknet_py.net.models import StarknetChainId
 from structlog import get_logger
 
+from swap.indexer.abi import decoders
+from swap.indexer.backfill import BackfillMonitor, backfill_write_concern
+from swap.indexer.calls import CallCache
 from swap.indexer.context import IndexerContext
 from swap.indexer.core import (handle_burn, handle_mint, handle_swap,
                                   handle_sync, handle_transfer)
-from swap.indexer.factory import handle_pair_created, TRANSFER_KEY, SWAP_KEY, SYNC_KEY, MINT_KEY, BURN_KEY
-from swap.indexer.jediswap import get_eth_price, index_from_block
+from swap.indexer.factory import (handle_pair_created,
+                                  is_pool_events_filter, pair_filter,
+                                  pool_events_filter)
+from swap.indexer.helpers import reconcile_liquidity_positions
+from swap.indexer.jediswap import index_from_block, max_pricing_hops
+from swap.indexer.memory import MemoryIndexerStorage
+from swap.indexer.log import BlockSummary, sample_block
+from swap.indexer.metadata import TokenMetadataCache
+from swap.indexer.metrics import IndexerMetrics
+from swap.indexer.oracle import EthPriceOracle
+from swap.indexer.pipeline import (PersistencePipeline, PipelinedIndexerRunner,
+                                   PipelinedIndexerStorage)
+from swap.indexer.profiler import BlockProfiler, ProfiledStorage, handler_name
+from swap.indexer.replay import BlockRecorder, read_blocks, replay_blocks
+from swap.indexer.routes import PricingRoutes
+from swap.indexer.rpc import RpcPool
+from swap.indexer.storage import BlockStorage
 
 FACTORY_ADDRESS = felt.from_hex("0x00dad44c139a476c7a17fc8141e6db680e9abc9f56fe249a105094c44382c2fd")
-PAIR_CREATED_KEY = felt.from_hex("0x19437bf1c5c394fc8509a2e38c9c72c152df0bac8be777d4fc8f959ac817189")
+PAIR_CREATED_KEY = felt.from_int(decoders["PairCreated"].key)
 
 logger = get_logger(__name__)
 
-# Print apibara logs
-root_logger = logging.getLogger("apibara")
-# change to `logging.DEBUG` to print more information
-root_logger.setLevel(logging.DEBUG)
-root_logger.addHandler(logging.StreamHandler())
-
 class JediSwapIndexer(StarkNetIndexer):
     _indexer_id: str
 
-    def __init__(self, indexer_id):
+    def __init__(
+        self,
+        indexer_id,
+        pipeline: Optional[PersistencePipeline] = None,
+        compact_filter: bool = False,
+        recorder: Optional[BlockRecorder] = None,
+    ):
         self._indexer_id = indexer_id
+        self._pipeline = pipeline
+        # writes the blocks received to a file, to replay them offline
+        self._recorder = recorder
+        # subscribe to the pool events of every contract, and keep the
+        # events of the known pairs, instead of one filter per pair
+        self._compact_filter = compact_filter
+        # pairs created in the current block
+        self._new_pairs: List[int] = []
+        # event key -> (decoder, handler), handlers are called with
+        # `(info, event, decoded_event, transaction_hash)`
+        self._event_handlers = {
+            decoders[name].key: (decoders[name], handler)
+            for name, handler in [
+                ("PairCreated", partial(handle_pair_created, self)),
+                ("Transfer", handle_transfer),
+                ("Swap", handle_swap),
+                ("Sync", handle_sync),
+                ("Mint", handle_mint),
+                ("Burn", handle_burn),
+            ]
+        }
         super().__init__()
 
     def indexer_id(self) -> str:
@@ -43,10 +85,12 @@ class JediSwapIndexer(StarkNetIndexer):
     
     def initial_configuration(self) -> Filter:
         # Return initial configuration of the indexer.
+        if self._compact_filter:
+            filter = pool_events_filter()
+        else:
+            filter = Filter().with_header(weak=False)
         return IndexerConfiguration(
-            filter=Filter()
-            .with_header(weak=False)
-            .add_event(
+            filter=filter.add_event(
                 EventFilter()
                 .with_from_address(FACTORY_ADDRESS)
                 .with_keys([PAIR_CREATED_KEY])
@@ -56,9 +100,90 @@ class JediSwapIndexer(StarkNetIndexer):
         )
 
     async def handle_data(self, info: Info, data: Block):
-        await handle_block(info, data.header)
-        await handle_events(self, info, data)
+        if self._recorder is not None:
+            self._recorder.write(data)
+
+        # far from the chain head, trade durability of the writes for
+        # throughput.
+        backfill = info.context.backfill
+        backfilling = backfill is not None and await backfill.update(
+            info.context.rpc, data.header.block_number
+        )
+
+        # buffer all writes of the block, they are sent to mongo in bulk
+        # once the block has been handled.
+        storage = BlockStorage(
+            info.storage,
+            write_concern=backfill_write_concern if backfilling else None,
+            parents=self._pipeline.in_flight if self._pipeline is not None else (),
+        )
+        info.storage = storage
+        profiler = info.context.profiler
+        if profiler is not None:
+            profiler.start(data.header.block_number)
+            info.storage = ProfiledStorage(storage, profiler)
+        info.context.entities.clear()
+        info.context.snapshots.clear()
+        info.context.mint_burn.clear()
+        info.context.users.clear()
+        sample_block()
+        summary = BlockSummary()
+        metrics = info.context.metrics
+        if metrics is not None:
+            await metrics.update_head(info.context.rpc)
+            rpc_requests = info.context.rpc.requests
+        self._new_pairs.clear()
+        with _stage(info, "handle_block"):
+            await handle_block(info, data.header)
+        with _stage(info, "handle_events"):
+            await handle_events(self, info, data, summary)
+        if self._new_pairs:
+            # one filter update for all the pairs created in the block
+            self.update_filter(pair_filter(self._new_pairs))
+        interval = info.context.lp_reconcile_interval
+        if interval and info.context.block_number % interval == 0:
+            with _stage(info, "reconcile"):
+                await reconcile_liquidity_positions(
+                    info, info.context.lp_reconcile_sample_size
+                )
+        # write back mints and burns, user counters, day/hour snapshots and
+        # the entities touched by the block
+        with _stage(info, "flush"):
+            await info.context.mint_burn.flush(info)
+            await info.context.users.flush(info)
+            await info.context.snapshots.flush(info)
+            await info.context.entities.flush(info)
+            info.context.calls.flush()
+            await storage.resolve()
+        if metrics is not None:
+            metrics.observe_block(
+                info.context.block_number,
+                mongo_reads=storage.reads,
+                mongo_writes=storage.pending_writes(),
+                rpc_requests=info.context.rpc.requests - rpc_requests,
+            )
+        with _stage(info, "write"):
+            if self._pipeline is not None:
+                # the cursor is acknowledged once the writes are committed
+                await self._pipeline.submit(storage, info.end_cursor)
+            else:
+                await storage.flush()
+        summary.log(info.context.block_number)
+        if profiler is not None:
+            profiler.finish()
     
+    def track_pair(self, pair_address: int):
+        """Start receiving the events of the pair at `pair_address`."""
+        if not self._compact_filter:
+            self._new_pairs.append(pair_address)
+
+    async def handle_invalidate(self, info: Info, cursor: Cursor):
+        # the pairs have been rolled back (after the blocks in flight, if
+        # any, were written), seed the in-memory state again
+        info.context.eth_price_oracle.reset()
+        info.context.routes.reset()
+        info.context.pairs.reset()
+
     async def handle_reconnect(self, exc: Exception, retry_count: int) -> Reconnect:
         await asyncio.sleep(10 * retry_count)
         return Reconnect(reconnect=retry_count < 5)
@@ -67,6 +192,7 @@ async def check_block_in_rpc(info: Info):
     logger.info(
         "checking block in rpc", block_number=info.context.block_number, block_hash=info.context.block_hash
         )
+    delay = 0.5
     while True:
         try:
             await info.context.rpc.get_block(block_number=info.context.block_number)
@@ -76,8 +202,25 @@ async def check_block_in_rpc(info: Info):
         except:
             break    
         logger.info(
-            "block not found in rpc", block_number=info.context.block_number, block_hash=info.context.block_hash
+            "block not found in rpc", block_number=info.context.block_number, block_hash=info.context.block_hash, retry_in=delay
             )
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 30.0)
+
+@contextmanager
+def _stage(info: Info, name: str):
+    """Time a stage of `handle_data` for the metrics and the profiler."""
+    profiler = info.context.profiler
+    if profiler is not None:
+        profiler.enter(name)
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    if info.context.metrics is not None:
+        info.context.metrics.observe_stage(name, elapsed)
+    if profiler is not None:
+        profiler.record_stage(name, elapsed)
+
 
 async def handle_block(info: Info, block_header: BlockHeader):
     # Store the block information in the database.
@@ -87,7 +230,7 @@ async def handle_block(info: Info, block_header: BlockHeader):
         "parent_hash": hex(felt.to_int(block_header.parent_block_hash)),
         "timestamp": block_header.timestamp.ToDatetime(),
     }
-    logger.info(
+    logger.debug(
         "handle block", block = block
     )
     
@@ -99,7 +242,7 @@ async def handle_block(info: Info, block_header: BlockHeader):
     await info.storage.insert_one("blocks", block)
 
 
-async def handle_events(indexer: JediSwapIndexer, info: Info, block: Block):
+async def handle_events(indexer: JediSwapIndexer, info: Info, block: Block, summary: BlockSummary):
     block_header = block.header
     info.context.block_hash = hex(felt.to_int(block_header.block_hash))
     info.context.block_number = block_header.block_number
@@ -107,42 +250,54 @@ async def handle_events(indexer: JediSwapIndexer, info: Info, block: Block):
 
     # await check_block_in_rpc(info)
 
-    eth_price = await get_eth_price(info)
-    if eth_price is None:
-        eth_price = Decimal("0")
-    info.context.eth_price = eth_price
+    # in-memory state, seeded from storage on the first block and whenever
+    # a block is handled again
+    states = [info.context.eth_price_oracle, info.context.routes]
+    if indexer._compact_filter:
+        states.append(info.context.pairs)
+    for state in states:
+        if state.needs_seed(info.context.block_number):
+            await state.seed(info)
+        state.advance(info.context.block_number)
+    info.context.eth_price = info.context.eth_price_oracle.price
 
-    logger.info(
+    logger.debug(
         "handle events", block_number=info.context.block_number, block_timestamp=info.context.block_timestamp
     )
 
     for event_with_tx in block.events:
         transaction_hash = hex(felt.to_int(event_with_tx.transaction.meta.hash))
         event = event_with_tx.event
-        if event.keys[0] == PAIR_CREATED_KEY:
-            logger.info("event name", event_name="PairCreated")
-            await handle_pair_created(indexer, info, block_header, event)
-        elif event.keys[0] == TRANSFER_KEY:
-            logger.info("event name", event_name="Transfer")
-            await handle_transfer(info, event, transaction_hash)
-        elif event.keys[0] == SWAP_KEY:
-            logger.info("event name", event_name="Swap")
-            await handle_swap(info, event, transaction_hash)
-        elif event.keys[0] == SYNC_KEY:
-            logger.info("event name", event_name="Sync")
-            await handle_sync(info, event, transaction_hash)
-        elif event.keys[0] == MINT_KEY:
-            logger.info("event name", event_name="Mint")
-            await handle_mint(info, event, transaction_hash)
-        elif event.keys[0] == BURN_KEY:
-            logger.info("event name", event_name="Burn")
-            await handle_burn(info, event, transaction_hash)
-        else:
-            logger.warn(f"Unhandled event {event.name}")
+        key = felt.to_int(event.keys[0])
+        entry = indexer._event_handlers.get(key)
+        if entry is None:
+            logger.warn("unhandled event", key=hex(key))
+            continue
+        decoder, handler = entry
+        if (
+            indexer._compact_filter
+            and decoder.name != "PairCreated"
+            and felt.to_int(event.from_address) not in info.context.pairs
+        ):
+            # pool event of another contract
+            continue
+        logger.debug("event name", event_name=decoder.name)
+        profiler = info.context.profiler
+        if profiler is not None:
+            profiler.enter(handler_name(handler))
+        start = time.perf_counter()
+        await handler(info, event, decoder(event.data), transaction_hash)
+        elapsed = time.perf_counter() - start
+        summary.record(decoder.name, elapsed)
+        if info.context.metrics is not None:
+            info.context.metrics.observe_event(decoder.name, elapsed)
+        if profiler is not None:
+            profiler.record_handler(handler_name(handler), elapsed)
+            profiler.enter("handle_events")
 
 
-async def run_indexer(server_url, apibara_auth_token, mongodb_url, rpc_url, indexer_id, restart):
-    runner = IndexerRunner(
+async def run_indexer(server_url, apibara_auth_token, mongodb_url, rpc_urls, indexer_id, restart, lp_reconcile_interval=0, eth_price_source="usdc", multihop_pricing=False, backfill_distance=None, pipeline_depth=0, compact_filter=False, rpc_batch_size=50, metrics_port=0, slow_block_ms=None, slow_block_dir="slow-blocks", record_path=None):
+    runner_options = dict(
         config=IndexerRunnerConfiguration(
             stream_url=server_url,
             storage_url=mongodb_url,
@@ -151,16 +306,135 @@ async def run_indexer(server_url, apibara_auth_token, mongodb_url, rpc_url, inde
         reset_state=restart,
         timeout=300,
     )
+    if not restart:
+        check_filter_mode(mongodb_url, indexer_id, compact_filter)
+
+    # persist blocks in the background while the next ones are handled
+    pipeline = None
+    if pipeline_depth > 0:
+        pipeline = PersistencePipeline(pipeline_depth)
+        runner = PipelinedIndexerRunner(pipeline=pipeline, **runner_options)
+    else:
+        runner = IndexerRunner(**runner_options)
+
+    metrics = None
+    if metrics_port:
+        metrics = IndexerMetrics()
+        await metrics.serve(metrics_port)
+
+    context = create_context(
+        mongodb_url,
+        rpc_urls,
+        indexer_id,
+        lp_reconcile_interval=lp_reconcile_interval,
+        eth_price_source=eth_price_source,
+        multihop_pricing=multihop_pricing,
+        backfill_distance=backfill_distance,
+        rpc_batch_size=rpc_batch_size,
+        metrics=metrics,
+        slow_block_ms=slow_block_ms,
+        slow_block_dir=slow_block_dir,
+    )
+    recorder = BlockRecorder(record_path) if record_path is not None else None
+
+    try:
+        while True:
+            await runner.run(JediSwapIndexer(indexer_id, pipeline, compact_filter, recorder), ctx=context)
+            logger.warn("disconnected. reconnecting.")
+    finally:
+        if recorder is not None:
+            recorder.close()
 
-    context = IndexerContext(
-        rpc=FullNodeClient(rpc_url, net=StarknetChainId.MAINNET),
+
+def check_filter_mode(mongodb_url, indexer_id, compact_filter):
+    """Raise if the filter stored for `indexer_id`, which wins over the
+    initial configuration, was not created with the same `compact_filter`.
+
+    A per-pair filter would never receive the events of the pairs created
+    afterwards, a compact filter would feed the pool events of every
+    contract to the handlers.
+    """
+    stored = IndexerStorage(mongodb_url, indexer_id).db["_apibara"].find_one(
+        {"indexer_id": indexer_id}
+    )
+    if stored is None or stored.get("filter") is None:
+        return
+    filter = Filter()
+    filter.parse(stored["filter"])
+    stored_compact = is_pool_events_filter(filter)
+    if stored_compact != compact_filter:
+        raise ValueError(
+            f"indexer {indexer_id} was created {'with' if stored_compact else 'without'} --compact-filter,"
+            " start it the same way or with --restart"
+        )
+
+
+async def replay_indexer(path, mongodb_url, rpc_urls, indexer_id, replay_id, from_block=None, to_block=None, lp_reconcile_interval=0, eth_price_source="usdc", multihop_pricing=False, pipeline_depth=0, compact_filter=False, rpc_batch_size=50, slow_block_ms=None, slow_block_dir="slow-blocks", storage="mongo"):
+    """Index the blocks recorded in `path` into the `replay_id` database.
+
+    The database is dropped first. Contract calls and token metadata come
+    from the caches of `indexer_id`, so that blocks indexed while recording
+    need no rpc node. With `storage = "memory"` the blocks are indexed in
+    memory, and `mongodb_url` (the caches) is optional.
+    """
+    pipeline = None
+    if storage == "memory":
+        if pipeline_depth > 0:
+            raise ValueError("the in-memory storage does not support pipelining")
+        indexer_storage = MemoryIndexerStorage()
+    elif pipeline_depth > 0:
+        pipeline = PersistencePipeline(pipeline_depth)
+        indexer_storage = PipelinedIndexerStorage(mongodb_url, replay_id, pipeline)
+    else:
+        indexer_storage = IndexerStorage(mongodb_url, replay_id)
+    indexer_storage.drop_database()
+
+    context = create_context(
+        mongodb_url,
+        rpc_urls,
+        indexer_id,
+        lp_reconcile_interval=lp_reconcile_interval,
+        eth_price_source=eth_price_source,
+        multihop_pricing=multihop_pricing,
+        rpc_batch_size=rpc_batch_size,
+        slow_block_ms=slow_block_ms,
+        slow_block_dir=slow_block_dir,
+    )
+    indexer = JediSwapIndexer(replay_id, pipeline, compact_filter)
+    blocks, events, elapsed = await replay_blocks(
+        indexer, context, indexer_storage, read_blocks(path, from_block, to_block)
+    )
+    if pipeline is not None:
+        pipeline.drain()
+    await context.rpc.close()
+    logger.info(
+        "replay done",
+        blocks=blocks,
+        events=events,
+        elapsed_s=round(elapsed, 3),
+        blocks_per_s=round(blocks / elapsed, 1) if elapsed else None,
+        events_per_s=round(events / elapsed, 1) if elapsed else None,
+    )
+
+
+def create_context(mongodb_url, rpc_urls, indexer_id, lp_reconcile_interval=0, eth_price_source="usdc", multihop_pricing=False, backfill_distance=None, rpc_batch_size=50, metrics=None, slow_block_ms=None, slow_block_dir="slow-blocks") -> IndexerContext:
+    # kept in a separate database, so that it survives `--restart`
+    cache_db = None
+    if mongodb_url is not None:
+        cache_db = MongoClient(mongodb_url)[indexer_id.replace("-", "_") + "_cache"]
+
+    return IndexerContext(
+        rpc=RpcPool(rpc_urls, max_batch_size=rpc_batch_size),
         block_hash=0,
         block_number=0,
         block_timestamp=None,
         eth_price=Decimal("0"),
+        eth_price_oracle=EthPriceOracle(eth_price_source),
+        routes=PricingRoutes(max_hops=max_pricing_hops if multihop_pricing else 1),
+        token_metadata=TokenMetadataCache(cache_db["token_metadata"] if cache_db is not None else None),
+        calls=CallCache(cache_db["calls"] if cache_db is not None else None),
+        lp_reconcile_interval=lp_reconcile_interval,
+        backfill=BackfillMonitor(backfill_distance) if backfill_distance is not None else None,
+        metrics=metrics,
+        profiler=BlockProfiler(slow_block_ms, slow_block_dir) if slow_block_ms is not None else None,
     )
-
-    while True:
-        await runner.run(JediSwapIndexer(indexer_id), ctx=context)
-        logger.warn("disconnected. reconnecting.")
-
@@ -0,0 +1,56 @@
+import time
+from typing import Optional
+
+from pymongo import WriteConcern
+from structlog import get_logger
+
+from swap.indexer.rpc import RpcPool
+
+logger = get_logger(__name__)
+
+# acknowledged by the primary, without waiting for the journal
+backfill_write_concern = WriteConcern(w=1, j=False)
+
+
+class BackfillMonitor:
+    """Tracks how far the indexer is from the chain head while backfilling.
+
+    Blocks more than `distance` blocks behind the head are written with
+    `backfill_write_concern`. Once the indexer catches up it switches to the
+    default write concern for good.
+    """
+
+    def __init__(self, distance: int, refresh_interval: float = 60.0):
+        self.active = True
+        self._distance = distance
+        self._refresh_interval = refresh_interval
+        self._head: Optional[int] = None
+        self._refreshed_at: Optional[float] = None
+
+    async def update(self, rpc: RpcPool, block_number: int) -> bool:
+        """Returns true if `block_number` must be indexed in backfill mode."""
+        if not self.active:
+            return False
+
+        now = time.monotonic()
+        if self._refreshed_at is None or now - self._refreshed_at > self._refresh_interval:
+            # also on failure: while the node is down, do not retry on
+            # every block
+            self._refreshed_at = now
+            try:
+                self._head = await rpc.get_block_number()
+            except Exception as e:
+                logger.warn("could not fetch chain head", error=str(e))
+
+        if self._head is None:
+            # keep backfilling until the head is known
+            return True
+
+        if self._head - block_number <= self._distance:
+            self.active = False
+            logger.info(
+                "caught up with chain head, switching to live indexing",
+                block_number=block_number,
+                head=self._head,
+            )
+        return self.active
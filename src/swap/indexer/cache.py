@@ -0,0 +1,131 @@
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple, Union
+
+from apibara.indexer import Info
+from structlog import get_logger
+
+from swap.indexer.storage import apply_update
+
+logger = get_logger(__name__)
+
+# fields identifying the entities of a collection, `id` if not listed.
+_key_fields = {
+    "liquidity_positions": ("pair_address", "user"),
+}
+
+EntityId = Union[str, Tuple[str, ...]]
+
+
+class EntityCache:
+    """Block-scoped identity map for pairs, tokens, factories and liquidity
+    positions.
+
+    Entities are loaded from storage the first time a handler asks for them,
+    mutated in memory for the rest of the block and written back once when
+    the block is flushed.
+    """
+
+    def __init__(self):
+        self._entities: Dict[Tuple[str, EntityId], dict] = dict()
+        # dict used as an ordered set, so entities are flushed in the order
+        # they were first modified.
+        self._dirty: Dict[Tuple[str, EntityId], None] = dict()
+
+    async def get(self, info: Info, collection: str, id: EntityId) -> Optional[dict]:
+        """Returns the entity of `collection` identified by `id`.
+
+        `id` is a tuple of values for collections identified by more than
+        one field, e.g. `(pair_address, user)` for liquidity positions.
+        """
+        key = (collection, id)
+        entity = self._entities.get(key)
+        if entity is not None:
+            return entity
+        entity = await info.storage.find_one(collection, _key_filter(collection, id))
+        if entity is not None:
+            self._entities[key] = entity
+        return entity
+
+    def add(self, collection: str, entity: dict):
+        """Track an entity that was just inserted in storage."""
+        self._entities[(collection, _entity_id(collection, entity))] = entity
+
+    def update(self, collection: str, entity: dict, update: dict):
+        """Apply a `$set`/`$inc` update to `entity` in memory."""
+        apply_update(entity, update)
+        self._dirty[(collection, _entity_id(collection, entity))] = None
+
+    def cached(self, collection: str) -> List[dict]:
+        """Returns the entities of `collection` loaded or added in this block."""
+        return [
+            entity for key, entity in self._entities.items() if key[0] == collection
+        ]
+
+    async def flush(self, info: Info):
+        """Write back all modified entities, one replace per entity."""
+        for collection, id in self._dirty:
+            entity = self._entities[(collection, id)]
+            # the entity carries the `_id` of the version it was loaded from
+            info.storage.replace_version(collection, entity, entity)
+        logger.debug(
+            "flushed entities", loaded=len(self._entities), written=len(self._dirty)
+        )
+        self.clear()
+
+    def clear(self):
+        self._entities.clear()
+        self._dirty.clear()
+
+
+class LRUCache:
+    """Mapping that keeps its `maxsize` most recently used items."""
+
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        self._items: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        try:
+            self._items.move_to_end(key)
+        except KeyError:
+            return default
+        return self._items[key]
+
+    def put(self, key: Hashable, value: Any):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        if len(self._items) > self._maxsize:
+            self._items.popitem(last=False)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+def _entity_id(collection: str, entity: dict) -> EntityId:
+    fields = _key_fields.get(collection)
+    if fields is None:
+        return entity["id"]
+    return tuple(entity[field] for field in fields)
+
+
+def _key_filter(collection: str, id: EntityId) -> dict:
+    fields = _key_fields.get(collection)
+    if fields is None:
+        return {"id": id}
+    return dict(zip(fields, id))
+
+
+async def load_entity(info: Info, collection: str, id: EntityId) -> Optional[dict]:
+    return await info.context.entities.get(info, collection, id)
+
+
+def add_entity(info: Info, collection: str, entity: dict):
+    info.context.entities.add(collection, entity)
+
+
+def update_entity(info: Info, collection: str, entity: dict, update: dict):
+    info.context.entities.update(collection, entity, update)
+
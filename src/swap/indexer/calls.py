@@ -0,0 +1,67 @@
+import hashlib
+from typing import Dict, List, Optional
+
+from pymongo import ReplaceOne
+from pymongo.collection import Collection
+from structlog import get_logger
+
+from swap.indexer.cache import LRUCache
+
+logger = get_logger(__name__)
+
+
+class CallCache:
+    """Results of contract calls, by contract, selector, calldata and block.
+
+    Like `TokenMetadataCache`, lookups go through an in-process LRU backed
+    by a MongoDB collection that survives `--restart`: re-indexing a range
+    of blocks does not call the RPC node again. Calls are keyed by block
+    hash, so results of blocks that were reorganized are never reused.
+
+    New results are written to the collection by `flush`, once per block.
+    """
+
+    def __init__(self, collection: Optional[Collection] = None, maxsize: int = 65536):
+        self._collection = collection
+        self._lru = LRUCache(maxsize)
+        # results not written to the collection yet
+        self._pending: Dict[str, List[int]] = dict()
+
+    def get(self, key: str) -> Optional[List[int]]:
+        result = self._lru.get(key)
+        if result is not None or self._collection is None:
+            return result
+        result = self._pending.get(key)
+        if result is not None:
+            return result
+        doc = self._collection.find_one({"_id": key})
+        if doc is None:
+            return None
+        # felts do not fit in 64 bits, they are stored as hex strings
+        result = [int(value, 16) for value in doc["result"]]
+        self._lru.put(key, result)
+        return result
+
+    def put(self, key: str, result: List[int]):
+        self._lru.put(key, result)
+        if self._collection is not None:
+            self._pending[key] = result
+
+    def flush(self):
+        """Writes the results put since the last flush in a single bulk write."""
+        if not self._pending:
+            return
+        requests = [
+            ReplaceOne({"_id": key}, {"_id": key, "result": [hex(value) for value in result]}, upsert=True)
+            for key, result in self._pending.items()
+        ]
+        self._pending = dict()
+        self._collection.bulk_write(requests, ordered=False)
+
+
+def call_key(contract: int, selector: int, calldata: List[int], block_hash: str) -> str:
+    """Returns the cache key of a call of `contract` at block `block_hash`."""
+    content = ":".join(
+        [hex(contract), hex(selector), ",".join(hex(value) for value in calldata), block_hash]
+    )
+    return hashlib.sha256(content.encode()).hexdigest()
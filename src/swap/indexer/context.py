@@ -1,8 +1,21 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
 from decimal import Decimal
+from typing import Dict, Optional, Set
 
-from starknet_py.net.full_node_client import FullNodeClient
+from swap.indexer.backfill import BackfillMonitor
+from swap.indexer.cache import EntityCache
+from swap.indexer.calls import CallCache
+from swap.indexer.daily import SnapshotBuffer
+from swap.indexer.metadata import TokenMetadataCache
+from swap.indexer.metrics import IndexerMetrics
+from swap.indexer.mintburn import MintBurnBuffer
+from swap.indexer.oracle import EthPriceOracle
+from swap.indexer.pairs import PairAddresses
+from swap.indexer.profiler import BlockProfiler
+from swap.indexer.routes import PricingRoutes
+from swap.indexer.rpc import RpcPool
+from swap.indexer.users import UserStats
 
 
 @dataclass
@@ -11,4 +24,25 @@ class IndexerContext:
     block_number: int
     block_timestamp: datetime
     eth_price: Decimal
-    rpc: FullNodeClient
+    rpc: RpcPool
+    entities: EntityCache = field(default_factory=EntityCache)
+    eth_price_oracle: EthPriceOracle = field(default_factory=EthPriceOracle)
+    routes: PricingRoutes = field(default_factory=PricingRoutes)
+    token_metadata: TokenMetadataCache = field(default_factory=TokenMetadataCache)
+    # results of contract calls, by contract, selector, calldata and block hash
+    calls: CallCache = field(default_factory=CallCache)
+    # methods known not to exist, by contract address
+    failed_selectors: Dict[int, Set[str]] = field(default_factory=dict)
+    # verify LP balances against the RPC node every n blocks, 0 to disable
+    lp_reconcile_interval: int = 0
+    lp_reconcile_sample_size: int = 20
+    # set with `--backfill`
+    backfill: Optional[BackfillMonitor] = None
+    snapshots: SnapshotBuffer = field(default_factory=SnapshotBuffer)
+    mint_burn: MintBurnBuffer = field(default_factory=MintBurnBuffer)
+    users: UserStats = field(default_factory=UserStats)
+    pairs: PairAddresses = field(default_factory=PairAddresses)
+    # set with `--metrics-port`
+    metrics: Optional[IndexerMetrics] = None
+    # set with `--slow-block-ms`
+    profiler: Optional[BlockProfiler] = None
@@ -6,34 +6,29 @@ from apibara.starknet.proto.starknet_pb2 import BlockHeader, Event
 from bson import Decimal128
 from structlog import get_logger
 
-# from swap.indexer.abi import (burn_decoder, decode_event, mint_decoder,
-#                                  swap_decoder, sync_decoder, transfer_decoder)
-from swap.indexer.abi import decode_event
+from swap.indexer.abi import Burn, Mint, Swap, Sync, Transfer
+from swap.indexer.cache import load_entity, update_entity
 from swap.indexer.context import IndexerContext
 from swap.indexer.daily import (snapshot_exchange_day_data,
                                    snapshot_pair_day_data,
                                    snapshot_pair_hour_data,
-                                   snapshot_token_day_data,
-                                   update_exchange_day_data,
-                                   update_pair_day_data, update_pair_hour_data,
-                                   update_token_day_data)
-from swap.indexer.helpers import (create_liquidity_snapshot, find_or_create_user,
-                                     create_transaction,
-                                     fetch_token_balance, price,
-                                     replace_liquidity_position, to_decimal,
+                                   snapshot_token_day_data)
+from swap.indexer.helpers import (create_liquidity_snapshot, create_transaction,
+                                     price, to_decimal,
+                                     update_liquidity_position,
                                      update_transaction_count)
 from swap.indexer.jediswap import (find_eth_per_token,
                                       get_tracked_liquidity_usd,
                                       get_tracked_volume_usd, jediswap_factory, zap_in_addresses)
+from swap.indexer.users import increment_user
 
 logger = get_logger(__name__)
 
 
-async def handle_transfer(info: Info, event: Event, transaction_hash: str):
-    transfer = decode_event('Transfer', event.data)
+async def handle_transfer(info: Info, event: Event, transfer: Transfer, transaction_hash: str):
     pair_address_int = felt.to_int(event.from_address)
     pair_address = hex(pair_address_int)
-    logger.info("handle Transfer", **transfer._asdict())
+    logger.debug("handle Transfer", transfer=transfer)
     if transfer.from_ == 0 and transfer.to == 1 and transfer.value == 1000:
         return
 
@@ -41,116 +36,64 @@ async def handle_transfer(info: Info, event: Event, transaction_hash: str):
     await create_transaction(info, transaction_hash)
 
     # mints
-    mints = await info.storage.find(
-        "mints",
-        {
-            "pair_id": pair_address,
-            "transaction_hash": transaction_hash,
-        },
-    )
-    mints = list(mints)
+    mints = info.context.mint_burn.mints(pair_address, transaction_hash)
 
     if transfer.from_ == 0:
-        logger.info("transfer is a mint")
+        logger.debug("transfer is a mint")
 
         # update total supply
-        await info.storage.find_one_and_update(
-            "pairs",
-            {"id": pair_address},
-            {"$inc": {"total_supply": Decimal128(value)}},
-        )
+        pair = await load_entity(info, "pairs", pair_address)
+        update_entity(info, "pairs", pair, {"$inc": {"total_supply": Decimal128(value)}})
 
         # create new mint if no mints so far or if last one is done already
         if not mints or _is_complete_mint(mints[-1]):
-            mint = {
-                "transaction_hash": transaction_hash,
-                "index": len(mints),
-                "pair_id": pair_address,
-                "to": hex(transfer.to),
-                "liquidity": Decimal128(value),
-                "timestamp": info.context.block_timestamp,
-            }
-            await info.storage.insert_one("mints", mint)
-    elif transfer.from_ in zap_in_addresses:
-            # update latest mint
-            logger.info("transfer is zapper")
-            mints = await info.storage.find(
-                "mints",
+            mints.append(
                 {
-                    "pair_id": pair_address,
                     "transaction_hash": transaction_hash,
-                },
-                sort={"index": 1},
-            )
-            mints = list(mints)
-            assert mints
-            await info.storage.find_one_and_update(
-                "mints",
-                {
+                    "index": len(mints),
                     "pair_id": pair_address,
-                    "transaction_hash": transaction_hash,
-                    "index": len(mints) - 1,
-                },
-                {
-                    "$set": {
-                        "to": hex(transfer.to),
-                        "zap_in": True
-                    }
-                },
+                    "to": hex(transfer.to),
+                    "liquidity": Decimal128(value),
+                    "timestamp": info.context.block_timestamp,
+                }
             )
+    elif transfer.from_ in zap_in_addresses:
+            # update latest mint
+            logger.debug("transfer is zapper")
+            assert mints
+            mints[-1]["to"] = hex(transfer.to)
+            mints[-1]["zap_in"] = True
+
+    burns = info.context.mint_burn.burns(pair_address, transaction_hash)
 
     if transfer.to == pair_address_int:
-        logger.info("transfer is burn (direct)")
+        logger.debug("transfer is burn (direct)")
         # send directly to pair
-        burns = await info.storage.find(
-            "burns",
+        burns.append(
             {
-                "pair_id": pair_address,
                 "transaction_hash": transaction_hash,
-            },
+                "index": len(burns),
+                "pair_id": pair_address,
+                "sender": hex(transfer.from_),
+                "to": hex(transfer.to),
+                "liquidity": Decimal128(value),
+                "timestamp": info.context.block_timestamp,
+                "needs_complete": True,
+            }
         )
-        burns = list(burns)
-
-        burn = {
-            "transaction_hash": transaction_hash,
-            "index": len(burns),
-            "pair_id": pair_address,
-            "sender": hex(transfer.from_),
-            "to": hex(transfer.to),
-            "liquidity": Decimal128(value),
-            "timestamp": info.context.block_timestamp,
-            "needs_complete": True,
-        }
-        await info.storage.insert_one("burns", burn)
 
     # burns
     if transfer.to == 0 and transfer.from_ == pair_address_int:
-        logger.info("transfer is a burn")
+        logger.debug("transfer is a burn")
 
         # update total supply
-        await info.storage.find_one_and_update(
-            "pairs",
-            {"id": pair_address},
-            {"$inc": {"total_supply": Decimal128(-value)}},
-        )
+        pair = await load_entity(info, "pairs", pair_address)
+        update_entity(info, "pairs", pair, {"$inc": {"total_supply": Decimal128(-value)}})
 
-        burns = await info.storage.find(
-            "burns",
-            {
-                "pair_id": pair_address,
-                "transaction_hash": transaction_hash,
-            },
-        )
-        burns = list(burns)
-
-        burn = None
-        if burns:
-            current_burn = burns[-1]
-            # continue previous burn
-            if current_burn["needs_complete"]:
-                burn = current_burn
-
-        if burn is None:
+        # continue previous burn
+        if burns and burns[-1]["needs_complete"]:
+            burn = burns[-1]
+        else:
             burn = {
                 "transaction_hash": transaction_hash,
                 "index": len(burns),
@@ -161,65 +104,35 @@ async def handle_transfer(info: Info, event: Event, transaction_hash: str):
                 "timestamp": info.context.block_timestamp,
                 "needs_complete": False,
             }
+            burns.append(burn)
 
         # if this logical burn included a fee mint, account for this
         if mints and not _is_complete_mint(mints[-1]):
-            mint = mints[-1]
+            mint = mints.pop()
             burn["fee_to"] = mint["to"]
             burn["fee_liquidity"] = mint["liquidity"]
-            # remove logical mint
-            await info.storage.delete_one(
-                "mints",
-                {"transaction_hash": mint["transaction_hash"], "index": mint["index"]},
-            )
-
-        del burn["_id"]
-        if burn["needs_complete"]:
-            # replace existing burn
-            await info.storage.find_one_and_replace(
-                "burns",
-                {
-                    "transaction_hash": burn["transaction_hash"],
-                    "index": burn["index"],
-                },
-                burn,
-            )
-        else:
-            await info.storage.insert_one("burns", burn)
 
-    if transfer.from_ != 0 and transfer.from_ != pair_address:
-        from_user_balance = await fetch_token_balance(
-            info, pair_address, transfer.from_
-        )
-        from_user_balance = to_decimal(from_user_balance, 18)
-        logger.debug("from user balance", balance=from_user_balance)
-        await replace_liquidity_position(
-            info, pair_address, transfer.from_, from_user_balance
-        )
+    # track LP token balances from the transfers themselves
+    if transfer.from_ != 0:
+        await update_liquidity_position(info, pair_address, transfer.from_, -value)
         await create_liquidity_snapshot(info, pair_address, transfer.from_)
 
-    if transfer.to != 0 and transfer.to != pair_address:
-        to_user_balance = await fetch_token_balance(info, pair_address, transfer.to)
-        to_user_balance = to_decimal(to_user_balance, 18)
-        logger.debug("to user balance", balance=to_user_balance)
-        await replace_liquidity_position(
-            info, pair_address, transfer.to, to_user_balance
-        )
+    if transfer.to != 0:
+        await update_liquidity_position(info, pair_address, transfer.to, value)
         await create_liquidity_snapshot(info, pair_address, transfer.to)
 
 
-async def handle_sync(info: Info, event: Event, transaction_hash: str):
-    sync = decode_event('Sync', event.data)
+async def handle_sync(info: Info, event: Event, sync: Sync, transaction_hash: str):
     pair_address = hex(felt.to_int(event.from_address))
-    logger.info("handle Sync", **sync._asdict())
+    logger.debug("handle Sync", sync=sync)
 
-    pair = await info.storage.find_one("pairs", {"id": pair_address})
+    pair = await load_entity(info, "pairs", pair_address)
     assert pair is not None
 
-    token0 = await info.storage.find_one("tokens", {"id": pair["token0_id"]})
+    token0 = await load_entity(info, "tokens", pair["token0_id"])
     assert token0 is not None
 
-    token1 = await info.storage.find_one("tokens", {"id": pair["token1_id"]})
+    token1 = await load_entity(info, "tokens", pair["token1_id"])
     assert token1 is not None
 
     reserve0 = to_decimal(sync.reserve0, token0["decimals"])
@@ -228,7 +141,7 @@ async def handle_sync(info: Info, event: Event, transaction_hash: str):
     token0_price = price(reserve0, reserve1)
     token1_price = price(reserve1, reserve0)
 
-    logger.info(
+    logger.debug(
         "new reserves and price",
         reserve0=reserve0,
         reserve1=reserve1,
@@ -236,11 +149,14 @@ async def handle_sync(info: Info, event: Event, transaction_hash: str):
         price1=token1_price,
     )
 
-    old_pair = await info.storage.find_one_and_update(
+    old_reserve0 = pair["reserve0"].to_decimal()
+    old_reserve1 = pair["reserve1"].to_decimal()
+    old_tracked_reserve_eth = pair["tracked_reserve_eth"].to_decimal()
+
+    update_entity(
+        info,
         "pairs",
-        {
-            "id": pair_address,
-        },
+        pair,
         {
             "$set": {
                 "reserve0": Decimal128(reserve0),
@@ -251,34 +167,44 @@ async def handle_sync(info: Info, event: Event, transaction_hash: str):
         },
     )
 
+    info.context.routes.update_pair(pair)
+
+    # keep the eth price in step with the reserves of its source pairs
+    oracle = info.context.eth_price_oracle
+    if oracle.is_source(pair):
+        oracle.update(pair)
+        info.context.eth_price = oracle.price
+
     token0_liquidity = (
         token0["total_liquidity"].to_decimal()
-        - old_pair["reserve0"].to_decimal()
+        - old_reserve0
         + reserve0
     )
     token1_liquidity = (
         token1["total_liquidity"].to_decimal()
-        - old_pair["reserve1"].to_decimal()
+        - old_reserve1
         + reserve1
     )
 
-    await info.storage.find_one_and_update(
+    update_entity(
+        info,
         "tokens",
-        {"id": token0["id"]},
+        token0,
         {"$set": {"total_liquidity": Decimal128(token0_liquidity)}},
     )
 
-    await info.storage.find_one_and_update(
+    update_entity(
+        info,
         "tokens",
-        {"id": token1["id"]},
+        token1,
         {"$set": {"total_liquidity": Decimal128(token1_liquidity)}},
     )
 
-    logger.info("fetch prices", token0=token0["symbol"], token1=token1["symbol"])
+    logger.debug("fetch prices", token0=token0["symbol"], token1=token1["symbol"])
     token0_derived_eth = await find_eth_per_token(info, token0["id"])
     token1_derived_eth = await find_eth_per_token(info, token1["id"])
 
-    logger.info(
+    logger.debug(
         "refresh token eth price",
         token0=token0_derived_eth,
         token1=token1_derived_eth,
@@ -299,11 +225,10 @@ async def handle_sync(info: Info, event: Event, transaction_hash: str):
     reserve_usd = reserve_eth * info.context.eth_price
 
     # update derived amounts
-    await info.storage.find_one_and_update(
+    update_entity(
+        info,
         "pairs",
-        {
-            "id": pair_address,
-        },
+        pair,
         {
             "$set": {
                 "tracked_reserve_eth": Decimal128(tracked_liquidity_eth),
@@ -312,15 +237,17 @@ async def handle_sync(info: Info, event: Event, transaction_hash: str):
             }
         },
     )
+    info.context.routes.update_pair(pair)
 
-    factory = await info.storage.find_one("factories", {"id": hex(jediswap_factory)})
+    factory = await load_entity(info, "factories", hex(jediswap_factory))
 
-    total_liquidity_eth = factory["total_liquidity_eth"].to_decimal() - old_pair["tracked_reserve_eth"].to_decimal() + tracked_liquidity_eth
+    total_liquidity_eth = factory["total_liquidity_eth"].to_decimal() - old_tracked_reserve_eth + tracked_liquidity_eth
     total_liquidity_usd = total_liquidity_eth * info.context.eth_price
 
-    await info.storage.find_one_and_update(
+    update_entity(
+        info,
         "factories",
-        {"id": hex(jediswap_factory)},
+        factory,
         {
             "$set": {
                 "total_liquidity_eth": Decimal128(total_liquidity_eth),
@@ -330,34 +257,25 @@ async def handle_sync(info: Info, event: Event, transaction_hash: str):
     )
 
 
-async def handle_mint(info: Info, event: Event, transaction_hash: str):
-    mint = decode_event('Mint', event.data)
+async def handle_mint(info: Info, event: Event, mint: Mint, transaction_hash: str):
     pair_address = hex(felt.to_int(event.from_address))
-    logger.info("handle Mint", **mint._asdict())
+    logger.debug("handle Mint", mint=mint)
 
     transaction = await info.storage.find_one(
         "transactions", {"hash": transaction_hash}
     )
     assert transaction is not None
 
-    mints = await info.storage.find(
-        "mints",
-        {
-            "pair_id": pair_address,
-            "transaction_hash": transaction_hash,
-        },
-        sort={"index": 1},
-    )
-    mints = list(mints)
+    mints = info.context.mint_burn.mints(pair_address, transaction_hash)
     assert mints
 
-    pair = await info.storage.find_one("pairs", {"id": pair_address})
+    pair = await load_entity(info, "pairs", pair_address)
     assert pair is not None
 
-    token0 = await info.storage.find_one("tokens", {"id": pair["token0_id"]})
+    token0 = await load_entity(info, "tokens", pair["token0_id"])
     assert token0 is not None
 
-    token1 = await info.storage.find_one("tokens", {"id": pair["token1_id"]})
+    token1 = await load_entity(info, "tokens", pair["token1_id"])
     assert token1 is not None
 
     await update_transaction_count(info, jediswap_factory, pair_address, token0, token1)
@@ -373,64 +291,37 @@ async def handle_mint(info: Info, event: Event, transaction_hash: str):
     amount_total_usd = amount_total_eth * info.context.eth_price
 
     # update latest mint
-    mint = await info.storage.find_one_and_update(
-        "mints",
+    mints[-1].update(
         {
-            "pair_id": pair_address,
-            "transaction_hash": transaction_hash,
-            "index": len(mints) - 1,
-        },
-        {
-            "$set": {
-                "sender": hex(mint.sender),
-                "amount0": Decimal128(token0_amount),
-                "amount1": Decimal128(token1_amount),
-                "amount_usd": Decimal128(amount_total_usd),
-            }
-        },
+            "sender": hex(mint.sender),
+            "amount0": Decimal128(token0_amount),
+            "amount1": Decimal128(token1_amount),
+            "amount_usd": Decimal128(amount_total_usd),
+        }
     )
-
-    user = await find_or_create_user(info, mint["to"])
+    mint = mints[-1]
 
     # update users data
-    await info.storage.find_one_and_update(
-        "users",
-        {"id": user["id"]},
-        {
-            "$inc": {
-                "transaction_count": 1,
-                "mint_count": 1,
-            }
-        },
-    )
+    increment_user(info, mint["to"], {"transaction_count": 1, "mint_count": 1})
 
     # update lp position
     await create_liquidity_snapshot(info, pair_address, mint["to"])
 
     # update daily stats
-    await snapshot_pair_day_data(info, pair_address)
-    await update_pair_day_data(info, pair_address, {"$inc": {"transaction_count": 1}})
+    await snapshot_pair_day_data(info, pair_address, inc={"transaction_count": 1})
 
-    await snapshot_pair_hour_data(info, pair_address)
-    await update_pair_hour_data(info, pair_address, {"$inc": {"transaction_count": 1}})
+    await snapshot_pair_hour_data(info, pair_address, inc={"transaction_count": 1})
 
     await snapshot_exchange_day_data(info, jediswap_factory)
 
-    await snapshot_token_day_data(info, pair["token0_id"])
-    await update_token_day_data(
-        info, pair["token0_id"], {"$inc": {"transaction_count": 1}}
-    )
+    await snapshot_token_day_data(info, pair["token0_id"], inc={"transaction_count": 1})
 
-    await snapshot_token_day_data(info, pair["token1_id"])
-    await update_token_day_data(
-        info, pair["token1_id"], {"$inc": {"transaction_count": 1}}
-    )
+    await snapshot_token_day_data(info, pair["token1_id"], inc={"transaction_count": 1})
 
 
-async def handle_burn(info: Info, event: Event, transaction_hash: str):
-    burn = decode_event('Burn', event.data)
+async def handle_burn(info: Info, event: Event, burn: Burn, transaction_hash: str):
     pair_address = hex(felt.to_int(event.from_address))
-    logger.info("handle Burn", **burn._asdict())
+    logger.debug("handle Burn", burn=burn)
 
     transaction = await info.storage.find_one(
         "transactions", {"hash": transaction_hash}
@@ -438,24 +329,16 @@ async def handle_burn(info: Info, event: Event, transaction_hash: str):
     if transaction is None:
         return
 
-    burns = await info.storage.find(
-        "burns",
-        {
-            "pair_id": pair_address,
-            "transaction_hash": transaction_hash,
-        },
-        sort={"index": 1},
-    )
-    burns = list(burns)
+    burns = info.context.mint_burn.burns(pair_address, transaction_hash)
     assert burns
 
-    pair = await info.storage.find_one("pairs", {"id": pair_address})
+    pair = await load_entity(info, "pairs", pair_address)
     assert pair is not None
 
-    token0 = await info.storage.find_one("tokens", {"id": pair["token0_id"]})
+    token0 = await load_entity(info, "tokens", pair["token0_id"])
     assert token0 is not None
 
-    token1 = await info.storage.find_one("tokens", {"id": pair["token1_id"]})
+    token1 = await load_entity(info, "tokens", pair["token1_id"])
     assert token1 is not None
 
     await update_transaction_count(info, jediswap_factory, pair_address, token0, token1)
@@ -471,72 +354,45 @@ async def handle_burn(info: Info, event: Event, transaction_hash: str):
     amount_total_usd = amount_total_eth * info.context.eth_price
 
     # update burn
-    burn = await info.storage.find_one_and_update(
-        "burns",
+    burns[-1].update(
         {
-            "pair_id": pair_address,
-            "transaction_hash": transaction_hash,
-            "index": len(burns) - 1,
-        },
-        {
-            "$set": {
-                # "to": hex(burn.to),
-                "amount0": Decimal128(token0_amount),
-                "amount1": Decimal128(token1_amount),
-                "amount_usd": Decimal128(amount_total_usd),
-            }
-        },
+            # "to": hex(burn.to),
+            "amount0": Decimal128(token0_amount),
+            "amount1": Decimal128(token1_amount),
+            "amount_usd": Decimal128(amount_total_usd),
+        }
     )
-
-    user = await find_or_create_user(info, burn["sender"])
+    burn = burns[-1]
 
     # update users data
-    await info.storage.find_one_and_update(
-        "users",
-        {"id": user["id"]},
-        {
-            "$inc": {
-                "transaction_count": 1,
-                "burn_count": 1,
-            }
-        },
-    )
+    increment_user(info, burn["sender"], {"transaction_count": 1, "burn_count": 1})
 
     # update lp position
     await create_liquidity_snapshot(info, pair_address, burn["sender"])
 
     # update daily stats
-    await snapshot_pair_day_data(info, pair_address)
-    await update_pair_day_data(info, pair_address, {"$inc": {"transaction_count": 1}})
+    await snapshot_pair_day_data(info, pair_address, inc={"transaction_count": 1})
 
-    await snapshot_pair_hour_data(info, pair_address)
-    await update_pair_hour_data(info, pair_address, {"$inc": {"transaction_count": 1}})
+    await snapshot_pair_hour_data(info, pair_address, inc={"transaction_count": 1})
 
     await snapshot_exchange_day_data(info, jediswap_factory)
 
-    await snapshot_token_day_data(info, pair["token0_id"])
-    await update_token_day_data(
-        info, pair["token0_id"], {"$inc": {"transaction_count": 1}}
-    )
+    await snapshot_token_day_data(info, pair["token0_id"], inc={"transaction_count": 1})
 
-    await snapshot_token_day_data(info, pair["token1_id"])
-    await update_token_day_data(
-        info, pair["token1_id"], {"$inc": {"transaction_count": 1}}
-    )
+    await snapshot_token_day_data(info, pair["token1_id"], inc={"transaction_count": 1})
 
 
-async def handle_swap(info: Info, event: Event, transaction_hash: str):
-    swap = decode_event('Swap', event.data)
+async def handle_swap(info: Info, event: Event, swap: Swap, transaction_hash: str):
     pair_address = hex(felt.to_int(event.from_address))
-    logger.info("handle Swap", **swap._asdict())
+    logger.debug("handle Swap", swap=swap)
 
-    pair = await info.storage.find_one("pairs", {"id": pair_address})
+    pair = await load_entity(info, "pairs", pair_address)
     assert pair is not None
 
-    token0 = await info.storage.find_one("tokens", {"id": pair["token0_id"]})
+    token0 = await load_entity(info, "tokens", pair["token0_id"])
     assert token0 is not None
 
-    token1 = await info.storage.find_one("tokens", {"id": pair["token1_id"]})
+    token1 = await load_entity(info, "tokens", pair["token1_id"])
     assert token1 is not None
 
     amount0_in = to_decimal(swap.amount0_in, token0["decimals"])
@@ -566,24 +422,14 @@ async def handle_swap(info: Info, event: Event, transaction_hash: str):
     amount1_total_eth = amount1_total * token1["derived_eth"].to_decimal()
     amount1_total_usd = amount1_total_eth * info.context.eth_price
 
-    user = await find_or_create_user(info, swap.to)
-
     # update users data
-    await info.storage.find_one_and_update(
-        "users",
-        {"id": user["id"]},
-        {
-            "$inc": {
-                "transaction_count": 1,
-                "swap_count": 1,
-            }
-        },
-    )
+    increment_user(info, swap.to, {"transaction_count": 1, "swap_count": 1})
 
     # update tokens data
-    await info.storage.find_one_and_update(
+    update_entity(
+        info,
         "tokens",
-        {"id": pair["token0_id"]},
+        token0,
         {
             "$inc": {
                 "trade_volume": Decimal128(amount0_total),
@@ -594,9 +440,10 @@ async def handle_swap(info: Info, event: Event, transaction_hash: str):
         },
     )
 
-    await info.storage.find_one_and_update(
+    update_entity(
+        info,
         "tokens",
-        {"id": pair["token1_id"]},
+        token1,
         {
             "$inc": {
                 "trade_volume": Decimal128(amount1_total),
@@ -608,9 +455,10 @@ async def handle_swap(info: Info, event: Event, transaction_hash: str):
     )
 
     # update pair
-    await info.storage.find_one_and_update(
+    update_entity(
+        info,
         "pairs",
-        {"id": pair_address},
+        pair,
         {
             "$inc": {
                 "volume_usd": Decimal128(tracked_amount_usd),
@@ -623,9 +471,11 @@ async def handle_swap(info: Info, event: Event, transaction_hash: str):
     )
 
     # update factory
-    await info.storage.find_one_and_update(
+    factory = await load_entity(info, "factories", hex(jediswap_factory))
+    update_entity(
+        info,
         "factories",
-        {"id": hex(jediswap_factory)},
+        factory,
         {
             "$inc": {
                 "total_volume_usd": Decimal128(tracked_amount_usd),
@@ -656,75 +506,60 @@ async def handle_swap(info: Info, event: Event, transaction_hash: str):
     )
 
     # update daily stats
-    await snapshot_exchange_day_data(info, jediswap_factory)
-    await update_exchange_day_data(
+    await snapshot_exchange_day_data(
         info,
         jediswap_factory,
-        {
-            "$inc": {
-                "daily_volume_usd": Decimal128(tracked_amount_usd),
-                "daily_volume_eth": Decimal128(tracked_amount_eth),
-                "daily_volume_untracked": Decimal128(derive_amount_usd),
-            }
+        inc={
+            "daily_volume_usd": Decimal128(tracked_amount_usd),
+            "daily_volume_eth": Decimal128(tracked_amount_eth),
+            "daily_volume_untracked": Decimal128(derive_amount_usd),
         },
     )
 
-    await snapshot_pair_day_data(info, pair_address)
-    await update_pair_day_data(
+    await snapshot_pair_day_data(
         info,
         pair_address,
-        {
-            "$inc": {
-                "transaction_count": 1,
-                "daily_volume_token0": Decimal128(amount0_total),
-                "daily_volume_token1": Decimal128(amount1_total),
-                "daily_volume_usd": Decimal128(tracked_amount_usd),
-            }
+        inc={
+            "transaction_count": 1,
+            "daily_volume_token0": Decimal128(amount0_total),
+            "daily_volume_token1": Decimal128(amount1_total),
+            "daily_volume_usd": Decimal128(tracked_amount_usd),
         },
     )
 
-    await snapshot_pair_hour_data(info, pair_address)
-    await update_pair_hour_data(
+    await snapshot_pair_hour_data(
         info,
         pair_address,
-        {
-            "$inc": {
-                "transaction_count": 1,
-                "hourly_volume_token0": Decimal128(amount0_total),
-                "hourly_volume_token1": Decimal128(amount1_total),
-                "hourly_volume_usd": Decimal128(tracked_amount_usd),
-            }
+        inc={
+            "transaction_count": 1,
+            "hourly_volume_token0": Decimal128(amount0_total),
+            "hourly_volume_token1": Decimal128(amount1_total),
+            "hourly_volume_usd": Decimal128(tracked_amount_usd),
         },
     )
 
-    await snapshot_token_day_data(info, pair["token0_id"])
-    await update_token_day_data(
+    await snapshot_token_day_data(
         info,
         pair["token0_id"],
-        {
-            "$inc": {
-                "transaction_count": 1,
-                "daily_volume_token": Decimal128(amount0_total),
-                "daily_volume_eth": Decimal128(amount0_total_eth),
-                "daily_volume_usd": Decimal128(amount0_total_usd),
-            }
+        inc={
+            "transaction_count": 1,
+            "daily_volume_token": Decimal128(amount0_total),
+            "daily_volume_eth": Decimal128(amount0_total_eth),
+            "daily_volume_usd": Decimal128(amount0_total_usd),
         },
     )
 
-    await snapshot_token_day_data(info, pair["token1_id"])
-    await update_token_day_data(
+    await snapshot_token_day_data(
         info,
         pair["token1_id"],
-        {
-            "$inc": {
-                "transaction_count": 1,
-                "daily_volume_token": Decimal128(amount1_total),
-                "daily_volume_eth": Decimal128(amount1_total_eth),
-                "daily_volume_usd": Decimal128(amount1_total_usd),
-            }
+        inc={
+            "transaction_count": 1,
+            "daily_volume_token": Decimal128(amount1_total),
+            "daily_volume_eth": Decimal128(amount1_total_eth),
+            "daily_volume_usd": Decimal128(amount1_total_usd),
         },
     )
 
 
 def _is_complete_mint(mint):
-    return mint["sender"] is not None
+    return mint.get("sender") is not None
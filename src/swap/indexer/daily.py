@@ -1,277 +1,190 @@
 from datetime import datetime
-from typing import Union
+from typing import Any, Dict, Optional, Tuple, Union
 
 from apibara.indexer import Info
 from bson import Decimal128
 
-from swap.indexer.context import IndexerContext
+from swap.indexer.cache import load_entity
+from swap.indexer.storage import apply_update
 
 from structlog import get_logger
 
 logger = get_logger(__name__)
 
 
-async def snapshot_pair_day_data(info: Info, pair_address: str):
-    pair = await info.storage.find_one("pairs", {"id": pair_address})
+class SnapshotBuffer:
+    """Dirty set of the day and hour buckets touched by a block.
+
+    Each touched bucket (e.g. a pair's day) keeps the values of its latest
+    snapshot and the sum of its `$inc` deltas. `flush` writes every bucket
+    once, at the end of the block, as a single upsert carrying both.
+    """
+
+    def __init__(self):
+        self._buckets: Dict[Tuple[str, Tuple], Dict[str, Any]] = dict()
+
+    def write(
+        self, collection: str, filter: dict, values: dict, inc: Optional[dict] = None
+    ):
+        key = (collection, tuple(filter.items()))
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = {"filter": filter, "inc": dict()}
+            self._buckets[key] = bucket
+        # the latest snapshot wins
+        bucket["values"] = values
+        if inc:
+            # accumulate the deltas
+            apply_update(bucket["inc"], {"$inc": inc})
+
+    async def flush(self, info: Info):
+        for (collection, _), bucket in self._buckets.items():
+            update = {"$set": bucket["values"]}
+            if bucket["inc"]:
+                update["$inc"] = bucket["inc"]
+            await info.storage.update_one(
+                collection, bucket["filter"], update, upsert=True
+            )
+        logger.debug("flushed snapshots", buckets=len(self._buckets))
+        self.clear()
+
+    def clear(self):
+        self._buckets.clear()
+
+
+async def snapshot_pair_day_data(
+    info: Info, pair_address: str, inc: Optional[dict] = None
+):
+    pair = await load_entity(info, "pairs", pair_address)
 
     day_id, day_start = _day_id(info)
 
-    pair_day_data = await info.storage.find_one("pair_day_data", {
+    await _snapshot(
+        info,
+        "pair_day_data",
+        {
             "pair_id": pair_address,
             "day_id": day_id,
-        })
-
-    if pair_day_data:
-        await info.storage.find_one_and_update(
-            "pair_day_data",
-            {
-                "pair_id": pair_address,
-                "day_id": day_id,
-            },
-            {
-                "$set": {
-                    "pair_id": pair_address,
-                    "day_id": day_id,
-                    "date": day_start,
-                    "token0_id": pair["token0_id"],
-                    "token1_id": pair["token1_id"],
-                    "total_supply": pair["total_supply"],
-                    "reserve0": pair["reserve0"],
-                    "reserve1": pair["reserve1"],
-                    "reserve_usd": pair["reserve_usd"],
-                    "token0_price": pair["token0_price"],
-                    "token1_price": pair["token1_price"],
-                }
-            }
-        )
-    else:
-        await info.storage.insert_one(
-            "pair_day_data",
-            {
-                "pair_id": pair_address,
-                "day_id": day_id,
-                "date": day_start,
-                "token0_id": pair["token0_id"],
-                "token1_id": pair["token1_id"],
-                "total_supply": pair["total_supply"],
-                "reserve0": pair["reserve0"],
-                "reserve1": pair["reserve1"],
-                "reserve_usd": pair["reserve_usd"],
-                "token0_price": pair["token0_price"],
-                "token1_price": pair["token1_price"],
-            }
-        )
-
-
-async def update_pair_day_data(info: Info, pair_address: str, update):
-    day_id, _day_start = _day_id(info)
-
-    await info.storage.find_one_and_update(
-        "pair_day_data",
+        },
         {
             "pair_id": pair_address,
             "day_id": day_id,
+            "date": day_start,
+            "token0_id": pair["token0_id"],
+            "token1_id": pair["token1_id"],
+            "total_supply": pair["total_supply"],
+            "reserve0": pair["reserve0"],
+            "reserve1": pair["reserve1"],
+            "reserve_usd": pair["reserve_usd"],
+            "token0_price": pair["token0_price"],
+            "token1_price": pair["token1_price"],
         },
-        update,
+        inc,
     )
 
 
-async def snapshot_pair_hour_data(info: Info, pair_address: str):
-    pair = await info.storage.find_one("pairs", {"id": pair_address})
+async def snapshot_pair_hour_data(
+    info: Info, pair_address: str, inc: Optional[dict] = None
+):
+    pair = await load_entity(info, "pairs", pair_address)
 
     hour_id, hour_start = _hour_id(info)
 
-    pair_hour_data = await info.storage.find_one("pair_hour_data", {
+    await _snapshot(
+        info,
+        "pair_hour_data",
+        {
             "pair_id": pair_address,
             "hour_id": hour_id,
-        })
-
-    if pair_hour_data:
-        await info.storage.find_one_and_update(
-            "pair_hour_data",
-            {
-                "pair_id": pair_address,
-                "hour_id": hour_id,
-            },
-            {
-                "$set": {
-                    "pair_id": pair_address,
-                    "hour_id": hour_id,
-                    "date": hour_start,
-                    "token0_id": pair["token0_id"],
-                    "token1_id": pair["token1_id"],
-                    "total_supply": pair["total_supply"],
-                    "reserve0": pair["reserve0"],
-                    "reserve1": pair["reserve1"],
-                    "reserve_usd": pair["reserve_usd"],
-                    "token0_price": pair["token0_price"],
-                    "token1_price": pair["token1_price"],
-                }
-            }
-        )
-    else:
-        await info.storage.insert_one(
-            "pair_hour_data",
-            {
-                "pair_id": pair_address,
-                "hour_id": hour_id,
-                "date": hour_start,
-                "token0_id": pair["token0_id"],
-                "token1_id": pair["token1_id"],
-                "total_supply": pair["total_supply"],
-                "reserve0": pair["reserve0"],
-                "reserve1": pair["reserve1"],
-                "reserve_usd": pair["reserve_usd"],
-                "token0_price": pair["token0_price"],
-                "token1_price": pair["token1_price"],
-            }
-        )
-
-
-async def update_pair_hour_data(info: Info, pair_address: str, update):
-    hour_id, _hour_start = _hour_id(info)
-
-    await info.storage.find_one_and_update(
-        "pair_hour_data",
+        },
         {
             "pair_id": pair_address,
             "hour_id": hour_id,
+            "date": hour_start,
+            "token0_id": pair["token0_id"],
+            "token1_id": pair["token1_id"],
+            "total_supply": pair["total_supply"],
+            "reserve0": pair["reserve0"],
+            "reserve1": pair["reserve1"],
+            "reserve_usd": pair["reserve_usd"],
+            "token0_price": pair["token0_price"],
+            "token1_price": pair["token1_price"],
         },
-        update,
+        inc,
     )
 
 
-async def snapshot_exchange_day_data(info: Info, address: int):
-    exchange = await info.storage.find_one("factories", {"id": hex(address)})
+async def snapshot_exchange_day_data(
+    info: Info, address: int, inc: Optional[dict] = None
+):
+    exchange = await load_entity(info, "factories", hex(address))
 
     day_id, day_start = _day_id(info)
 
-    exchange_day_data = await info.storage.find_one("exchange_day_data", {
+    await _snapshot(
+        info,
+        "exchange_day_data",
+        {
             "address": hex(address),
             "day_id": day_id,
-        })
-
-    if exchange_day_data:
-        await info.storage.find_one_and_update(
-            "exchange_day_data",
-            {
-                "address": hex(address),
-                "day_id": day_id,
-            },
-            {
-                "$set": {
-                    "address": hex(address),
-                    "day_id": day_id,
-                    "date": day_start,
-                    "total_volume_usd": exchange["total_volume_usd"],
-                    "total_volume_eth": exchange["total_volume_eth"],
-                    "total_liquidity_usd": exchange["total_liquidity_usd"],
-                    "total_liquidity_eth": exchange["total_liquidity_eth"],
-                    "transaction_count": exchange["transaction_count"],
-                }
-            }
-        )
-    else:
-        await info.storage.insert_one(
-            "exchange_day_data",
-            {
-                "address": hex(address),
-                "day_id": day_id,
-                "date": day_start,
-                "total_volume_usd": exchange["total_volume_usd"],
-                "total_volume_eth": exchange["total_volume_eth"],
-                "total_liquidity_usd": exchange["total_liquidity_usd"],
-                "total_liquidity_eth": exchange["total_liquidity_eth"],
-                "transaction_count": exchange["transaction_count"],
-            }
-        )
-
-
-async def update_exchange_day_data(info: Info, address: int, update):
-    day_id, _day_start = _day_id(info)
-
-    await info.storage.find_one_and_update(
-        "exchange_day_data",
+        },
         {
             "address": hex(address),
             "day_id": day_id,
+            "date": day_start,
+            "total_volume_usd": exchange["total_volume_usd"],
+            "total_volume_eth": exchange["total_volume_eth"],
+            "total_liquidity_usd": exchange["total_liquidity_usd"],
+            "total_liquidity_eth": exchange["total_liquidity_eth"],
+            "transaction_count": exchange["transaction_count"],
         },
-        update,
+        inc,
     )
 
 
 async def snapshot_token_day_data(
-    info: Info, token_address: Union[int, bytes]
+    info: Info, token_address: Union[int, bytes], inc: Optional[dict] = None
 ):
     if isinstance(token_address, int):
         token_address = hex(token_address)
 
     day_id, day_start = _day_id(info)
 
-    token = await info.storage.find_one("tokens", {"id": token_address})
+    token = await load_entity(info, "tokens", token_address)
 
     price_usd = token["derived_eth"].to_decimal() * info.context.eth_price
     total_liquidity_token = token["total_liquidity"].to_decimal()
     total_liquidity_eth = total_liquidity_token * token["derived_eth"].to_decimal()
     total_liquidity_usd = total_liquidity_eth * info.context.eth_price
 
-    token_day_data = await info.storage.find_one("token_day_data", {
+    await _snapshot(
+        info,
+        "token_day_data",
+        {
             "token_id": token_address,
             "day_id": day_id,
-        })
-
-    if token_day_data:
-        await info.storage.find_one_and_update(
-            "token_day_data",
-            {
-                "token_id": token_address,
-                "day_id": day_id,
-            },
-            {
-                "$set": {
-                    "token_id": token_address,
-                    "day_id": day_id,
-                    "date": day_start,
-                    "price_usd": Decimal128(price_usd),
-                    "total_liquidity_token": Decimal128(total_liquidity_token),
-                    "total_liquidity_eth": Decimal128(total_liquidity_eth),
-                    "total_liquidity_usd": Decimal128(total_liquidity_usd),
-                }
-            }
-        )
-    else:
-        await info.storage.insert_one(
-            "token_day_data",
-            {
-                "token_id": token_address,
-                "day_id": day_id,
-                "date": day_start,
-                "price_usd": Decimal128(price_usd),
-                "total_liquidity_token": Decimal128(total_liquidity_token),
-                "total_liquidity_eth": Decimal128(total_liquidity_eth),
-                "total_liquidity_usd": Decimal128(total_liquidity_usd),
-            }
-        )
-
-
-async def update_token_day_data(
-    info: Info, token: Union[int, bytes], update
-):
-    if isinstance(token, int):
-        token = hex(token)
-
-    day_id, _day_start = _day_id(info)
-
-    await info.storage.find_one_and_update(
-        "token_day_data",
+        },
         {
-            "token_id": token,
+            "token_id": token_address,
             "day_id": day_id,
+            "date": day_start,
+            "price_usd": Decimal128(price_usd),
+            "total_liquidity_token": Decimal128(total_liquidity_token),
+            "total_liquidity_eth": Decimal128(total_liquidity_eth),
+            "total_liquidity_usd": Decimal128(total_liquidity_usd),
         },
-        update,
+        inc,
     )
 
 
+async def _snapshot(
+    info: Info, collection: str, filter: dict, values: dict, inc: Optional[dict]
+):
+    """Set `values` on the bucket matching `filter` and increment its `inc`
+    fields, creating the bucket if needed, at the end of the block."""
+    info.context.snapshots.write(collection, filter, values, inc)
+
+
 def _day_id(info: Info):
     ts = int(info.context.block_timestamp.timestamp())
     day_id = ts // 86400
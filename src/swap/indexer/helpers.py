@@ -1,5 +1,8 @@
+import asyncio
+import random
+import time
 from decimal import Decimal
-from typing import List, Union
+from typing import List, Optional, Union
 
 from apibara.indexer import Info
 from bson import Decimal128
@@ -8,6 +11,8 @@ from starknet_py.contract import ContractFunction
 from starknet_py.net.client_models import Call
 from starknet_py.net.client_errors import ClientError
 
+from swap.indexer.cache import add_entity, load_entity, update_entity
+from swap.indexer.calls import call_key
 from swap.indexer.context import IndexerContext
 
 from swap.indexer.jediswap import _eth
@@ -15,6 +20,15 @@ from swap.indexer.jediswap import _eth
 from structlog import get_logger
 logger = get_logger(__name__)
 
+# StarkNet RPC API errors meaning the contract does not implement the
+# method: contract not found, invalid message selector, contract error
+_missing_method_codes = {20, 21, 40}
+
+_name_methods = ["name", "get_name"]
+_symbol_methods = ["symbol", "get_symbol"]
+_decimals_methods = ["decimals", "get_decimals"]
+_total_supply_methods = ["totalSupply", "total_supply", "get_total_supply"]
+
 
 def uint256(low, high):
     return low + (high << 128)
@@ -32,21 +46,18 @@ def price(a: Decimal, b: Decimal):
 
 
 async def create_token(info: Info, address: int):
-    token = await info.storage.find_one("tokens", {"id": hex(address)})
+    token = await load_entity(info, "tokens", hex(address))
     if token is not None:
         return token
-    name = await fetch_token_name(info, address)
-    symbol = await fetch_token_symbol(info, address)
-    decimals = await fetch_token_decimals(info, address)
-    total_supply = await fetch_token_total_supply(info, address)
+    metadata = await fetch_token_metadata(info, address)
 
     token = {
         "id": hex(address),
-        "name": name,
-        "symbol": symbol,
-        "decimals": decimals,
+        "name": metadata["name"],
+        "symbol": metadata["symbol"],
+        "decimals": metadata["decimals"],
         # used for market cap
-        "total_supply": hex(total_supply),
+        "total_supply": metadata["total_supply"],
         # token specific volume
         "trade_volume": Decimal128("0"),
         "trade_volume_usd": Decimal128("0"),
@@ -63,6 +74,8 @@ async def create_token(info: Info, address: int):
         token["derived_eth"] = Decimal128("1")
 
     await info.storage.insert_one("tokens", token)
+    add_entity(info, "tokens", token)
+    info.context.routes.set_derived_eth(token["id"], token["derived_eth"].to_decimal())
     return token
 
 
@@ -82,44 +95,87 @@ async def create_transaction(info: Info, transaction_hash: bytes):
     await info.storage.insert_one("transactions", transaction)
     return transaction
 
-async def find_or_create_user(info: Info, user_id: Union[int, bytes]):
-    
-    if isinstance(user_id, int):
-        user_id = hex(user_id)
-    
-    user = await info.storage.find_one(
-        "users", {"id": user_id}
-    )
-    if user is not None:
-        return user
-
-    user = {
-        "id": user_id,
-        "transaction_count": 0,
-        "swap_count": 0,
-        "mint_count": 0,
-        "burn_count": 0,
-    }
-
-    await info.storage.insert_one("users", user)
-    return user
-
-
-async def replace_liquidity_position(
-    info: Info, pair_address: str, user: int, balance: Decimal
+async def update_liquidity_position(
+    info: Info, pair_address: str, user: int, delta: Decimal
 ):
-    await info.storage.find_one_and_replace(
-        "liquidity_positions",
-        {
-            "pair_address": pair_address,
-            "user": hex(user),
-        },
-        {
+    """Apply a transfer of `delta` LP tokens to the balance of `user`.
+
+    Balances are derived from the pair's Transfer events, starting from
+    zero, instead of calling `balanceOf` on every transfer.
+    """
+    position = await load_entity(
+        info, "liquidity_positions", (pair_address, hex(user))
+    )
+    if position is None:
+        position = {
             "pair_address": pair_address,
             "user": hex(user),
-            "liquidity_token_balance": Decimal128(balance),
-        },
-        upsert=True,
+            "liquidity_token_balance": Decimal128(delta),
+        }
+        await info.storage.insert_one("liquidity_positions", position)
+        add_entity(info, "liquidity_positions", position)
+        return position
+
+    update_entity(
+        info,
+        "liquidity_positions",
+        position,
+        {"$inc": {"liquidity_token_balance": Decimal128(delta)}},
+    )
+    return position
+
+
+async def reconcile_liquidity_positions(info: Info, sample_size: int):
+    """Compare a sample of the liquidity positions touched by the block with
+    the balances reported by the RPC node, fixing the ones that differ."""
+    positions = info.context.entities.cached("liquidity_positions")
+    if len(positions) > sample_size:
+        positions = random.sample(positions, sample_size)
+    balances = await asyncio.gather(
+        *(
+            fetch_token_balance(
+                info, int(position["pair_address"], 16), int(position["user"], 16)
+            )
+            for position in positions
+        ),
+        return_exceptions=True,
+    )
+
+    mismatches = 0
+    for position, balance in zip(positions, balances):
+        if isinstance(balance, Exception):
+            logger.warn(
+                "could not reconcile liquidity position",
+                pair_address=position["pair_address"],
+                user=position["user"],
+                error=str(balance),
+            )
+            continue
+        balance = to_decimal(balance, 18)
+        ledger_balance = position["liquidity_token_balance"].to_decimal()
+        if balance == ledger_balance:
+            continue
+        mismatches += 1
+        logger.warn(
+            "liquidity position balance mismatch",
+            pair_address=position["pair_address"],
+            user=position["user"],
+            ledger_balance=ledger_balance,
+            rpc_balance=balance,
+            block_number=info.context.block_number,
+        )
+        update_entity(
+            info,
+            "liquidity_positions",
+            position,
+            {"$set": {"liquidity_token_balance": Decimal128(balance)}},
+        )
+
+    logger.info(
+        "reconciled liquidity positions",
+        block_number=info.context.block_number,
+        checked=len(positions),
+        mismatches=mismatches,
     )
 
 
@@ -129,15 +185,13 @@ async def create_liquidity_snapshot(
     if isinstance(user, int):
         user = hex(user)
 
-    pair = await info.storage.find_one("pairs", {"id": pair_address})
+    pair = await load_entity(info, "pairs", pair_address)
     assert pair is not None
-    token0 = await info.storage.find_one("tokens", {"id": pair["token0_id"]})
+    token0 = await load_entity(info, "tokens", pair["token0_id"])
     assert token0 is not None
-    token1 = await info.storage.find_one("tokens", {"id": pair["token1_id"]})
+    token1 = await load_entity(info, "tokens", pair["token1_id"])
     assert token1 is not None
-    position = await info.storage.find_one(
-        "liquidity_positions", {"pair_address": pair_address, "user": user}
-    )
+    position = await load_entity(info, "liquidity_positions", (pair_address, user))
     assert position is not None
 
     token0_price_usd = token0["derived_eth"].to_decimal() * info.context.eth_price
@@ -164,90 +218,134 @@ async def create_liquidity_snapshot(
 async def update_transaction_count(
     info: Info, factory: int, pair_address: str, token0, token1
 ):
-    await info.storage.find_one_and_update(
-        "factories", {"id": hex(factory)}, {"$inc": {"transaction_count": 1}}
-    )
+    factory = await load_entity(info, "factories", hex(factory))
+    update_entity(info, "factories", factory, {"$inc": {"transaction_count": 1}})
 
-    await info.storage.find_one_and_update(
-        "tokens", {"id": token0["id"]}, {"$inc": {"transaction_count": 1}}
-    )
+    update_entity(info, "tokens", token0, {"$inc": {"transaction_count": 1}})
 
-    await info.storage.find_one_and_update(
-        "tokens", {"id": token1["id"]}, {"$inc": {"transaction_count": 1}}
-    )
+    update_entity(info, "tokens", token1, {"$inc": {"transaction_count": 1}})
+
+    pair = await load_entity(info, "pairs", pair_address)
+    update_entity(info, "pairs", pair, {"$inc": {"transaction_count": 1}})
+
+
+async def fetch_token_metadata(info: Info, address: int) -> dict:
+    """Returns the token's name, symbol, decimals and total supply.
+
+    Known tokens are served from the metadata cache, new tokens are fetched
+    with concurrent RPC calls and then cached, unless a field fell back to
+    its placeholder.
+    """
+    metadata = info.context.token_metadata.get(address)
+    if metadata is not None:
+        return metadata
 
-    await info.storage.find_one_and_update(
-        "pairs", {"id": pair_address}, {"$inc": {"transaction_count": 1}}
+    name, symbol, decimals, total_supply = await asyncio.gather(
+        fetch_token_name(info, address),
+        fetch_token_symbol(info, address),
+        fetch_token_decimals(info, address),
+        fetch_token_total_supply(info, address),
     )
+    metadata = {
+        "name": name,
+        "symbol": symbol,
+        "decimals": decimals,
+        "total_supply": hex(total_supply),
+    }
+    failed = info.context.failed_selectors.get(address, set())
+    if not any(
+        failed.issuperset(methods)
+        for methods in (_name_methods, _symbol_methods, _decimals_methods, _total_supply_methods)
+    ):
+        info.context.token_metadata.put(address, metadata)
+    return metadata
 
 
 async def fetch_token_balance(
     info: Info, token_address: int, user: int
 ):
-    try:
-        result = await simple_call(info, token_address, "balanceOf", [user])
-    except:
-        result = await simple_call(info, token_address, "balance_of", [user])
+    result = await call_with_fallback(
+        info, token_address, ["balanceOf", "balance_of"], [user]
+    )
+    if result is None:
+        raise ValueError(f"{hex(token_address)} has no balance method")
     return uint256(result[0], result[1])
 
 
 async def fetch_token_name(info: Info, address: int):
-    try:
-        result = await simple_call(info, address, "name", [])
-    except:
-        try:
-            result = await simple_call(info, address, "get_name", [])
-        except:
-            return 'NonToken'
+    result = await call_with_fallback(info, address, _name_methods, [])
+    if result is None:
+        return 'NonToken'
     return decode_shortstring(result[0]).strip("\x00")
 
 
 async def fetch_token_symbol(info: Info, address: int):
-    try:
-        result = await simple_call(info, address, "symbol", [])
-    except:
-        try:
-            result = await simple_call(info, address, "get_symbol", [])
-        except:
-            return 'NONT'
+    result = await call_with_fallback(info, address, _symbol_methods, [])
+    if result is None:
+        return 'NONT'
     return decode_shortstring(result[0]).strip("\x00")
 
 
 async def fetch_token_decimals(info: Info, address: int):
-    try:
-        result = await simple_call(info, address, "decimals", [])
-    except:
-        try:
-            result = await simple_call(info, address, "get_decimals", [])
-        except:
-            return 0
+    result = await call_with_fallback(info, address, _decimals_methods, [])
+    if result is None:
+        return 0
     return result[0]
 
 
 async def fetch_token_total_supply(info: Info, address: int):
-    try:
-        result = await simple_call(info, address, "totalSupply", [])
-    except:
-        try:
-            result = await simple_call(info, address, "total_supply", [])
-        except:
-            try:
-                result = await simple_call(info, address, "get_total_supply", []) 
-            except:
-                return 0
-    try:
+    result = await call_with_fallback(info, address, _total_supply_methods, [])
+    if result is None:
+        return 0
+    if len(result) > 1:
         return uint256(result[0], result[1])
-    except:
-        return result[0]
+    return result[0]
+
+
+async def call_with_fallback(
+    info: Info, contract: int, methods: List[str], calldata: List[int]
+) -> Optional[List[int]]:
+    """Call the first of `methods` implemented by `contract`.
+
+    Methods the contract does not implement (contract not found, invalid
+    selector or contract error) are remembered per contract and not tried
+    again. Returns `None` if the contract implements none of them, other
+    errors (e.g. http or rate limit errors) are raised so the block is
+    retried.
+    """
+    failed = info.context.failed_selectors.setdefault(contract, set())
+    for method in methods:
+        if method in failed:
+            continue
+        try:
+            return await simple_call(info, contract, method, calldata)
+        except ClientError as e:
+            if e.code not in _missing_method_codes:
+                raise
+            failed.add(method)
+    return None
 
 
 async def simple_call(
     info: Info, contract: int, method: str, calldata: List[int]
 ):
     selector = ContractFunction.get_selector(method)
+    key = call_key(contract, selector, calldata, info.context.block_hash)
+    result = info.context.calls.get(key)
+    profiler = info.context.profiler
+    if result is not None:
+        if profiler is not None:
+            profiler.record_call(method, 0.0, cached=True)
+        return result
     call = Call(contract, selector, calldata)
+    start = time.perf_counter()
     try:
-        return await info.context.rpc.call_contract(call, block_number=info.context.block_number)
+        result = await info.context.rpc.call_contract(call, block_hash=info.context.block_hash)
     except Exception as e:
         logger.info("rpc call did not succeed", error=str(e), contract=contract, method=method, calldata=calldata, block_number=info.context.block_number, block_hash=info.context.block_hash)  
         raise
+    finally:
+        if profiler is not None:
+            profiler.record_call(method, time.perf_counter() - start)
+    info.context.calls.put(key, result)
+    return result
@@ -4,7 +4,7 @@ from bson import Decimal128
 
 from apibara.indexer import Info
 
-from swap.indexer.context import IndexerContext
+from swap.indexer.cache import load_entity, update_entity
 
 from structlog import get_logger
 
@@ -20,16 +20,21 @@ index_from_block = 10_760
 
 _eth = int("049d36570d4e46f48e99674bd3fcc84644ddd6b96f7c741b1562b82f9e004dc7", 16)
 _usdc = int("053c91253bc9682c04929ca02ed00b3e423f6710d2ee7e0d5ebb06f3ecf368a8", 16)
+_dai = int("00da114221cb83fa859dbdb4c44beeaa0bb37c7537ad5ae66fe5e0efd20e6eb3", 16)
+_usdt = int("068f5c6a61780768455de69077e07e89787839bf8166decfbf92b645209c0fb8", 16)
+
+# used by the `median` and `weighted` eth price sources
+_stablecoins = [_dai, _usdc, _usdt]
 
 _whitelist = [
     # ETH
     _eth,
     # DAI
-    int("00da114221cb83fa859dbdb4c44beeaa0bb37c7537ad5ae66fe5e0efd20e6eb3", 16),
+    _dai,
     # USDC
     _usdc,
     # USDT
-    int("068f5c6a61780768455de69077e07e89787839bf8166decfbf92b645209c0fb8", 16),
+    _usdt,
     # wBTC
     int("03fe2b97c1fd336e750087d68b9b867997fd64a2661ff3ca5a7c771641e8e7ac", 16),
 ]
@@ -41,13 +46,10 @@ _eth_usdc_address = hex(
 
 _minimum_liquidity_threshold_eth = Decimal("1")
 
+# longest path of pairs used to price a token with `--multihop-pricing`
+max_pricing_hops = 3
 
-async def get_eth_price(info: Info):
-    """Returns ETH price using the price in the ETH-USDC pool."""
-    pair = await info.storage.find_one("pairs", {"id": _eth_usdc_address})
-    if pair is None:
-        return None
-    return pair["token1_price"].to_decimal()
+_whitelisted_ids = [hex(token) for token in _whitelist]
 
 
 async def find_eth_per_token(info: Info, token: Union[int, bytes]):
@@ -58,42 +60,49 @@ async def find_eth_per_token(info: Info, token: Union[int, bytes]):
     if token == hex(_eth): 
         return Decimal("1")
 
-    for whitelisted in _whitelist:
-        pair = await info.storage.find_one(
-            "pairs", {"token0_id": token, "token1_id": hex(whitelisted)}
-        )
-        if pair is not None:
-            if pair["reserve_eth"].to_decimal() >= _minimum_liquidity_threshold_eth:
-                token1 = await info.storage.find_one(
-                    "tokens", {"id": hex(whitelisted)}
-                )
-                token0_derived_eth = pair["token1_price"].to_decimal() * token1["derived_eth"].to_decimal()
-                await info.storage.find_one_and_update(
-                    "tokens", 
-                    {"id": token}, 
-                    {"$set": {"derived_eth": Decimal128(token0_derived_eth)}},
-                    )
-                return (token0_derived_eth)
-
-        pair = await info.storage.find_one(
-            "pairs", {"token1_id": token, "token0_id": hex(whitelisted)}
+    routes = info.context.routes
+    for route in routes.routes(token):
+        pair = routes.pair(route.pair_id)
+        if pair.reserve_eth < _minimum_liquidity_threshold_eth:
+            continue
+        if route.token_is_token0:
+            derived_eth = pair.token1_price * routes.derived_eth(route.whitelisted)
+        else:
+            derived_eth = pair.token0_price * routes.derived_eth(route.whitelisted)
+        token_entity = await load_entity(info, "tokens", token)
+        update_entity(
+            info,
+            "tokens",
+            token_entity,
+            {"$set": {"derived_eth": Decimal128(derived_eth)}},
         )
-        if pair is not None:
-            if pair["reserve_eth"].to_decimal() >= _minimum_liquidity_threshold_eth:
-                token0 = await info.storage.find_one(
-                    "tokens", {"id": hex(whitelisted)}
-                )
-                token1_derived_eth = pair["token0_price"].to_decimal() * token0["derived_eth"].to_decimal()
-                await info.storage.find_one_and_update(
-                    "tokens", 
-                    {"id": token}, 
-                    {"$set": {"derived_eth": Decimal128(token1_derived_eth)}},
-                    )
-                return (token1_derived_eth)
+        routes.set_derived_eth(token, derived_eth)
+        return derived_eth
+
+    # no direct pair with enough liquidity, try longer paths
+    if routes.max_hops > 1:
+        derived_eth = routes.best_path_price(token, _minimum_liquidity_threshold_eth)
+        if derived_eth is not None:
+            token_entity = await load_entity(info, "tokens", token)
+            update_entity(
+                info,
+                "tokens",
+                token_entity,
+                {"$set": {"derived_eth": Decimal128(derived_eth)}},
+            )
+            return derived_eth
 
     return Decimal("0")
 
 
+def _is_tracked(info: Info, token: dict) -> bool:
+    """Returns true if the token's volume and liquidity are tracked: tokens in
+    the whitelist, or any priced token with multi-hop pricing."""
+    if token["id"] in _whitelisted_ids:
+        return True
+    return info.context.routes.max_hops > 1 and token["derived_eth"].to_decimal() > Decimal("0")
+
+
 async def get_tracked_liquidity_usd(
     info: Info, token0, token0_amount, token1, token1_amount
 ):
@@ -101,13 +110,8 @@ async def get_tracked_liquidity_usd(
     price0 = token0["derived_eth"].to_decimal() * eth_usd
     price1 = token1["derived_eth"].to_decimal() * eth_usd
 
-    token0_whitelisted = False
-    token1_whitelisted = False
-    for whitelisted in _whitelist:
-        if hex(whitelisted) == token0["id"]:
-            token0_whitelisted = True
-        if hex(whitelisted) == token1["id"]:
-            token1_whitelisted = True
+    token0_whitelisted = _is_tracked(info, token0)
+    token1_whitelisted = _is_tracked(info, token1)
 
     # take average of the two
     if token0_whitelisted and token1_whitelisted:
@@ -131,13 +135,8 @@ async def get_tracked_volume_usd(
     price0 = token0["derived_eth"].to_decimal() * info.context.eth_price
     price1 = token1["derived_eth"].to_decimal() * info.context.eth_price
 
-    token0_whitelisted = False
-    token1_whitelisted = False
-    for whitelisted in _whitelist:
-        if hex(whitelisted) == token0["id"]:
-            token0_whitelisted = True
-        if hex(whitelisted) == token1["id"]:
-            token1_whitelisted = True
+    token0_whitelisted = _is_tracked(info, token0)
+    token1_whitelisted = _is_tracked(info, token1)
 
     # take average of the two
     if token0_whitelisted and token1_whitelisted:
@@ -0,0 +1,95 @@
+import logging
+import random
+import time
+from collections import Counter, defaultdict
+from typing import Dict
+
+import structlog
+from structlog import get_logger
+
+logger = get_logger(__name__)
+
+log_levels = ["debug", "info", "warning", "error"]
+
+# whether detailed (debug) logs are emitted for the current block
+_detailed = True
+_sample_rate = 1.0
+
+
+def configure_logging(
+    level: str = "info", sample_rate: float = 1.0, apibara_level: str = "info"
+):
+    """Configure structlog for the indexer.
+
+    Log calls below `level` are no-ops, their arguments are not even
+    formatted. With `level = "debug"`, `sample_rate` is the fraction of
+    blocks for which per-event debug logs are emitted.
+    """
+    global _sample_rate
+    _sample_rate = sample_rate
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(
+            logging.getLevelName(level.upper())
+        ),
+        processors=[
+            structlog.contextvars.merge_contextvars,
+            _drop_unsampled,
+            _expand_tuples,
+            structlog.processors.add_log_level,
+            structlog.processors.StackInfoRenderer(),
+            structlog.dev.set_exc_info,
+            structlog.processors.TimeStamper(fmt="%Y-%m-%d %H:%M:%S", utc=False),
+            structlog.dev.ConsoleRenderer(),
+        ],
+        cache_logger_on_first_use=True,
+    )
+
+    # print apibara logs
+    apibara_logger = logging.getLogger("apibara")
+    apibara_logger.setLevel(apibara_level.upper())
+    apibara_logger.addHandler(logging.StreamHandler())
+
+
+def sample_block():
+    """Decide whether the block about to be handled logs its details."""
+    global _detailed
+    _detailed = _sample_rate >= 1.0 or random.random() < _sample_rate
+
+
+def _drop_unsampled(logger, method_name, event_dict):
+    if method_name == "debug" and not _detailed:
+        raise structlog.DropEvent
+    return event_dict
+
+
+def _expand_tuples(logger, method_name, event_dict):
+    # decoded events are logged as tuples, only expanded if the line is printed
+    for key, value in list(event_dict.items()):
+        if isinstance(value, tuple) and hasattr(value, "_asdict"):
+            event_dict[key] = dict(value._asdict())
+    return event_dict
+
+
+class BlockSummary:
+    """Event counts and timings of a block, logged once the block is handled."""
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._events: Dict[str, int] = Counter()
+        self._handler_time: Dict[str, float] = defaultdict(float)
+
+    def record(self, event_name: str, elapsed: float):
+        self._events[event_name] += 1
+        self._handler_time[event_name] += elapsed
+
+    def log(self, block_number: int):
+        logger.info(
+            "block handled",
+            block_number=block_number,
+            events=dict(self._events),
+            handlers_ms={
+                name: round(elapsed * 1000, 1)
+                for name, elapsed in self._handler_time.items()
+            },
+            total_ms=round((time.perf_counter() - self._start) * 1000, 1),
+        )
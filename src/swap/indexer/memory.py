@@ -0,0 +1,338 @@
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from apibara.protocol.proto.stream_pb2 import Cursor
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+
+from swap.indexer.storage import (Document, DocumentFilter, _get, _project,
+                                  _sort_key, apply_update, matches_filter)
+
+_valid_to = "_chain.valid_to"
+# fields looked up by equality, by the handlers or in `create_indexes.py`
+_indexed_fields = (
+    "id",
+    "hash",
+    "number",
+    "address",
+    "token_id",
+    "token0_id",
+    "token1_id",
+    "pair_id",
+    "pair_address",
+    "pair",
+    "user",
+    "block",
+    "day_id",
+    "hour_id",
+    "transaction_hash",
+    "to",
+    "sender",
+)
+# index key of the values that are not indexed, candidates of any lookup
+_unindexed = object()
+
+
+class MemoryCollection:
+    """All the versions of the documents of a collection.
+
+    Current versions (`_chain.valid_to` null) are kept apart from older
+    ones, in insertion order, and indexed by the `_indexed_fields` they
+    have: lookups by equality (or `$in`) on one of them only match the
+    documents of its smallest index entry.
+    """
+
+    def __init__(self):
+        self._current: Dict[ObjectId, Document] = dict()
+        self._history: List[Document] = []
+        self._indexes: Dict[str, Dict[Any, Dict[ObjectId, None]]] = {
+            field: dict() for field in _indexed_fields
+        }
+
+    def find(self, filter: DocumentFilter) -> Iterator[Document]:
+        """Yields the documents matching `filter`, not copied."""
+        filter = dict(filter)
+        if _valid_to in filter and filter[_valid_to] is None:
+            del filter[_valid_to]
+            docs = self._candidates(filter)
+        else:
+            docs = [*self._history, *self._current.values()]
+        for doc in docs:
+            if matches_filter(doc, filter):
+                yield doc
+
+    def insert(self, doc: Document):
+        doc = _copy(doc)
+        doc.setdefault("_id", ObjectId())
+        if doc.get("_chain", {}).get("valid_to") is not None:
+            self._history.append(doc)
+            return
+        self._current[doc["_id"]] = doc
+        for field, index in self._indexes.items():
+            if field in doc:
+                index.setdefault(_index_key(doc[field]), dict())[doc["_id"]] = None
+
+    def close(self, doc: Document, block_number: int):
+        """Set `_chain.valid_to` of the current version `doc`."""
+        self._remove(doc)
+        doc["_chain"] = {**doc["_chain"], "valid_to": block_number}
+        self._history.append(doc)
+
+    def bulk_write(self, requests: Iterable[Any], ordered: bool = True, session=None):
+        """Apply the `InsertOne` and `UpdateOne` requests sent by
+        `BlockStorage.write`."""
+        for request in requests:
+            # pymongo keeps the arguments of the requests in private fields
+            if isinstance(request, InsertOne):
+                self.insert(request._doc)
+            elif isinstance(request, UpdateOne):
+                doc = next(self.find(request._filter), None)
+                if doc is None:
+                    continue
+                block_number = request._doc.get("$set", {}).get(_valid_to)
+                if block_number is not None and len(request._doc) == 1:
+                    self.close(doc, block_number)
+                else:
+                    self._replace(doc, request._doc)
+            else:
+                raise ValueError(f"unsupported bulk write request {request}")
+
+    def rollback(self, block_number: int):
+        """Drop the versions created after `block_number`, restore the
+        versions closed after it."""
+        docs = [*self._history, *self._current.values()]
+        self._current.clear()
+        self._history.clear()
+        for index in self._indexes.values():
+            index.clear()
+        for doc in docs:
+            chain = doc["_chain"]
+            if chain["valid_from"] > block_number:
+                continue
+            if chain["valid_to"] is not None and chain["valid_to"] > block_number:
+                doc["_chain"] = {**chain, "valid_to": None}
+            self.insert(doc)
+
+    def count(self) -> int:
+        return len(self._current) + len(self._history)
+
+    def _replace(self, doc: Document, update: Dict[str, Any]):
+        new_version = dict(doc)
+        apply_update(new_version, update)
+        self._remove(doc)
+        self.insert(new_version)
+
+    def _remove(self, doc: Document):
+        del self._current[doc["_id"]]
+        for field, index in self._indexes.items():
+            if field in doc:
+                entry = index.get(_index_key(doc[field]))
+                if entry is not None:
+                    entry.pop(doc["_id"], None)
+
+    def _candidates(self, filter: DocumentFilter) -> Iterable[Document]:
+        ids = self._indexed_ids(filter)
+        if ids is None:
+            return list(self._current.values())
+        return [self._current[id] for id in ids if id in self._current]
+
+    def _indexed_ids(self, filter: DocumentFilter) -> Optional[Iterable[ObjectId]]:
+        """Returns the ids of a superset of the current documents matching
+        `filter`, the smallest found in the indexes, or None if no index
+        applies."""
+        if isinstance(filter.get("_id"), ObjectId):
+            return [filter["_id"]]
+        best: Optional[Dict[ObjectId, None]] = None
+        for field, index in self._indexes.items():
+            values = _indexed_values(filter.get(field))
+            if values is None:
+                continue
+            ids: Dict[ObjectId, None] = dict(index.get(_unindexed, ()))
+            for value in values:
+                ids.update(index.get(value, ()))
+            if best is None or len(ids) < len(best):
+                best = ids
+        for branch in filter.get("$and", ()):
+            ids = self._indexed_ids(branch)
+            if ids is not None and (best is None or len(ids) < len(best)):
+                best = dict.fromkeys(ids)
+        if "$or" in filter:
+            ids = dict()
+            for branch in filter["$or"]:
+                branch_ids = self._indexed_ids(branch)
+                if branch_ids is None:
+                    return best
+                ids.update(dict.fromkeys(branch_ids))
+            if best is None or len(ids) < len(best):
+                best = ids
+        return best
+
+
+class MemoryDatabase:
+    """The collections of an in-memory storage, like a pymongo `Database`."""
+
+    def __init__(self):
+        self.collections: Dict[str, MemoryCollection] = dict()
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        return self.get_collection(name)
+
+    def get_collection(self, name: str, write_concern=None) -> MemoryCollection:
+        collection = self.collections.get(name)
+        if collection is None:
+            collection = self.collections[name] = MemoryCollection()
+        return collection
+
+    def list_collection_names(self) -> List[str]:
+        return list(self.collections.keys())
+
+
+class MemoryStorage:
+    """Chain-aware storage kept in memory.
+
+    Same interface and `_chain` versioning as apibara's `Storage`, without
+    MongoDB: handlers (and `BlockStorage`) run unchanged on top of it, which
+    isolates their CPU cost from the database in benchmarks.
+    """
+
+    def __init__(self, db: MemoryDatabase, cursor: Cursor, session=None):
+        self._db = db
+        self._cursor = cursor
+        self._session = session
+
+    async def find_one(self, collection: str, filter: DocumentFilter) -> Optional[Document]:
+        """Find the first document in `collection` matching `filter`."""
+        filter[_valid_to] = None
+        doc = next(self._db[collection].find(filter), None)
+        return _copy(doc) if doc is not None else None
+
+    async def find(
+        self,
+        collection: str,
+        filter: DocumentFilter,
+        sort: Optional[Dict[str, int]] = None,
+        projection: Optional[Dict[str, Any]] = None,
+        skip: int = 0,
+        limit: int = 0,
+    ) -> List[Document]:
+        """Find all documents in `collection` matching `filter`."""
+        filter[_valid_to] = None
+        docs = [_copy(doc) for doc in self._db[collection].find(filter)]
+        if sort is not None:
+            for field, order in reversed(list(sort.items())):
+                docs.sort(key=lambda doc: _sort_key(_get(doc, field)), reverse=order < 0)
+        if skip:
+            docs = docs[skip:]
+        if limit:
+            docs = docs[:limit]
+        if projection is not None:
+            docs = [_project(doc, projection) for doc in docs]
+        return docs
+
+    async def insert_one(self, collection: str, doc: Document):
+        """Insert `doc` into `collection`."""
+        doc["_chain"] = {"valid_from": self._cursor.order_key, "valid_to": None}
+        doc.setdefault("_id", ObjectId())
+        self._db[collection].insert(doc)
+
+    async def insert_many(self, collection: str, docs: Iterable[Document]):
+        """Insert multiple `docs` into `collection`."""
+        for doc in docs:
+            await self.insert_one(collection, doc)
+
+    async def delete_one(self, collection: str, filter: DocumentFilter):
+        """Delete the first document in `collection` matching `filter`."""
+        filter[_valid_to] = None
+        doc = next(self._db[collection].find(filter), None)
+        if doc is not None:
+            self._db[collection].close(doc, self._cursor.order_key)
+
+    async def delete_many(self, collection: str, filter: DocumentFilter):
+        """Delete all documents in `collection` matching `filter`."""
+        filter[_valid_to] = None
+        for doc in list(self._db[collection].find(filter)):
+            self._db[collection].close(doc, self._cursor.order_key)
+
+    async def find_one_and_replace(
+        self,
+        collection: str,
+        filter: DocumentFilter,
+        replacement: Document,
+        upsert: bool = False,
+    ):
+        """Replace the first document in `collection` matching `filter` with
+        `replacement`, or insert it if `upsert`."""
+        filter[_valid_to] = None
+        existing = next(self._db[collection].find(filter), None)
+        if existing is not None:
+            self._db[collection].close(existing, self._cursor.order_key)
+        if existing is not None or upsert:
+            await self.insert_one(collection, replacement)
+        return _copy(existing) if existing is not None else None
+
+    async def find_one_and_update(self, collection: str, filter: DocumentFilter, update: Dict[str, Any]):
+        """Update the first document in `collection` matching `filter` with `update`."""
+        filter[_valid_to] = None
+        existing = next(self._db[collection].find(filter), None)
+        if existing is None:
+            return None
+        self._db[collection].close(existing, self._cursor.order_key)
+        new_version = {k: v for k, v in existing.items() if k not in ("_id", "_chain")}
+        apply_update(new_version, update)
+        await self.insert_one(collection, new_version)
+        return _copy(existing)
+
+
+class MemoryIndexerStorage:
+    """In-memory counterpart of apibara's `IndexerStorage`, for replays and
+    benchmarks."""
+
+    def __init__(self):
+        self.db = MemoryDatabase()
+        self.cursor: Optional[Cursor] = None
+
+    @contextmanager
+    def create_storage_for_data(self, cursor: Cursor) -> Iterator[MemoryStorage]:
+        yield MemoryStorage(self.db, cursor=cursor)
+        self._update_cursor(cursor)
+
+    def invalidate(self, cursor: Cursor, session=None):
+        for collection in self.db.collections.values():
+            collection.rollback(cursor.order_key)
+
+    def drop_database(self):
+        self.db = MemoryDatabase()
+
+    def _update_cursor(self, cursor: Cursor, session=None):
+        self.cursor = cursor
+
+
+def _indexable(value) -> bool:
+    # ids and keys are hex strings or numbers, other values may match values
+    # of another type (e.g. Decimal128 and int)
+    return isinstance(value, (str, int)) and not isinstance(value, bool)
+
+
+def _index_key(value):
+    return value if _indexable(value) else _unindexed
+
+
+def _indexed_values(condition) -> Optional[List[Any]]:
+    """Returns the values matched by `condition` on an indexed field, None
+    if the indexes cannot be used."""
+    if _indexable(condition):
+        return [condition]
+    if isinstance(condition, dict) and list(condition) == ["$in"]:
+        values = list(condition["$in"])
+        if all(_indexable(value) for value in values):
+            return values
+    return None
+
+
+def _copy(value):
+    # documents hold immutable values, embedded documents and lists
+    if isinstance(value, dict):
+        return {k: _copy(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy(v) for v in value]
+    return value
@@ -0,0 +1,42 @@
+from typing import Optional
+
+from pymongo.collection import Collection
+from structlog import get_logger
+
+from swap.indexer.cache import LRUCache
+
+logger = get_logger(__name__)
+
+
+class TokenMetadataCache:
+    """Token name, symbol, decimals and total supply, by token address.
+
+    Lookups go through an in-process LRU backed by a MongoDB collection.
+    The collection lives outside of the indexer's database, so it is not
+    dropped by `--restart` and re-indexing never fetches a known token's
+    metadata from the RPC node again.
+    """
+
+    def __init__(self, collection: Optional[Collection] = None, maxsize: int = 4096):
+        self._collection = collection
+        self._lru = LRUCache(maxsize)
+
+    def get(self, address: int) -> Optional[dict]:
+        metadata = self._lru.get(address)
+        if metadata is not None or self._collection is None:
+            return metadata
+        metadata = self._collection.find_one({"_id": hex(address)})
+        if metadata is None:
+            return None
+        del metadata["_id"]
+        self._lru.put(address, metadata)
+        return metadata
+
+    def put(self, address: int, metadata: dict):
+        self._lru.put(address, metadata)
+        if self._collection is None:
+            return
+        self._collection.replace_one(
+            {"_id": hex(address)}, dict(metadata, _id=hex(address)), upsert=True
+        )
+        logger.debug("stored token metadata", address=hex(address))
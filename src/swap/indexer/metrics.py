@@ -0,0 +1,237 @@
+import bisect
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+from structlog import get_logger
+
+logger = get_logger(__name__)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# seconds
+_latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# operations per block
+_count_buckets = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class Metric:
+    """A metric family in the Prometheus text format."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self._values: Dict[Labels, float] = defaultdict(float)
+
+    def inc(self, value: float = 1, **labels: str):
+        self._values[_labels(labels)] += value
+
+    def set_total(self, value: float, **labels: str):
+        """Mirror a total counted elsewhere, e.g. by the rpc pool."""
+        self._values[_labels(labels)] = value
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(labels)} {_format_value(value)}"
+            for labels, value in self._values.items()
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str):
+        self._values[_labels(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float]):
+        super().__init__(name, help)
+        self._buckets = list(buckets)
+        # per labels: count of each bucket (not cumulative), sum and count
+        self._values: Dict[Labels, Tuple[List[int], List[float]]] = dict()
+
+    def observe(self, value: float, **labels: str):
+        key = _labels(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = ([0] * (len(self._buckets) + 1), [0.0, 0])
+            self._values[key] = entry
+        counts, totals = entry
+        counts[bisect.bisect_left(self._buckets, value)] += 1
+        totals[0] += value
+        totals[1] += 1
+
+    def sum(self, **labels: str) -> float:
+        entry = self._values.get(_labels(labels))
+        return entry[1][0] if entry is not None else 0.0
+
+    def count(self, **labels: str) -> int:
+        entry = self._values.get(_labels(labels))
+        return entry[1][1] if entry is not None else 0
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for labels, (counts, (total, count)) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self._buckets + ["+Inf"], counts):
+                cumulative += bucket_count
+                bucket_labels = labels + (("le", _format_value(bound)),)
+                lines.append(f"{self.name}_bucket{_format_labels(bucket_labels)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class IndexerMetrics:
+    """Throughput and latency metrics of the indexer.
+
+    Updated by `handle_data` and served in the Prometheus text format by
+    `serve`, e.g. `rate(swap_indexer_blocks_total[1m])` for blocks/s.
+    """
+
+    def __init__(self, head_refresh_interval: float = 30.0):
+        self.blocks = Counter("swap_indexer_blocks_total", "Blocks handled.")
+        self.events = Counter("swap_indexer_events_total", "Events handled, by event.")
+        self.block_number = Gauge("swap_indexer_block_number", "Last block handled.")
+        self.chain_head = Gauge("swap_indexer_chain_head", "Chain head according to the rpc node.")
+        self.head_lag = Gauge("swap_indexer_head_lag_blocks", "Blocks between the last block handled and the chain head.")
+        self.mongo_reads = Histogram(
+            "swap_indexer_mongo_reads_per_block", "MongoDB queries per block.", _count_buckets
+        )
+        self.mongo_writes = Histogram(
+            "swap_indexer_mongo_writes_per_block", "MongoDB write operations per block.", _count_buckets
+        )
+        self.rpc_requests = Histogram(
+            "swap_indexer_rpc_requests_per_block", "RPC requests (batches count once) per block.", _count_buckets
+        )
+        self.stage_seconds = Histogram(
+            "swap_indexer_stage_seconds", "Latency of the stages of a block (handle_block, handle_events, flush, write).", _latency_buckets
+        )
+        self.handler_seconds = Histogram(
+            "swap_indexer_event_handler_seconds", "Latency of the handle_* function of each event.", _latency_buckets
+        )
+        self.rpc_calls = Counter("swap_indexer_rpc_calls_total", "Requests sent to each rpc node.")
+        self.rpc_errors = Counter("swap_indexer_rpc_errors_total", "Failed requests of each rpc node.")
+        self.rpc_hedges = Counter("swap_indexer_rpc_hedges_total", "Hedged requests sent to each rpc node.")
+        self.rpc_in_flight = Gauge("swap_indexer_rpc_in_flight", "Requests in flight on each rpc node.")
+        self.rpc_latency = Gauge(
+            "swap_indexer_rpc_latency_seconds", "Latency quantiles of each rpc node, over its recent requests."
+        )
+        self._head_refresh_interval = head_refresh_interval
+        self._head: Optional[int] = None
+        self._head_refreshed_at: Optional[float] = None
+        self._rpc = None
+
+    def observe_event(self, event_name: str, elapsed: float):
+        self.events.inc(event=event_name)
+        self.handler_seconds.observe(elapsed, event=event_name)
+
+    def observe_stage(self, stage: str, elapsed: float):
+        self.stage_seconds.observe(elapsed, stage=stage)
+
+    def observe_block(self, block_number: int, mongo_reads: int, mongo_writes: int, rpc_requests: int):
+        self.blocks.inc()
+        self.block_number.set(block_number)
+        self.mongo_reads.observe(mongo_reads)
+        self.mongo_writes.observe(mongo_writes)
+        self.rpc_requests.observe(rpc_requests)
+        if self._head is not None:
+            self.head_lag.set(max(self._head - block_number, 0))
+
+    async def update_head(self, rpc):
+        """Refresh the chain head, at most every `head_refresh_interval` seconds."""
+        self._rpc = rpc
+        now = time.monotonic()
+        if self._head_refreshed_at is not None and now - self._head_refreshed_at < self._head_refresh_interval:
+            return
+        # also on failure: while the node is down, do not retry on every block
+        self._head_refreshed_at = now
+        try:
+            self._head = await rpc.get_block_number()
+        except Exception as e:
+            logger.warn("could not fetch chain head", error=str(e))
+            return
+        self.chain_head.set(self._head)
+
+    def render(self) -> str:
+        if self._rpc is not None:
+            for endpoint in self._rpc.metrics():
+                name = str(endpoint["endpoint"])
+                self.rpc_calls.set_total(endpoint["calls"], endpoint=name)
+                self.rpc_errors.set_total(endpoint["errors"], endpoint=name)
+                self.rpc_hedges.set_total(endpoint["hedges"], endpoint=name)
+                self.rpc_in_flight.set(endpoint["in_flight"], endpoint=name)
+                for quantile, field in (("0.5", "p50"), ("0.95", "p95")):
+                    if endpoint[field] is not None:
+                        self.rpc_latency.set(endpoint[field], endpoint=name, quantile=quantile)
+        metrics = [
+            self.blocks,
+            self.events,
+            self.block_number,
+            self.chain_head,
+            self.head_lag,
+            self.mongo_reads,
+            self.mongo_writes,
+            self.rpc_requests,
+            self.stage_seconds,
+            self.handler_seconds,
+            self.rpc_calls,
+            self.rpc_errors,
+            self.rpc_hedges,
+            self.rpc_in_flight,
+            self.rpc_latency,
+        ]
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+    async def serve(self, port: int, host: str = "0.0.0.0") -> web.AppRunner:
+        """Serve the metrics on `http://host:port/metrics`."""
+
+        async def handle_metrics(request):
+            return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle_metrics)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info("serving metrics", port=port)
+        return runner
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def _format_value(value) -> str:
+    if isinstance(value, str):
+        return value
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
@@ -0,0 +1,41 @@
+from typing import Dict, List, Tuple
+
+from apibara.indexer import Info
+from structlog import get_logger
+
+logger = get_logger(__name__)
+
+
+class MintBurnBuffer:
+    """Logical mints and burns of the transactions of a block.
+
+    A mint or a burn is spread over several events of a transaction: the LP
+    token transfers, then the pair's `Mint` or `Burn`. Fee mints are folded
+    into the burn they belong to. The documents are assembled in memory,
+    by `(pair_id, transaction_hash)`, and only their final version is
+    inserted when the block is flushed.
+    """
+
+    def __init__(self):
+        self._mints: Dict[Tuple[str, str], List[dict]] = dict()
+        self._burns: Dict[Tuple[str, str], List[dict]] = dict()
+
+    def mints(self, pair_id: str, transaction_hash: str) -> List[dict]:
+        """Returns the mints of the transaction on the pair, in order."""
+        return self._mints.setdefault((pair_id, transaction_hash), [])
+
+    def burns(self, pair_id: str, transaction_hash: str) -> List[dict]:
+        """Returns the burns of the transaction on the pair, in order."""
+        return self._burns.setdefault((pair_id, transaction_hash), [])
+
+    async def flush(self, info: Info):
+        mints = [mint for mints in self._mints.values() for mint in mints]
+        burns = [burn for burns in self._burns.values() for burn in burns]
+        await info.storage.insert_many("mints", mints)
+        await info.storage.insert_many("burns", burns)
+        logger.debug("flushed mints and burns", mints=len(mints), burns=len(burns))
+        self.clear()
+
+    def clear(self):
+        self._mints.clear()
+        self._burns.clear()
@@ -0,0 +1,100 @@
+from decimal import Decimal
+from typing import Dict, Optional, Tuple
+
+from apibara.indexer import Info
+from structlog import get_logger
+
+from swap.indexer.jediswap import _eth, _eth_usdc_address, _stablecoins
+
+logger = get_logger(__name__)
+
+eth_price_sources = ["usdc", "median", "weighted"]
+
+
+class EthPriceOracle:
+    """In-memory ETH price in USD.
+
+    The price is seeded from the stored pairs and then updated by
+    `handle_sync` every time one of the source pairs syncs, so it always
+    matches the reserves of the pairs. Sources are:
+
+     - `usdc`: the price in the ETH/USDC pair,
+     - `median`: the median price across the ETH/stablecoin pairs,
+     - `weighted`: the average price across the ETH/stablecoin pairs,
+       weighted by their ETH reserve.
+    """
+
+    def __init__(self, source: str = "usdc"):
+        if source not in eth_price_sources:
+            raise ValueError(f"unknown eth price source {source}")
+        self._source = source
+        # (eth price, eth reserve) by pair id
+        self._pairs: Dict[str, Tuple[Decimal, Decimal]] = dict()
+        self._block_number: Optional[int] = None
+        self.price = Decimal("0")
+
+    def needs_seed(self, block_number: int) -> bool:
+        """Returns true if the price must be seeded again from storage before
+        handling `block_number`, e.g. because the block is being handled again
+        after a failure, a filter update or a chain reorganization."""
+        return self._block_number is None or block_number <= self._block_number
+
+    async def seed(self, info: Info):
+        self._pairs.clear()
+        if self._source == "usdc":
+            query = {"id": _eth_usdc_address}
+        else:
+            stablecoins = [hex(token) for token in _stablecoins]
+            query = {
+                "$or": [
+                    {"token0_id": hex(_eth), "token1_id": {"$in": stablecoins}},
+                    {"token0_id": {"$in": stablecoins}, "token1_id": hex(_eth)},
+                ]
+            }
+        for pair in await info.storage.find("pairs", query):
+            self.update(pair)
+        self._block_number = info.context.block_number
+        logger.debug(
+            "seeded eth price", source=self._source, pairs=len(self._pairs), price=self.price
+        )
+
+    def advance(self, block_number: int):
+        self._block_number = block_number
+
+    def reset(self):
+        self._pairs.clear()
+        self._block_number = None
+        self.price = Decimal("0")
+
+    def is_source(self, pair: dict) -> bool:
+        if self._source == "usdc":
+            return pair["id"] == _eth_usdc_address
+        tokens = {pair["token0_id"], pair["token1_id"]}
+        return hex(_eth) in tokens and any(hex(t) in tokens for t in _stablecoins)
+
+    def update(self, pair: dict):
+        """Update the price with the current reserves of `pair`."""
+        if pair["token0_id"] == hex(_eth):
+            eth_price = pair["token1_price"].to_decimal()
+            eth_reserve = pair["reserve0"].to_decimal()
+        else:
+            eth_price = pair["token0_price"].to_decimal()
+            eth_reserve = pair["reserve1"].to_decimal()
+        self._pairs[pair["id"]] = (eth_price, eth_reserve)
+        self.price = self._aggregate()
+
+    def _aggregate(self) -> Decimal:
+        # pairs without liquidity have no price
+        prices = [(p, r) for p, r in self._pairs.values() if p != Decimal("0")]
+        if not prices:
+            return Decimal("0")
+        if self._source == "weighted":
+            total_reserve = sum(r for _, r in prices)
+            if total_reserve == Decimal("0"):
+                return Decimal("0")
+            return sum(p * r for p, r in prices) / total_reserve
+        prices = sorted(p for p, _ in prices)
+        middle = len(prices) // 2
+        if len(prices) % 2 == 1:
+            return prices[middle]
+        return (prices[middle - 1] + prices[middle]) / Decimal("2")
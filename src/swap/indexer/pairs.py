@@ -0,0 +1,44 @@
+from typing import Optional, Set
+
+from apibara.indexer import Info
+from structlog import get_logger
+
+logger = get_logger(__name__)
+
+
+class PairAddresses:
+    """In-memory set of the addresses of the indexed pairs.
+
+    With `--compact-filter` the stream sends the pool events of every
+    contract, the indexer keeps the events emitted by these addresses.
+    """
+
+    def __init__(self):
+        self._addresses: Set[int] = set()
+        self._block_number: Optional[int] = None
+
+    def needs_seed(self, block_number: int) -> bool:
+        """Returns true if the set must be seeded again from storage before
+        handling `block_number`."""
+        return self._block_number is None or block_number <= self._block_number
+
+    async def seed(self, info: Info):
+        self.reset()
+        pairs = await info.storage.find("pairs", {}, projection={"id": 1})
+        for pair in pairs:
+            self.add(int(pair["id"], 16))
+        self._block_number = info.context.block_number
+        logger.debug("seeded pair addresses", pairs=len(self._addresses))
+
+    def advance(self, block_number: int):
+        self._block_number = block_number
+
+    def reset(self):
+        self._addresses.clear()
+        self._block_number = None
+
+    def add(self, address: int):
+        self._addresses.add(address)
+
+    def __contains__(self, address: int) -> bool:
+        return address in self._addresses
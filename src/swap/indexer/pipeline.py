@@ -0,0 +1,113 @@
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import List, Optional
+
+from apibara.indexer import IndexerRunner
+from apibara.indexer.storage import IndexerStorage, Storage
+from apibara.protocol.proto.stream_pb2 import Cursor
+from pymongo.client_session import ClientSession
+from structlog import get_logger
+
+from swap.indexer.storage import BlockStorage
+
+logger = get_logger(__name__)
+
+
+class PersistencePipeline:
+    """Persist blocks in the background while the next blocks are handled.
+
+    Blocks are written in order by a single thread, and the cursor of a
+    block is stored once its writes are committed. At most `depth` blocks
+    are in flight: handling a block waits for a slot. The storages of the
+    blocks in flight are the parents of the next `BlockStorage`, so that
+    reads see their writes before they are committed.
+    """
+
+    def __init__(self, depth: int = 2):
+        self.in_flight: List[BlockStorage] = []
+        self._depth = depth
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persist")
+        self._indexer_storage: Optional[IndexerStorage] = None
+        self._error: Optional[BaseException] = None
+
+    def attach(self, indexer_storage: IndexerStorage):
+        self._indexer_storage = indexer_storage
+
+    async def submit(self, storage: BlockStorage, cursor: Cursor):
+        """Write `storage` and acknowledge `cursor` in the background."""
+        if self._error is not None:
+            # blocks after a failed one must not be written
+            raise RuntimeError("persisting a previous block failed") from self._error
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._depth)
+        await storage.resolve()
+        await self._slots.acquire()
+        self.in_flight.append(storage)
+        loop = asyncio.get_running_loop()
+        future = self._executor.submit(self._persist, storage, cursor)
+        future.add_done_callback(
+            lambda future: loop.call_soon_threadsafe(self._done, storage, future)
+        )
+
+    def drain(self):
+        """Block until all the blocks in flight are persisted.
+
+        Blocks that could not be written are dropped: the indexer restarts
+        from the last acknowledged cursor.
+        """
+        self._executor.submit(lambda: None).result()
+        self.in_flight.clear()
+        if self._error is not None:
+            logger.warn("dropped blocks in flight after error", error=str(self._error))
+            self._error = None
+
+    def _persist(self, storage: BlockStorage, cursor: Cursor):
+        if self._error is not None:
+            return
+        try:
+            storage.write()
+            self._indexer_storage._update_cursor(cursor)
+        except BaseException as e:
+            logger.error("could not persist block", cursor=cursor.order_key, error=str(e))
+            self._error = e
+
+    def _done(self, storage: BlockStorage, future: Future):
+        if storage in self.in_flight:
+            self.in_flight.remove(storage)
+        self._slots.release()
+
+
+class PipelinedIndexerStorage(IndexerStorage):
+    """Indexer storage that leaves acknowledging the cursor of a block to the
+    persistence pipeline."""
+
+    def __init__(self, url: Optional[str], indexer_id: str, pipeline: PersistencePipeline):
+        super().__init__(url, indexer_id)
+        self._pipeline = pipeline
+        pipeline.attach(self)
+
+    @contextmanager
+    def create_storage_for_data(self, cursor: Cursor):
+        with self._mongo.start_session() as session:
+            yield Storage(self.db, session=session, cursor=cursor)
+
+    def invalidate(self, cursor: Cursor, session: Optional[ClientSession] = None):
+        # the blocks in flight must be written before they are rolled back
+        self._pipeline.drain()
+        super().invalidate(cursor, session=session)
+
+
+class PipelinedIndexerRunner(IndexerRunner):
+    """Indexer runner that persists blocks through `pipeline`."""
+
+    def __init__(self, *, pipeline: PersistencePipeline, **kwargs):
+        super().__init__(**kwargs)
+        self._pipeline = pipeline
+
+    def _setup_storage(self, indexer):
+        self._indexer_id = indexer.indexer_id()
+        self._indexer_storage = PipelinedIndexerStorage(
+            self._config.storage_url, self._indexer_id, self._pipeline
+        )
@@ -0,0 +1,184 @@
+import json
+import os
+import time
+from collections import defaultdict
+from typing import Any, Dict, Optional
+
+from structlog import get_logger
+
+from swap.indexer.storage import BlockStorage
+
+logger = get_logger(__name__)
+
+# operations outside of any stage or handler
+_block = "block"
+
+
+class _Timings:
+    """Count and total time of an operation."""
+
+    __slots__ = ("count", "elapsed")
+
+    def __init__(self):
+        self.count = 0
+        self.elapsed = 0.0
+
+    def add(self, elapsed: float):
+        self.count += 1
+        self.elapsed += elapsed
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"count": self.count, "ms": round(self.elapsed * 1000, 3)}
+
+
+class BlockProfiler:
+    """Storage operations and contract calls of a block, by handler.
+
+    Every operation of `info.storage` (through `ProfiledStorage`) and every
+    `simple_call` is counted and timed, and attributed to the stage or
+    event handler running at the time. Blocks slower than `threshold_ms`
+    are written to `report_dir` as `block-<number>.json`.
+    """
+
+    def __init__(self, threshold_ms: float, report_dir: str):
+        self._threshold_ms = threshold_ms
+        self._report_dir = report_dir
+        self._block_number: Optional[int] = None
+        self._start = 0.0
+        self._current = _block
+        self._stages: Dict[str, float] = {}
+        self._handlers: Dict[str, _Timings] = defaultdict(_Timings)
+        # handler -> "collection.operation" or method -> timings
+        self._storage: Dict[str, Dict[str, _Timings]] = defaultdict(lambda: defaultdict(_Timings))
+        self._calls: Dict[str, Dict[str, _Timings]] = defaultdict(lambda: defaultdict(_Timings))
+        self._cached_calls: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+    def start(self, block_number: int):
+        self._block_number = block_number
+        self._start = time.perf_counter()
+        self._current = _block
+        self._stages.clear()
+        self._handlers.clear()
+        self._storage.clear()
+        self._calls.clear()
+        self._cached_calls.clear()
+
+    def enter(self, name: str):
+        """Attribute the next operations to the stage or handler `name`."""
+        self._current = name
+
+    def record_stage(self, name: str, elapsed: float):
+        self._stages[name] = self._stages.get(name, 0.0) + elapsed
+        self._current = _block
+
+    def record_handler(self, name: str, elapsed: float):
+        self._handlers[name].add(elapsed)
+
+    def record_storage(self, collection: str, operation: str, elapsed: float):
+        self._storage[self._current][f"{collection}.{operation}"].add(elapsed)
+
+    def record_call(self, method: str, elapsed: float, cached: bool = False):
+        if cached:
+            self._cached_calls[self._current][method] += 1
+        else:
+            self._calls[self._current][method].add(elapsed)
+
+    def finish(self):
+        """Write the report of the block if it is slower than the threshold."""
+        elapsed_ms = (time.perf_counter() - self._start) * 1000
+        if elapsed_ms < self._threshold_ms:
+            return
+        report = self.report(elapsed_ms)
+        os.makedirs(self._report_dir, exist_ok=True)
+        path = os.path.join(self._report_dir, f"block-{self._block_number}.json")
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        slowest = max(report["handlers"].items(), key=lambda item: item[1]["ms"], default=(None, None))[0]
+        logger.warn(
+            "slow block",
+            block_number=self._block_number,
+            total_ms=round(elapsed_ms, 1),
+            slowest_handler=slowest,
+            report=path,
+        )
+
+    def report(self, elapsed_ms: float) -> Dict[str, Any]:
+        totals = defaultdict(_Timings)
+        for operations in self._storage.values():
+            for name, timings in operations.items():
+                totals[name].count += timings.count
+                totals[name].elapsed += timings.elapsed
+        call_totals = defaultdict(_Timings)
+        for methods in self._calls.values():
+            for name, timings in methods.items():
+                call_totals[name].count += timings.count
+                call_totals[name].elapsed += timings.elapsed
+        return {
+            "block_number": self._block_number,
+            "total_ms": round(elapsed_ms, 3),
+            "stages_ms": {name: round(elapsed * 1000, 3) for name, elapsed in self._stages.items()},
+            "handlers": {name: timings.to_dict() for name, timings in self._handlers.items()},
+            "storage": {name: timings.to_dict() for name, timings in totals.items()},
+            "calls": {name: timings.to_dict() for name, timings in call_totals.items()},
+            # the same, by stage or handler
+            "by_handler": {
+                name: {
+                    "storage": {op: t.to_dict() for op, t in self._storage.get(name, {}).items()},
+                    "calls": {method: t.to_dict() for method, t in self._calls.get(name, {}).items()},
+                    "cached_calls": dict(self._cached_calls.get(name, {})),
+                }
+                for name in {*self._storage, *self._calls, *self._cached_calls}
+            },
+        }
+
+
+class ProfiledStorage:
+    """Times the operations of a `BlockStorage` with `profiler`."""
+
+    def __init__(self, storage: BlockStorage, profiler: BlockProfiler):
+        self._storage = storage
+        self._profiler = profiler
+
+    def __getattr__(self, name: str):
+        # flush, replace_version and friends are not profiled
+        return getattr(self._storage, name)
+
+    async def _timed(self, operation: str, collection: str, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await getattr(self._storage, operation)(collection, *args, **kwargs)
+        finally:
+            self._profiler.record_storage(collection, operation, time.perf_counter() - start)
+
+    async def insert_one(self, collection, *args, **kwargs):
+        return await self._timed("insert_one", collection, *args, **kwargs)
+
+    async def insert_many(self, collection, *args, **kwargs):
+        return await self._timed("insert_many", collection, *args, **kwargs)
+
+    async def delete_one(self, collection, *args, **kwargs):
+        return await self._timed("delete_one", collection, *args, **kwargs)
+
+    async def delete_many(self, collection, *args, **kwargs):
+        return await self._timed("delete_many", collection, *args, **kwargs)
+
+    async def find_one(self, collection, *args, **kwargs):
+        return await self._timed("find_one", collection, *args, **kwargs)
+
+    async def find(self, collection, *args, **kwargs):
+        return await self._timed("find", collection, *args, **kwargs)
+
+    async def find_one_and_replace(self, collection, *args, **kwargs):
+        return await self._timed("find_one_and_replace", collection, *args, **kwargs)
+
+    async def find_one_and_update(self, collection, *args, **kwargs):
+        return await self._timed("find_one_and_update", collection, *args, **kwargs)
+
+    async def update_one(self, collection, *args, **kwargs):
+        return await self._timed("update_one", collection, *args, **kwargs)
+
+
+def handler_name(handler) -> str:
+    """Returns the name of an event handler, e.g. `handle_swap`."""
+    # handle_pair_created is bound to the indexer with `partial`
+    return getattr(handler, "__name__", None) or handler.func.__name__
@@ -0,0 +1,147 @@
+import gzip
+import os
+import struct
+import time
+from typing import BinaryIO, Dict, Iterator, Optional
+
+from apibara.indexer import Info
+from apibara.indexer.storage import IndexerStorage
+from apibara.protocol.proto.stream_pb2 import Cursor
+from apibara.starknet import felt
+from apibara.starknet.proto.starknet_pb2 import Block
+from structlog import get_logger
+
+logger = get_logger(__name__)
+
+_magic = b"JSBLOCKS1\n"
+_length = struct.Struct(">I")
+# blocks written between flushes, at most lost if the indexer is killed
+_flush_every = 100
+# replayed blocks whose hash is kept, to tell a block recorded again from a reorg
+_replayed_window = 1000
+
+
+def _open(path: str, mode: str) -> BinaryIO:
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+class BlockRecorder:
+    """Append the blocks received by `handle_data` to a file.
+
+    The file starts with a magic line, followed by one record per block:
+    the length of the serialized `Block` protobuf (4 bytes, big endian)
+    and its bytes. Paths ending with `.gz` are compressed.
+
+    Blocks are recorded as they are received: after a reconnect or a
+    restart, the blocks streamed again from the stored cursor are recorded
+    again. `replay_blocks` skips them.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = _open(path, "ab")
+        if new:
+            self._file.write(_magic)
+        self.blocks = 0
+
+    def write(self, block: Block):
+        raw = block.SerializeToString()
+        self._file.write(_length.pack(len(raw)))
+        self._file.write(raw)
+        self.blocks += 1
+        if self.blocks % _flush_every == 0:
+            # a gzip sync flush: the blocks written so far can be read back
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_blocks(
+    path: str, from_block: Optional[int] = None, to_block: Optional[int] = None
+) -> Iterator[Block]:
+    """Yields the blocks recorded in `path`, in order, from `from_block` to
+    `to_block` (inclusive).
+
+    Block numbers go backwards where the stream was resumed from an older
+    cursor, so the whole recording is read.
+    """
+    with _open(path, "rb") as f:
+        if f.read(len(_magic)) != _magic:
+            raise ValueError(f"{path} is not a block recording")
+        while True:
+            try:
+                header = f.read(_length.size)
+                if not header:
+                    return
+                if len(header) < _length.size:
+                    logger.warn("truncated block recording", path=path)
+                    return
+                (size,) = _length.unpack(header)
+                raw = f.read(size)
+            except EOFError:
+                # a compressed recording cut before the end of its stream
+                logger.warn("truncated block recording", path=path)
+                return
+            if len(raw) < size:
+                logger.warn("truncated block recording", path=path)
+                return
+            block = Block()
+            block.ParseFromString(raw)
+            number = block.header.block_number
+            if from_block is not None and number < from_block:
+                continue
+            if to_block is not None and number > to_block:
+                continue
+            yield block
+
+
+async def replay_blocks(indexer, ctx, indexer_storage: IndexerStorage, blocks: Iterator[Block]):
+    """Feed `blocks` to `indexer.handle_data`, as the runner would.
+
+    Filter updates are dropped: the recorded blocks already contain the
+    events of the pairs created while recording. Blocks already replayed
+    (recorded again after a reconnect) are skipped, a different block at a
+    replayed height invalidates the data from that height first, like a
+    reorg. Returns the number of blocks and events handled and the elapsed
+    time.
+    """
+    handled = 0
+    events = 0
+    # hashes of the last blocks replayed, by number
+    replayed: Dict[int, bytes] = dict()
+    last_number = None
+    start = time.perf_counter()
+    for block in blocks:
+        number = block.header.block_number
+        block_hash = felt.to_int(block.header.block_hash).to_bytes(32, "big")
+        if last_number is not None and number <= last_number:
+            if replayed.get(number, block_hash) == block_hash:
+                continue
+            cursor = Cursor(order_key=number - 1, unique_key=replayed.get(number - 1, b""))
+            logger.info("invalidating replayed blocks", from_block=number)
+            indexer_storage.invalidate(cursor)
+            with indexer_storage.create_storage_for_data(cursor) as storage:
+                await indexer.handle_invalidate(Info(context=ctx, storage=storage, cursor=cursor, end_cursor=cursor), cursor)
+            for stale in [n for n in replayed if n >= number]:
+                del replayed[stale]
+        replayed[number] = block_hash
+        last_number = number
+        if len(replayed) > _replayed_window:
+            del replayed[next(iter(replayed))]
+        end_cursor = Cursor(order_key=number, unique_key=block_hash)
+        with indexer_storage.create_storage_for_data(end_cursor) as storage:
+            info = Info(
+                context=ctx,
+                storage=storage,
+                cursor=Cursor(order_key=number - 1),
+                end_cursor=end_cursor,
+            )
+            await indexer.handle_data(info, block)
+            indexer._get_and_reset_filter()
+        handled += 1
+        events += len(block.events)
+    return handled, events, time.perf_counter() - start
@@ -0,0 +1,158 @@
+from collections import defaultdict, namedtuple
+from decimal import Decimal
+from typing import Dict, List, Optional
+
+from apibara.indexer import Info
+from structlog import get_logger
+
+from swap.indexer.jediswap import _whitelisted_ids
+
+logger = get_logger(__name__)
+
+# a pair between `token` and the `whitelisted` token that prices it
+Route = namedtuple("Route", ["pair_id", "whitelisted", "token_is_token0"])
+
+PairPrices = namedtuple(
+    "PairPrices", ["token0_id", "token0_price", "token1_price", "reserve_eth"]
+)
+
+
+class PricingRoutes:
+    """In-memory index of the pairs used to price tokens in ETH.
+
+    Maps every token to its pairs with a whitelisted token, in the order
+    `find_eth_per_token` tries them, and keeps the prices and ETH reserve of
+    those pairs plus the derived ETH price of the whitelisted tokens. Pairs
+    are added by `handle_pair_created` and refreshed by `handle_sync`, so
+    pricing a token never queries MongoDB.
+
+    With `max_hops > 1` the index keeps the graph of all pairs, used to
+    price tokens without a pair against a whitelisted token.
+    """
+
+    def __init__(self, max_hops: int = 1):
+        self.max_hops = max_hops
+        self._routes: Dict[str, List[Route]] = defaultdict(list)
+        # other token of each pair, by token and pair id
+        self._neighbours: Dict[str, Dict[str, str]] = defaultdict(dict)
+        self._pairs: Dict[str, PairPrices] = dict()
+        self._derived_eth: Dict[str, Decimal] = dict()
+        self._block_number: Optional[int] = None
+
+    def needs_seed(self, block_number: int) -> bool:
+        """Returns true if the index must be seeded again from storage before
+        handling `block_number`."""
+        return self._block_number is None or block_number <= self._block_number
+
+    async def seed(self, info: Info):
+        self.reset()
+        query = dict()
+        if self.max_hops == 1:
+            query = {
+                "$or": [
+                    {"token0_id": {"$in": _whitelisted_ids}},
+                    {"token1_id": {"$in": _whitelisted_ids}},
+                ]
+            }
+        pairs = await info.storage.find("pairs", query)
+        for pair in pairs:
+            self.add_pair(pair)
+        tokens = await info.storage.find("tokens", {"id": {"$in": _whitelisted_ids}})
+        for token in tokens:
+            self.set_derived_eth(token["id"], token["derived_eth"].to_decimal())
+        self._block_number = info.context.block_number
+        logger.debug("seeded pricing routes", pairs=len(self._pairs))
+
+    def advance(self, block_number: int):
+        self._block_number = block_number
+
+    def reset(self):
+        self._routes.clear()
+        self._neighbours.clear()
+        self._pairs.clear()
+        self._derived_eth.clear()
+        self._block_number = None
+
+    def add_pair(self, pair: dict):
+        token0, token1 = pair["token0_id"], pair["token1_id"]
+        if self.max_hops > 1:
+            self._neighbours[token0][pair["id"]] = token1
+            self._neighbours[token1][pair["id"]] = token0
+        for token, other, token_is_token0 in ((token0, token1, True), (token1, token0, False)):
+            if other not in _whitelisted_ids:
+                continue
+            routes = self._routes[token]
+            routes.append(Route(pair["id"], other, token_is_token0))
+            # same order as the lookups of `find_eth_per_token`: by whitelisted
+            # token, then with `token` as token0 first.
+            routes.sort(
+                key=lambda r: (_whitelisted_ids.index(r.whitelisted), not r.token_is_token0)
+            )
+        self.update_pair(pair)
+
+    def update_pair(self, pair: dict):
+        """Refresh the prices and ETH reserve of `pair`."""
+        if not self._is_indexed(pair):
+            return
+        self._pairs[pair["id"]] = PairPrices(
+            pair["token0_id"],
+            pair["token0_price"].to_decimal(),
+            pair["token1_price"].to_decimal(),
+            pair["reserve_eth"].to_decimal(),
+        )
+
+    def set_derived_eth(self, token: str, derived_eth: Decimal):
+        if token in _whitelisted_ids:
+            self._derived_eth[token] = derived_eth
+
+    def routes(self, token: str) -> List[Route]:
+        return self._routes.get(token, [])
+
+    def pair(self, pair_id: str) -> PairPrices:
+        return self._pairs[pair_id]
+
+    def derived_eth(self, token: str) -> Decimal:
+        return self._derived_eth.get(token, Decimal("0"))
+
+    def best_path_price(self, token: str, min_reserve_eth: Decimal) -> Optional[Decimal]:
+        """Returns the ETH price of `token` through pairs of other tokens.
+
+        Looks for paths of at most `max_hops` pairs, each with at least
+        `min_reserve_eth`, from `token` to a priced whitelisted token. The
+        best path is the one whose thinnest pair has the most ETH reserve,
+        then the shortest one. Returns `None` if there is no such path.
+        """
+        best = self._search(token, Decimal("1"), None, 0, {token}, min_reserve_eth, None)
+        if best is None:
+            return None
+        return best[2]
+
+    def _search(self, token, rate, bottleneck, hops, visited, min_reserve_eth, best):
+        # `best` is a tuple (thinnest reserve, -hops, price), compared in order
+        for pair_id, other in self._neighbours.get(token, {}).items():
+            pair = self._pairs[pair_id]
+            if other in visited or pair.reserve_eth < min_reserve_eth:
+                continue
+            path_bottleneck = pair.reserve_eth if bottleneck is None else min(bottleneck, pair.reserve_eth)
+            if best is not None and path_bottleneck < best[0]:
+                continue
+            # price of `token` in `other`, see `find_eth_per_token`
+            if pair.token0_id == token:
+                path_rate = rate * pair.token1_price
+            else:
+                path_rate = rate * pair.token0_price
+            if other in _whitelisted_ids:
+                derived_eth = self.derived_eth(other)
+                candidate = (path_bottleneck, -(hops + 1), path_rate * derived_eth)
+                if derived_eth > Decimal("0") and (best is None or candidate[:2] > best[:2]):
+                    best = candidate
+            elif hops + 1 < self.max_hops:
+                best = self._search(
+                    other, path_rate, path_bottleneck, hops + 1, visited | {other}, min_reserve_eth, best
+                )
+        return best
+
+    def _is_indexed(self, pair: dict) -> bool:
+        if self.max_hops > 1:
+            return True
+        return pair["token0_id"] in _whitelisted_ids or pair["token1_id"] in _whitelisted_ids
@@ -0,0 +1,356 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple, Union
+
+import aiohttp
+from starknet_py.net.client_errors import ClientError
+from starknet_py.net.client_models import Call
+from starknet_py.net.full_node_client import FullNodeClient, get_block_identifier
+from starknet_py.net.http_client import ServerError
+from starknet_py.net.models import StarknetChainId
+from structlog import get_logger
+
+logger = get_logger(__name__)
+
+
+class Endpoint:
+    """A node of the pool, with its circuit breaker state and latencies."""
+
+    def __init__(self, url: str, client: FullNodeClient, max_in_flight: int, window: int):
+        self.url = url
+        self.client = client
+        self.slots = asyncio.Semaphore(max_in_flight)
+        # latencies of the last successful calls, in seconds
+        self.latencies: deque = deque(maxlen=window)
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.hedges = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+
+    def available(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(int(q * len(latencies)), len(latencies) - 1)]
+
+
+class RpcPool:
+    """StarkNet RPC client over several nodes.
+
+    Exposes the methods of `FullNodeClient` used by the indexer. Calls go to
+    the available node with the fewest calls in flight, at most
+    `max_in_flight` per node, over a shared keep-alive session:
+
+     - a call slower than the `hedge_percentile` latency of its node is
+       sent to a second node as well, the first answer wins,
+     - a call failing because of the node (network, HTTP or server errors)
+       is retried on the next node. Errors returned by the StarkNet RPC
+       API (e.g. unknown entrypoint) are raised to the caller,
+     - a node failing `failure_threshold` calls in a row is ejected for
+       `cooldown` seconds, then tried again,
+     - contract calls made concurrently are sent as JSON-RPC batches of at
+       most `max_batch_size` calls, 1 to disable batching.
+    """
+
+    def __init__(
+        self,
+        urls: List[str],
+        max_in_flight: int = 16,
+        hedge_percentile: float = 0.95,
+        hedge_min_samples: int = 20,
+        failure_threshold: int = 5,
+        cooldown: float = 30.0,
+        window: int = 256,
+        metrics_interval: float = 60.0,
+        max_batch_size: int = 50,
+    ):
+        if not urls:
+            raise ValueError("at least one rpc url is required")
+        self._urls = urls
+        self._max_in_flight = max_in_flight
+        self._hedge_percentile = hedge_percentile
+        self._hedge_min_samples = hedge_min_samples
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        self._window = window
+        self._metrics_interval = metrics_interval
+        self._metrics_logged_at = time.monotonic()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._endpoints: List[Endpoint] = []
+        self._max_batch_size = max_batch_size
+        # calls waiting to be sent, with the future of their result
+        self._batch: List[Tuple[Call, Any, Any, asyncio.Future]] = []
+        # batches being sent
+        self._batch_tasks: Set[asyncio.Task] = set()
+        # requests sent, a batch counts once
+        self.requests = 0
+
+    async def get_block_number(self) -> int:
+        return await self._request(
+            "get_block_number", lambda endpoint: endpoint.client.get_block_number()
+        )
+
+    async def get_block(self, *args, **kwargs):
+        return await self._request(
+            "get_block", lambda endpoint: endpoint.client.get_block(*args, **kwargs)
+        )
+
+    async def call_contract(
+        self,
+        call: Call,
+        block_hash: Optional[Union[int, str]] = None,
+        block_number: Optional[Union[int, str]] = None,
+    ) -> List[int]:
+        """Call a contract, like `FullNodeClient.call_contract`.
+
+        Calls made concurrently, e.g. by `asyncio.gather`, are sent to the
+        node as JSON-RPC batches of at most `max_batch_size` calls.
+        """
+        if self._max_batch_size <= 1:
+            return await self._request(
+                "call",
+                lambda endpoint: endpoint.client.call_contract(
+                    call, block_hash=block_hash, block_number=block_number
+                ),
+            )
+        future = asyncio.get_running_loop().create_future()
+        if not self._batch:
+            # sent once the other tasks ready to run have queued their calls
+            asyncio.get_running_loop().call_soon(self._send_batches)
+        self._batch.append((call, block_hash, block_number, future))
+        return await future
+
+    def metrics(self) -> List[Dict[str, Any]]:
+        """Returns the calls, errors, hedges and latencies of each node."""
+        now = time.monotonic()
+        return [
+            {
+                "endpoint": i,
+                "calls": endpoint.calls,
+                "errors": endpoint.errors,
+                "hedges": endpoint.hedges,
+                "in_flight": endpoint.in_flight,
+                "ejected": not endpoint.available(now),
+                "p50": endpoint.percentile(0.5),
+                "p95": endpoint.percentile(0.95),
+            }
+            for i, endpoint in enumerate(self._endpoints)
+        ]
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+            self._endpoints = []
+
+    def _send_batches(self):
+        batch, self._batch = self._batch, []
+        for i in range(0, len(batch), self._max_batch_size):
+            task = asyncio.ensure_future(self._send_batch(batch[i : i + self._max_batch_size]))
+            # keep a reference, the event loop only keeps weak ones
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _send_batch(self, batch: List[Tuple[Call, Any, Any, asyncio.Future]]):
+        if len(batch) == 1:
+            [(call, block_hash, block_number, future)] = batch
+            send = lambda endpoint: endpoint.client.call_contract(
+                call, block_hash=block_hash, block_number=block_number
+            )
+        else:
+            payload = [
+                {
+                    "jsonrpc": "2.0",
+                    "method": "starknet_call",
+                    "params": _call_params(call, block_hash, block_number),
+                    "id": i,
+                }
+                for i, (call, block_hash, block_number, _) in enumerate(batch)
+            ]
+            send = lambda endpoint: self._post(endpoint, payload)
+        try:
+            response = await self._request("call", send)
+        except Exception as e:
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        if len(batch) == 1:
+            if not future.done():
+                future.set_result(response)
+            return
+        responses = {item.get("id"): item for item in response}
+        for i, (*_, future) in enumerate(batch):
+            if future.done():
+                continue
+            item = responses.get(i)
+            if item is None:
+                future.set_exception(ServerError(body=response))
+            elif "result" in item:
+                future.set_result([int(value, 16) for value in item["result"]])
+            else:
+                future.set_exception(_rpc_error(item))
+
+    async def _post(self, endpoint: Endpoint, payload: List[dict]) -> List[dict]:
+        async with self._session.post(endpoint.url, json=payload) as response:
+            if response.status >= 300:
+                raise ClientError(code=str(response.status), message=await response.text())
+            body = await response.json(content_type=None)
+        if not isinstance(body, list):
+            # e.g. a node not supporting batches
+            raise ServerError(body=body)
+        return body
+
+    async def _request(
+        self, method: str, send: Callable[[Endpoint], Awaitable[Any]]
+    ):
+        self.requests += 1
+        candidates = self._candidates()
+        last_error: Optional[Exception] = None
+        # try the nodes in turn, until one answers
+        while candidates:
+            endpoint = candidates.pop(0)
+            try:
+                result = await self._hedged(endpoint, candidates, send)
+                self._maybe_log_metrics()
+                return result
+            except Exception as e:
+                if not _is_node_failure(e):
+                    raise
+                last_error = e
+                logger.warn(
+                    "rpc node failed", endpoint=self._endpoints.index(endpoint), method=method, error=str(e)
+                )
+        raise last_error
+
+    async def _hedged(
+        self,
+        endpoint: Endpoint,
+        others: List[Endpoint],
+        send: Callable[[Endpoint], Awaitable[Any]],
+    ):
+        primary = asyncio.ensure_future(self._call(endpoint, send))
+        threshold = None
+        if others and len(endpoint.latencies) >= self._hedge_min_samples:
+            threshold = endpoint.percentile(self._hedge_percentile)
+        if threshold is None:
+            return await primary
+
+        done, _ = await asyncio.wait({primary}, timeout=threshold)
+        if done:
+            return primary.result()
+
+        # slow call, race it against the next node
+        hedge_endpoint = others[0]
+        hedge_endpoint.hedges += 1
+        hedge = asyncio.ensure_future(self._call(hedge_endpoint, send))
+        pending = {primary, hedge}
+        error: Optional[Exception] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    return task.result()
+                if error is None or task is primary:
+                    error = task.exception()
+        raise error
+
+    async def _call(self, endpoint: Endpoint, send: Callable[[Endpoint], Awaitable[Any]]):
+        async with endpoint.slots:
+            endpoint.in_flight += 1
+            endpoint.calls += 1
+            start = time.monotonic()
+            try:
+                result = await send(endpoint)
+            except Exception as e:
+                if _is_node_failure(e):
+                    self._record_failure(endpoint)
+                else:
+                    # the node answered
+                    endpoint.consecutive_failures = 0
+                raise
+            finally:
+                endpoint.in_flight -= 1
+            endpoint.latencies.append(time.monotonic() - start)
+            endpoint.consecutive_failures = 0
+            return result
+
+    def _record_failure(self, endpoint: Endpoint):
+        endpoint.errors += 1
+        endpoint.consecutive_failures += 1
+        if endpoint.consecutive_failures >= self._failure_threshold:
+            endpoint.ejected_until = time.monotonic() + self._cooldown
+            endpoint.consecutive_failures = 0
+            logger.warn(
+                "rpc node ejected",
+                endpoint=self._endpoints.index(endpoint),
+                cooldown=self._cooldown,
+            )
+
+    def _candidates(self) -> List[Endpoint]:
+        if self._session is None:
+            # created lazily, the session must belong to the running loop
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._max_in_flight * len(self._urls))
+            )
+            self._endpoints = [
+                Endpoint(
+                    url,
+                    FullNodeClient(url, net=StarknetChainId.MAINNET, session=self._session),
+                    self._max_in_flight,
+                    self._window,
+                )
+                for url in self._urls
+            ]
+        now = time.monotonic()
+        available = [endpoint for endpoint in self._endpoints if endpoint.available(now)]
+        if not available:
+            # all nodes are ejected, try the one coming back first
+            available = sorted(self._endpoints, key=lambda endpoint: endpoint.ejected_until)
+        return sorted(available, key=lambda endpoint: endpoint.in_flight)
+
+    def _maybe_log_metrics(self):
+        now = time.monotonic()
+        if now - self._metrics_logged_at < self._metrics_interval:
+            return
+        self._metrics_logged_at = now
+        for metrics in self.metrics():
+            logger.info("rpc endpoint", **metrics)
+
+
+def _is_node_failure(e: Exception) -> bool:
+    """Returns true if `e` is caused by the node rather than by the call."""
+    if isinstance(e, ClientError):
+        # http errors carry the status code as a string, errors of the
+        # StarkNet RPC API an integer code
+        return isinstance(e.code, str)
+    return isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError, ServerError, OSError))
+
+
+def _call_params(
+    call: Call, block_hash: Optional[Union[int, str]], block_number: Optional[Union[int, str]]
+) -> dict:
+    """Returns the params of a `starknet_call` request."""
+    return {
+        "request": {
+            "contract_address": hex(call.to_addr),
+            "entry_point_selector": hex(call.selector),
+            "calldata": [hex(value) for value in call.calldata],
+        },
+        **get_block_identifier(block_hash=block_hash, block_number=block_number),
+    }
+
+
+def _rpc_error(item: dict) -> Exception:
+    error = item.get("error")
+    if error is None:
+        return ServerError(body=item)
+    return ClientError(code=error["code"], message=error["message"])
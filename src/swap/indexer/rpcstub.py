@@ -0,0 +1,321 @@
+import asyncio
+import json
+import os
+import random
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import aiohttp
+from aiohttp import web
+from starknet_py.hash.selector import get_selector_from_name
+from structlog import get_logger
+
+logger = get_logger(__name__)
+
+# StarkNet RPC API errors
+_contract_not_found = {"code": 20, "message": "Contract not found"}
+_contract_error = {"code": 40, "message": "Contract error"}
+_method_not_found = {"code": -32601, "message": "Method not found"}
+# upstream errors worth recording: contract not found, invalid message
+# selector, contract error. Others (rate limits, missing blocks, internal
+# errors) are transient.
+_recorded_error_codes = {20, 21, 40}
+
+CallKey = Tuple[int, int, Tuple[int, ...]]
+# block number, or block hash as a normalized hex string
+BlockKey = Union[int, str]
+
+
+class RpcFixtures:
+    """Answers of the stub server, loaded from and saved to a JSON file:
+
+        {
+          "calls": [
+            {"contract_address": "0x1", "entry_point": "decimals",
+             "calldata": [], "result": ["0x12"]},
+            {"contract_address": "*", "entry_point_selector": "0x...",
+             "calldata": [], "block_number": 10, "error": "contract error"},
+            {"contract_address": "0x1", "entry_point": "balanceOf",
+             "calldata": ["0x5"], "block_hash": "0xa", "result": ["0x1", "0x0"]}
+          ],
+          "blocks": [{"block_number": 10, "block_hash": "0xa", ...}],
+          "head": 12
+        }
+
+    A call matches the fixture of its block, by number or hash like the
+    call, if any, otherwise the one without block. `"*"` matches any
+    contract. Blocks without fixture are synthesized.
+    """
+
+    def __init__(self):
+        # (contract, selector, calldata) -> {block or None: fixture}
+        self._calls: Dict[CallKey, Dict[Optional[BlockKey], dict]] = dict()
+        self._blocks: Dict[int, dict] = dict()
+        self.head: Optional[int] = None
+
+    @classmethod
+    def load(cls, path: Optional[str]) -> "RpcFixtures":
+        fixtures = cls()
+        if path is None:
+            return fixtures
+        with open(path) as f:
+            content = json.load(f)
+        for call in content.get("calls", []):
+            fixtures.add_call(call)
+        for block in content.get("blocks", []):
+            fixtures._blocks[block["block_number"]] = block
+        fixtures.head = content.get("head")
+        return fixtures
+
+    def save(self, path: str):
+        calls = [fixture for fixtures in self._calls.values() for fixture in fixtures.values()]
+        with open(path, "w") as f:
+            json.dump(
+                {"calls": calls, "blocks": list(self._blocks.values()), "head": self.head},
+                f,
+                indent=1,
+            )
+
+    def add_call(self, fixture: dict):
+        if "entry_point" in fixture:
+            selector = get_selector_from_name(fixture["entry_point"])
+        else:
+            selector = int(fixture["entry_point_selector"], 16)
+        contract = fixture["contract_address"]
+        key = (
+            -1 if contract == "*" else int(contract, 16),
+            selector,
+            tuple(int(value, 16) for value in fixture.get("calldata", [])),
+        )
+        block = fixture.get("block_number")
+        if block is None and fixture.get("block_hash") is not None:
+            block = _hash_key(fixture["block_hash"])
+        self._calls.setdefault(key, dict())[block] = fixture
+
+    def find_call(self, request: dict, block: Optional[BlockKey]) -> Optional[dict]:
+        contract = int(request["contract_address"], 16)
+        selector = int(request["entry_point_selector"], 16)
+        calldata = tuple(int(value, 16) for value in request["calldata"])
+        for key in ((contract, selector, calldata), (-1, selector, calldata)):
+            fixtures = self._calls.get(key)
+            if fixtures is None:
+                continue
+            fixture = fixtures.get(block, fixtures.get(None))
+            if fixture is not None:
+                return fixture
+        return None
+
+    def head_number(self) -> int:
+        if self.head is not None:
+            return self.head
+        return max(self._blocks, default=0)
+
+    def block_number_of(self, block_hash: str) -> int:
+        for number, block in self._blocks.items():
+            if _hash_key(block["block_hash"]) == block_hash:
+                return number
+        # synthesized blocks
+        return int(block_hash, 16) - 1
+
+    def block(self, block_number: int) -> dict:
+        block = self._blocks.get(block_number)
+        if block is not None:
+            return block
+        return {
+            "status": "ACCEPTED_ON_L2",
+            "block_hash": hex(block_number + 1),
+            "parent_hash": hex(block_number),
+            "block_number": block_number,
+            "new_root": "0",
+            "timestamp": 1680000000 + block_number,
+            "sequencer_address": "0x0",
+            "transactions": [],
+        }
+
+
+class RpcStub:
+    """Local StarkNet JSON-RPC server answering from `fixtures`.
+
+    Answers `starknet_call`, `starknet_getBlockWithTxHashes`,
+    `starknet_getBlockWithTxs` and `starknet_blockNumber`, including
+    batches, after `latency` seconds (plus up to `jitter`). A fraction
+    `error_rate` of the requests fail with HTTP 503, like an overloaded
+    node. Calls without fixture are sent to `upstream` and recorded, if
+    set, or fail with a contract error. Transient upstream failures are
+    answered with HTTP 503 and not recorded.
+    """
+
+    def __init__(
+        self,
+        fixtures: RpcFixtures,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        upstream: Optional[str] = None,
+        seed: Optional[int] = None,
+    ):
+        self.fixtures = fixtures
+        self._latency = latency
+        self._jitter = jitter
+        self._error_rate = error_rate
+        self._upstream = upstream
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._random = random.Random(seed)
+        self.requests = 0
+        self.misses = 0
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 9545) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_post("/", self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info("serving rpc stub", host=host, port=port, upstream=self._upstream)
+        return runner
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        delay = self._latency + self._random.uniform(0, self._jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if self._random.random() < self._error_rate:
+            return web.Response(status=503, text="injected error")
+        payload = await request.json()
+        try:
+            if isinstance(payload, list):
+                body = [await self._answer(item) for item in payload]
+            else:
+                body = await self._answer(payload)
+        except (_UpstreamError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warn("upstream call failed", error=str(e))
+            return web.Response(status=503, text=str(e))
+        return web.json_response(body)
+
+    async def _answer(self, item: dict) -> dict:
+        method = item.get("method")
+        params = item.get("params", {})
+        try:
+            if method == "starknet_call":
+                result = await self._call(params)
+            elif method in ("starknet_getBlockWithTxHashes", "starknet_getBlockWithTxs"):
+                result = self._block(params)
+            elif method == "starknet_blockNumber":
+                result = self.fixtures.head_number()
+            else:
+                raise _RpcError(_method_not_found)
+        except _RpcError as e:
+            return {"jsonrpc": "2.0", "id": item.get("id"), "error": e.error}
+        return {"jsonrpc": "2.0", "id": item.get("id"), "result": result}
+
+    async def _call(self, params: dict) -> List[str]:
+        request = params["request"]
+        block = _block_key(params["block_id"])
+        fixture = self.fixtures.find_call(request, block)
+        if fixture is None:
+            self.misses += 1
+            if self._upstream is None:
+                raise _RpcError(_contract_error)
+            fixture = await self._record(request, params["block_id"], block)
+        if "error" in fixture:
+            raise _RpcError(
+                _contract_not_found if fixture["error"] == "contract not found" else _contract_error
+            )
+        return fixture["result"]
+
+    async def _record(self, request: dict, block_id: Any, block: Optional[BlockKey]) -> dict:
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        payload = {
+            "jsonrpc": "2.0",
+            "method": "starknet_call",
+            "params": {"request": request, "block_id": block_id},
+            "id": 0,
+        }
+        async with self._session.post(self._upstream, json=payload) as response:
+            if response.status >= 300:
+                raise _UpstreamError(f"upstream answered http {response.status}")
+            body = await response.json(content_type=None)
+        fixture = {
+            "contract_address": request["contract_address"],
+            "entry_point_selector": request["entry_point_selector"],
+            "calldata": request["calldata"],
+        }
+        if isinstance(block, str):
+            fixture["block_hash"] = block
+        else:
+            fixture["block_number"] = block
+        code = body.get("error", {}).get("code")
+        if "result" in body:
+            fixture["result"] = body["result"]
+        elif code == _contract_not_found["code"]:
+            fixture["error"] = "contract not found"
+        elif code in _recorded_error_codes:
+            fixture["error"] = "contract error"
+        else:
+            raise _UpstreamError(f"upstream answered {body.get('error')}")
+        self.fixtures.add_call(fixture)
+        return fixture
+
+    def _block(self, params: dict) -> dict:
+        block = _block_key(params["block_id"])
+        if block is None:
+            block = self.fixtures.head_number()
+        elif isinstance(block, str):
+            block = self.fixtures.block_number_of(block)
+        return self.fixtures.block(block)
+
+
+class _UpstreamError(Exception):
+    """A transient upstream failure, answered with HTTP 503 and not recorded."""
+
+
+class _RpcError(Exception):
+    def __init__(self, error: dict):
+        super().__init__(error["message"])
+        self.error = error
+
+
+def _block_key(block_id: Any) -> Optional[BlockKey]:
+    # "latest" or "pending": answered as of no particular block
+    if isinstance(block_id, dict):
+        if block_id.get("block_number") is not None:
+            return block_id["block_number"]
+        if block_id.get("block_hash") is not None:
+            return _hash_key(block_id["block_hash"])
+    return None
+
+
+def _hash_key(block_hash: str) -> str:
+    return hex(int(block_hash, 16))
+
+
+async def run_rpc_stub(
+    fixtures_path: Optional[str],
+    host: str,
+    port: int,
+    latency: float = 0.0,
+    jitter: float = 0.0,
+    error_rate: float = 0.0,
+    upstream: Optional[str] = None,
+):
+    if upstream is not None and fixtures_path is not None and not os.path.exists(fixtures_path):
+        # recording into a new file
+        fixtures = RpcFixtures()
+    else:
+        fixtures = RpcFixtures.load(fixtures_path)
+    stub = RpcStub(fixtures, latency, jitter, error_rate, upstream=upstream)
+    runner = await stub.serve(host, port)
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        logger.info("rpc stub stopped", requests=stub.requests, misses=stub.misses)
+        await runner.cleanup()
+        await stub.close()
+        if upstream is not None and fixtures_path is not None:
+            # keep the calls recorded from the upstream node
+            stub.fixtures.save(fixtures_path)
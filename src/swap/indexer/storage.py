@@ -0,0 +1,500 @@
+from collections import defaultdict
+from decimal import Decimal
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from apibara.indexer.storage import Storage
+from bson import Decimal128, ObjectId
+from pymongo import InsertOne, UpdateOne, WriteConcern
+from pymongo.client_session import ClientSession
+from structlog import get_logger
+
+logger = get_logger(__name__)
+
+Document = Dict[str, Any]
+DocumentFilter = Dict[str, Any]
+DocumentUpdate = Dict[str, Any]
+
+
+class BlockStorage:
+    """Chain-aware storage that buffers all the writes of a block.
+
+    Exposes the same methods as apibara's `Storage`, but instead of sending
+    every write to MongoDB it keeps the new version of each document in
+    memory. Reads see the buffered state, so handlers can read their own
+    writes. `flush` then writes the block with one unordered `bulk_write`
+    per collection:
+
+     - documents replaced, updated or deleted in the block get their
+       `_chain.valid_to` set to the block number,
+     - new documents and new versions are inserted with
+       `_chain.valid_from` set to the block number.
+
+    This is the same versioning applied by apibara's storage. Intermediate
+    versions created and replaced within the same block are never written:
+    they would be valid from and to the same block, so no query can see them.
+
+    Updates sent with `update_one` are applied lazily: the documents they
+    target are fetched with a single query per collection, before the next
+    read of the collection or when the block is flushed.
+
+    `parents` are the storages of the previous blocks whose writes may not
+    be committed yet, oldest first. Reads see their documents as if they
+    were stored.
+
+    `reads` counts the queries sent to MongoDB.
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        write_concern: Optional[WriteConcern] = None,
+        parents: Sequence["BlockStorage"] = (),
+    ):
+        self._storage = storage
+        self._parents = parents
+        self._db = storage._db
+        self._write_concern = write_concern
+        self._session = storage._session
+        self._block_number = storage._cursor.order_key
+        # new documents (and new versions of stored documents), by collection
+        self._pending: Dict[str, List[Document]] = defaultdict(list)
+        # stored documents replaced or deleted in this block, by collection
+        self._superseded: Dict[str, Dict[ObjectId, None]] = defaultdict(dict)
+        # updates not applied yet, by collection
+        self._updates: Dict[
+            str, List[Tuple[DocumentFilter, DocumentUpdate, bool]]
+        ] = defaultdict(list)
+        self.reads = 0
+
+    async def insert_one(self, collection: str, doc: Document):
+        """Insert `doc` into `collection`."""
+        # like pymongo, set the id on the caller's document
+        doc.setdefault("_id", ObjectId())
+        self._add_pending(collection, doc)
+
+    async def insert_many(self, collection: str, docs: Iterable[Document]):
+        """Insert multiple `docs` into `collection`."""
+        for doc in docs:
+            await self.insert_one(collection, doc)
+
+    async def delete_one(self, collection: str, filter: DocumentFilter):
+        """Delete the first document in `collection` matching `filter`."""
+        existing = await self.find_one(collection, filter)
+        if existing is not None:
+            self._remove(collection, existing)
+
+    async def delete_many(self, collection: str, filter: DocumentFilter):
+        """Delete all documents in `collection` matching `filter`."""
+        for existing in await self.find(collection, filter):
+            self._remove(collection, existing)
+
+    async def find_one(
+        self, collection: str, filter: DocumentFilter
+    ) -> Optional[Document]:
+        """Find the first document in `collection` matching `filter`."""
+        await self._apply_updates(collection)
+        doc = self._find_pending(collection, filter)
+        if doc is not None:
+            return dict(doc)
+        self.reads += 1
+        return await self._storage.find_one(
+            collection, self._stored_filter(collection, filter)
+        )
+
+    async def find(
+        self,
+        collection: str,
+        filter: DocumentFilter,
+        sort: Optional[Dict[str, int]] = None,
+        projection: Optional[Dict[str, Any]] = None,
+        skip: int = 0,
+        limit: int = 0,
+    ) -> List[Document]:
+        """Find all documents in `collection` matching `filter`.
+
+        Stored documents come first, followed by the documents written in
+        this block, like in MongoDB's natural order.
+        """
+        await self._apply_updates(collection)
+        # read the parents first: their documents may be committed meanwhile
+        parent_docs = [
+            doc
+            for doc in self._parent_docs(collection)
+            if matches_filter(doc, filter)
+        ]
+        parent_ids = {doc["_id"] for doc in parent_docs}
+        self.reads += 1
+        docs = [
+            doc
+            for doc in await self._storage.find(
+                collection, self._stored_filter(collection, filter)
+            )
+            if doc["_id"] not in parent_ids
+        ]
+        docs.extend(dict(doc) for doc in parent_docs)
+        docs.extend(
+            dict(doc)
+            for doc in self._pending.get(collection, [])
+            if matches_filter(doc, filter)
+        )
+        if sort is not None:
+            # sort by the last key first, python's sort is stable
+            for field, order in reversed(list(sort.items())):
+                docs.sort(key=lambda doc: _sort_key(_get(doc, field)), reverse=order < 0)
+        if skip:
+            docs = docs[skip:]
+        if limit:
+            docs = docs[:limit]
+        if projection is not None:
+            docs = [_project(doc, projection) for doc in docs]
+        return docs
+
+    async def find_one_and_replace(
+        self,
+        collection: str,
+        filter: DocumentFilter,
+        replacement: Document,
+        upsert: bool = False,
+    ):
+        """Replace the first document in `collection` matching `filter` with `replacement`.
+        If `upsert = True`, insert `replacement` even if no document matched the `filter`.
+        """
+        existing = await self.find_one(collection, filter)
+        if existing is not None:
+            self.replace_version(collection, existing, replacement)
+        elif upsert:
+            replacement = dict(replacement)
+            replacement.pop("_id", None)
+            self._add_pending(collection, replacement)
+        return existing
+
+    async def find_one_and_update(
+        self, collection: str, filter: DocumentFilter, update: Dict[str, Any]
+    ):
+        """Update the first document in `collection` matching `filter` with `update`.
+
+        Returns the document before the update.
+        """
+        existing = await self.find_one(collection, filter)
+        if existing is not None:
+            new_version = dict(existing)
+            apply_update(new_version, update)
+            self.replace_version(collection, existing, new_version)
+        return existing
+
+    async def update_one(
+        self,
+        collection: str,
+        filter: DocumentFilter,
+        update: DocumentUpdate,
+        upsert: bool = False,
+    ):
+        """Update the first document in `collection` matching `filter` with `update`.
+        If `upsert = True`, insert a document built from the equality fields
+        of `filter` and `update` if no document matched the `filter`.
+
+        Unlike `find_one_and_update`, the update is deferred and nothing is
+        returned.
+        """
+        self._updates[collection].append((filter, update, upsert))
+
+    def replace_version(self, collection: str, current: Document, replacement: Document):
+        """Replace `current`, a document previously read from this storage,
+        with `replacement`."""
+        self._remove(collection, current)
+        replacement = dict(replacement)
+        # the new version is a new document
+        replacement.pop("_id", None)
+        self._add_pending(collection, replacement)
+
+    async def flush(self):
+        """Write all buffered changes, one `bulk_write` per collection."""
+        await self.resolve()
+        self.write(self._session)
+        self._pending.clear()
+        self._superseded.clear()
+
+    async def resolve(self):
+        """Apply the deferred updates, the block is ready to be written."""
+        for collection in list(self._updates.keys()):
+            await self._apply_updates(collection)
+
+    def pending_writes(self) -> int:
+        """Returns the number of write operations sent by `write`."""
+        return sum(len(ids) for ids in self._superseded.values()) + sum(
+            len(docs) for docs in self._pending.values()
+        )
+
+    def write(self, session: Optional[ClientSession] = None):
+        """Send the buffered changes to MongoDB, one `bulk_write` per collection.
+
+        Blocking, can run outside of the event loop once the block is resolved.
+        """
+        collections = list(self._superseded.keys())
+        collections.extend(c for c in self._pending.keys() if c not in self._superseded)
+
+        writes = 0
+        for collection in collections:
+            requests = [
+                UpdateOne(
+                    {"_id": id, "_chain.valid_to": None},
+                    {"$set": {"_chain.valid_to": self._block_number}},
+                )
+                for id in self._superseded.get(collection, [])
+            ]
+            requests.extend(InsertOne(doc) for doc in self._pending.get(collection, []))
+            if not requests:
+                continue
+            self._db.get_collection(
+                collection, write_concern=self._write_concern
+            ).bulk_write(requests, ordered=False, session=session)
+            writes += len(requests)
+
+        logger.debug(
+            "flushed block storage",
+            block_number=self._block_number,
+            collections=len(collections),
+            writes=writes,
+        )
+
+    async def _apply_updates(self, collection: str):
+        updates = self._updates.pop(collection, None)
+        if not updates:
+            return
+        # fetch the stored documents targeted by all the updates at once
+        self.reads += 1
+        stored = list(
+            await self._storage.find(
+                collection,
+                self._stored_filter(
+                    collection, {"$or": [filter for filter, _, _ in updates]}
+                ),
+            )
+        )
+        for filter, update, upsert in updates:
+            existing = self._find_pending(collection, filter)
+            if existing is None:
+                superseded = self._superseded.get(collection, {})
+                existing = next(
+                    (
+                        doc
+                        for doc in stored
+                        if doc["_id"] not in superseded and matches_filter(doc, filter)
+                    ),
+                    None,
+                )
+            if existing is not None:
+                new_version = dict(existing)
+                apply_update(new_version, update)
+                self.replace_version(collection, existing, new_version)
+            elif upsert:
+                doc = {
+                    field: value
+                    for field, value in filter.items()
+                    if not field.startswith("$")
+                }
+                apply_update(doc, update, is_insert=True)
+                self._add_pending(collection, doc)
+
+    def _find_pending(
+        self, collection: str, filter: DocumentFilter
+    ) -> Optional[Document]:
+        for doc in self._pending.get(collection, []):
+            if matches_filter(doc, filter):
+                return doc
+        for doc in reversed(self._parent_docs(collection)):
+            if matches_filter(doc, filter):
+                return doc
+        return None
+
+    def _parent_docs(self, collection: str) -> List[Document]:
+        """Returns the documents written by the parents and not replaced
+        since, oldest first."""
+        docs = []
+        superseded = set(self._superseded.get(collection, ()))
+        for parent in reversed(self._parents):
+            for doc in reversed(parent._pending.get(collection, [])):
+                if doc["_id"] not in superseded:
+                    docs.append(doc)
+            superseded.update(parent._superseded.get(collection, ()))
+        docs.reverse()
+        return docs
+
+    def _add_pending(self, collection: str, doc: Document):
+        doc = dict(doc)
+        doc.setdefault("_id", ObjectId())
+        doc["_chain"] = {"valid_from": self._block_number, "valid_to": None}
+        self._pending[collection].append(doc)
+
+    def _remove(self, collection: str, current: Document):
+        pending = self._pending.get(collection, [])
+        for i, doc in enumerate(pending):
+            if doc["_id"] == current["_id"]:
+                # written in this block, drop the intermediate version
+                del pending[i]
+                return
+        self._superseded[collection][current["_id"]] = None
+
+    def _stored_filter(self, collection: str, filter: DocumentFilter):
+        filter = dict(filter)
+        superseded = list(self._superseded.get(collection, ()))
+        for parent in self._parents:
+            superseded.extend(parent._superseded.get(collection, ()))
+        if superseded:
+            not_superseded = {"$nin": superseded}
+            if "_id" in filter:
+                # keep the caller's condition on `_id`
+                filter["$and"] = [*filter.get("$and", []), {"_id": not_superseded}]
+            else:
+                filter["_id"] = not_superseded
+        return filter
+
+
+def matches_filter(doc: Document, filter: DocumentFilter) -> bool:
+    """Returns true if `doc` matches the MongoDB query `filter`.
+
+    Supports the subset of the query language used by the indexer:
+    equality on (dotted) fields, comparison operators, `$in`, `$nin`,
+    `$and` and `$or`.
+    """
+    for key, condition in filter.items():
+        if key == "$or":
+            if not any(matches_filter(doc, f) for f in condition):
+                return False
+        elif key == "$and":
+            if not all(matches_filter(doc, f) for f in condition):
+                return False
+        elif not _matches_condition(_get(doc, key), condition):
+            return False
+    return True
+
+
+def apply_update(doc: Document, update: Dict[str, Any], is_insert: bool = False):
+    """Apply the MongoDB `update` operators to `doc`, in place."""
+    for operator, fields in update.items():
+        if operator == "$setOnInsert":
+            if not is_insert:
+                continue
+            operator = "$set"
+        for field, value in fields.items():
+            if operator == "$set":
+                _set(doc, field, value)
+            elif operator == "$inc":
+                _set(doc, field, _inc(_get(doc, field), value))
+            elif operator == "$unset":
+                _unset(doc, field)
+            else:
+                raise ValueError(f"unsupported update operator {operator}")
+
+
+def _matches_condition(value, condition) -> bool:
+    if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+        for operator, operand in condition.items():
+            if operator == "$in":
+                if not any(_equals(value, o) for o in operand):
+                    return False
+            elif operator == "$nin":
+                if any(_equals(value, o) for o in operand):
+                    return False
+            elif operator == "$ne":
+                if _equals(value, operand):
+                    return False
+            elif operator == "$eq":
+                if not _equals(value, operand):
+                    return False
+            elif operator in _comparisons:
+                if value is None or operand is None:
+                    return False
+                if not _comparisons[operator](_comparable(value), _comparable(operand)):
+                    return False
+            else:
+                raise ValueError(f"unsupported query operator {operator}")
+        return True
+    return _equals(value, condition)
+
+
+_comparisons = {
+    "$gt": lambda a, b: a > b,
+    "$gte": lambda a, b: a >= b,
+    "$lt": lambda a, b: a < b,
+    "$lte": lambda a, b: a <= b,
+}
+
+
+def _equals(value, other) -> bool:
+    # like MongoDB, `None` matches both null and missing fields
+    if isinstance(value, Decimal128) or isinstance(other, Decimal128):
+        if value is None or other is None:
+            return value is other
+        return _comparable(value) == _comparable(other)
+    return value == other
+
+
+def _comparable(value):
+    if isinstance(value, Decimal128):
+        return value.to_decimal()
+    return value
+
+
+def _sort_key(value):
+    # missing and null values sort first in ascending order
+    if value is None:
+        return (0, 0)
+    return (1, _comparable(value))
+
+
+_missing = object()
+
+
+def _get(doc: Document, field: str):
+    value = doc
+    for part in field.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part, _missing)
+        if value is _missing:
+            return None
+    return value
+
+
+def _set(doc: Document, field: str, value):
+    *parents, last = field.split(".")
+    for part in parents:
+        # copy embedded documents, they may be shared with older versions
+        doc[part] = dict(doc.get(part) or dict())
+        doc = doc[part]
+    doc[last] = value
+
+
+def _unset(doc: Document, field: str):
+    *parents, last = field.split(".")
+    for part in parents:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(last, None)
+
+
+def _inc(current, value):
+    if current is None:
+        return value
+    if isinstance(current, Decimal128) or isinstance(value, Decimal128):
+        return Decimal128(_to_decimal(current) + _to_decimal(value))
+    return current + value
+
+
+def _to_decimal(value) -> Decimal:
+    if isinstance(value, Decimal128):
+        return value.to_decimal()
+    return Decimal(value)
+
+
+def _project(doc: Document, projection: Dict[str, Any]) -> Document:
+    include = {k for k, v in projection.items() if v}
+    exclude = {k for k, v in projection.items() if not v}
+    if include:
+        projected = {k: v for k, v in doc.items() if k in include}
+        if "_id" not in exclude and "_id" in doc:
+            projected["_id"] = doc["_id"]
+        return projected
+    return {k: v for k, v in doc.items() if k not in exclude}
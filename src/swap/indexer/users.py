@@ -0,0 +1,50 @@
+from typing import Dict, Union
+
+from apibara.indexer import Info
+from structlog import get_logger
+
+from swap.indexer.storage import apply_update
+
+logger = get_logger(__name__)
+
+# counters of a new user
+_user_counters = ("transaction_count", "swap_count", "mint_count", "burn_count")
+
+
+class UserStats:
+    """Per-user counters of a block.
+
+    Increments are summed in memory by user id and written once, when the
+    block is flushed, as one `$inc` upsert per user.
+    """
+
+    def __init__(self):
+        self._inc: Dict[str, dict] = dict()
+
+    def increment(self, user_id: str, inc: dict):
+        apply_update(self._inc.setdefault(user_id, dict()), {"$inc": inc})
+
+    async def flush(self, info: Info):
+        for user_id, inc in self._inc.items():
+            await info.storage.update_one(
+                "users",
+                {"id": user_id},
+                {
+                    "$setOnInsert": {
+                        counter: 0 for counter in _user_counters if counter not in inc
+                    },
+                    "$inc": inc,
+                },
+                upsert=True,
+            )
+        logger.debug("flushed users", users=len(self._inc))
+        self.clear()
+
+    def clear(self):
+        self._inc.clear()
+
+
+def increment_user(info: Info, user_id: Union[int, str], inc: dict):
+    if isinstance(user_id, int):
+        user_id = hex(user_id)
+    info.context.users.increment(user_id, inc)
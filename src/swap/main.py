@@ -4,7 +4,10 @@ from functools import wraps
 import click
 from structlog import get_logger
 
-from swap.indexer import run_indexer
+from swap.indexer import replay_indexer, run_indexer
+from swap.indexer.log import configure_logging, log_levels
+from swap.indexer.oracle import eth_price_sources
+from swap.indexer.rpcstub import run_rpc_stub
 from swap.server import run_graphql_server
 
 import os
@@ -34,8 +37,82 @@ def cli():
 # @click.option("--mongo-url", default=None, help="MongoDB url.")
 # @click.option("--rpc-url", default=None, help="StarkNet RPC url.")
 @click.option("--restart", is_flag=True, help="Restart indexing from the beginning.")
+@click.option(
+    "--reconcile-lp-every",
+    default=0,
+    type=int,
+    help="Verify a sample of LP balances against RPC every n blocks (0 to disable).",
+)
+@click.option(
+    "--eth-price-source",
+    default="usdc",
+    type=click.Choice(eth_price_sources),
+    help="Pairs used to price ETH: the ETH/USDC pair, or the median or reserve-weighted price of the ETH/stablecoin pairs.",
+)
+@click.option(
+    "--multihop-pricing",
+    is_flag=True,
+    help="Price tokens without a whitelisted pair through paths of other pairs, and track their volume.",
+)
+@click.option(
+    "--backfill",
+    is_flag=True,
+    help="Write without waiting for the journal while far from the chain head.",
+)
+@click.option(
+    "--backfill-distance",
+    default=1000,
+    type=int,
+    help="Blocks behind the chain head from which --backfill applies.",
+)
+@click.option(
+    "--pipeline-depth",
+    default=0,
+    type=click.IntRange(min=0),
+    help="Blocks persisted in the background while the next ones are handled (0 to persist each block before the next).",
+)
+@click.option(
+    "--compact-filter",
+    is_flag=True,
+    help="Subscribe to pool events by key and keep those of known pairs, instead of one filter per pair. Must match the mode the indexer was created with, or be used with --restart.",
+)
+@click.option(
+    "--rpc-batch-size",
+    default=50,
+    type=click.IntRange(min=1),
+    help="Contract calls sent in one JSON-RPC batch (1 for nodes without batch support).",
+)
+@click.option(
+    "--metrics-port",
+    default=0,
+    type=click.IntRange(min=0),
+    help="Serve Prometheus metrics on http://0.0.0.0:<port>/metrics (0 to disable).",
+)
+@click.option(
+    "--slow-block-ms",
+    default=None,
+    type=click.FloatRange(min=0),
+    help="Profile storage operations and contract calls, and report blocks slower than this (in ms) to --slow-block-dir.",
+)
+@click.option("--slow-block-dir", default="slow-blocks", type=click.Path(file_okay=False), help="Directory of the slow-block reports.")
+@click.option(
+    "--record",
+    "record_path",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Append the blocks received to this file, to replay them with `replay` (compressed if it ends with .gz).",
+)
+@click.option("--log-level", default="info", type=click.Choice(log_levels), help="Indexer log level.")
+@click.option(
+    "--log-sample-rate",
+    default=1.0,
+    type=click.FloatRange(0, 1),
+    help="Fraction of blocks that print per-event debug logs.",
+)
+@click.option("--apibara-log-level", default="info", type=click.Choice(log_levels), help="Log level of the apibara sdk.")
 @async_command
-async def indexer(restart):
+async def indexer(restart, reconcile_lp_every, eth_price_source, multihop_pricing, backfill, backfill_distance, pipeline_depth, compact_filter, rpc_batch_size, metrics_port, slow_block_ms, slow_block_dir, record_path, log_level, log_sample_rate, apibara_log_level):
+    configure_logging(log_level, log_sample_rate, apibara_log_level)
     server_url = os.environ.get('SERVER_URL', None)
     if server_url is None:
         sys.exit("SERVER_URL not set")
@@ -45,6 +122,8 @@ async def indexer(restart):
     rpc_url = os.environ.get('RPC_URL', None)
     if rpc_url is None:
         sys.exit("RPC_URL not set")
+    # comma-separated urls of the nodes of the pool
+    rpc_urls = [url.strip() for url in rpc_url.split(",") if url.strip()]
     apibara_auth_token = os.environ.get('APIBARA_AUTH_TOKEN', None)
     if apibara_auth_token is None:
         sys.exit("APIBARA_AUTH_TOKEN not set")
@@ -54,8 +133,115 @@ async def indexer(restart):
         # skip mongo_url: contains password
         rpc_url=rpc_url,
         restart=restart,
+        reconcile_lp_every=reconcile_lp_every,
+        eth_price_source=eth_price_source,
+        multihop_pricing=multihop_pricing,
+        backfill=backfill,
+        pipeline_depth=pipeline_depth,
+        compact_filter=compact_filter,
+        rpc_batch_size=rpc_batch_size,
+        metrics_port=metrics_port,
+        slow_block_ms=slow_block_ms,
+        record_path=record_path,
+    )
+    await run_indexer(
+        server_url, apibara_auth_token, mongo_url, rpc_urls, indexer_id, restart, reconcile_lp_every, eth_price_source, multihop_pricing,
+        backfill_distance=backfill_distance if backfill else None,
+        pipeline_depth=pipeline_depth,
+        compact_filter=compact_filter,
+        rpc_batch_size=rpc_batch_size,
+        metrics_port=metrics_port,
+        slow_block_ms=slow_block_ms,
+        slow_block_dir=slow_block_dir,
+        record_path=record_path,
+    )
+
+
+@cli.command()
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--from-block", default=None, type=int, help="First recorded block to replay.")
+@click.option("--to-block", default=None, type=int, help="Last recorded block to replay.")
+@click.option(
+    "--replay-id",
+    default=indexer_id + "-replay",
+    help="Indexer id of the replay, its database is dropped first.",
+)
+@click.option("--eth-price-source", default="usdc", type=click.Choice(eth_price_sources), help="Pool(s) the ETH price is derived from.")
+@click.option("--multihop-pricing", is_flag=True, help="Price tokens through multi-hop routes.")
+@click.option("--pipeline-depth", default=0, type=click.IntRange(min=0), help="Blocks persisted in the background while the next ones are handled.")
+@click.option("--compact-filter", is_flag=True, help="Keep only the events of known pairs (for blocks recorded with --compact-filter).")
+@click.option("--rpc-batch-size", default=50, type=click.IntRange(min=1), help="Contract calls sent in one JSON-RPC batch.")
+@click.option("--slow-block-ms", default=None, type=click.FloatRange(min=0), help="Report blocks slower than this (in ms), see `indexer --help`.")
+@click.option("--slow-block-dir", default="slow-blocks", type=click.Path(file_okay=False), help="Directory of the slow-block reports.")
+@click.option(
+    "--storage",
+    default="mongo",
+    type=click.Choice(["mongo", "memory"]),
+    help="Index into MongoDB, or in memory to measure the handlers alone (MONGO_URL then only provides the caches).",
+)
+@click.option("--log-level", default="info", type=click.Choice(log_levels), help="Indexer log level.")
+@async_command
+async def replay(path, from_block, to_block, replay_id, eth_price_source, multihop_pricing, pipeline_depth, compact_filter, rpc_batch_size, slow_block_ms, slow_block_dir, storage, log_level):
+    """Index blocks recorded with `indexer --record`, without apibara."""
+    configure_logging(log_level)
+    if storage == "memory" and pipeline_depth > 0:
+        raise click.UsageError("--pipeline-depth requires --storage mongo")
+    mongo_url = os.environ.get('MONGO_URL', None)
+    if mongo_url is None and storage == "mongo":
+        sys.exit("MONGO_URL not set")
+    # contract calls made while recording are cached, others need a node
+    rpc_url = os.environ.get('RPC_URL', "http://localhost:9545")
+    rpc_urls = [url.strip() for url in rpc_url.split(",") if url.strip()]
+    logger.info(
+        "starting replay",
+        path=path,
+        from_block=from_block,
+        to_block=to_block,
+        replay_id=replay_id,
+        rpc_url=rpc_url,
+        storage=storage,
+    )
+    await replay_indexer(
+        path, mongo_url, rpc_urls, indexer_id, replay_id,
+        from_block=from_block,
+        to_block=to_block,
+        eth_price_source=eth_price_source,
+        multihop_pricing=multihop_pricing,
+        pipeline_depth=pipeline_depth,
+        compact_filter=compact_filter,
+        rpc_batch_size=rpc_batch_size,
+        slow_block_ms=slow_block_ms,
+        slow_block_dir=slow_block_dir,
+        storage=storage,
+    )
+
+
+@cli.command("rpc-stub")
+@click.option("--fixtures", "fixtures_path", default=None, type=click.Path(dir_okay=False), help="JSON file of the call results and blocks served.")
+@click.option("--host", default="127.0.0.1", help="Address to listen on.")
+@click.option("--port", default=9545, type=int, help="Port to listen on.")
+@click.option("--latency-ms", default=0.0, type=click.FloatRange(min=0), help="Delay added to every request.")
+@click.option("--jitter-ms", default=0.0, type=click.FloatRange(min=0), help="Random delay added on top of --latency-ms.")
+@click.option("--error-rate", default=0.0, type=click.FloatRange(0, 1), help="Fraction of the requests failing with HTTP 503.")
+@click.option(
+    "--upstream",
+    default=None,
+    help="RPC node answering the calls missing from the fixtures, they are saved to --fixtures on exit.",
+)
+@click.option("--log-level", default="info", type=click.Choice(log_levels), help="Log level.")
+@async_command
+async def rpc_stub(fixtures_path, host, port, latency_ms, jitter_ms, error_rate, upstream, log_level):
+    """Serve contract calls and blocks from fixtures, in place of a StarkNet node."""
+    configure_logging(log_level)
+    await run_rpc_stub(
+        fixtures_path,
+        host,
+        port,
+        latency=latency_ms / 1000,
+        jitter=jitter_ms / 1000,
+        error_rate=error_rate,
+        upstream=upstream,
     )
-    await run_indexer(server_url, apibara_auth_token, mongo_url, rpc_url, indexer_id, restart)
 
 
 @cli.command()
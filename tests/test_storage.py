@@ -0,0 +1,202 @@
+"""BlockStorage on top of the in-memory storage.
+
+    PYTHONPATH=src python -m unittest discover tests
+"""
+import unittest
+from decimal import Decimal
+
+from apibara.protocol.proto.stream_pb2 import Cursor
+from bson import Decimal128, ObjectId
+
+from swap.indexer.memory import MemoryDatabase, MemoryStorage
+from swap.indexer.storage import BlockStorage, apply_update, matches_filter
+
+
+class BlockStorageTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.db = MemoryDatabase()
+
+    def block(self, block_number: int, parents=()) -> BlockStorage:
+        return BlockStorage(
+            MemoryStorage(self.db, Cursor(order_key=block_number)), parents=parents
+        )
+
+    async def store(self, block_number: int, collection: str, *docs):
+        storage = self.block(block_number)
+        for doc in docs:
+            await storage.insert_one(collection, doc)
+        await storage.flush()
+
+    def versions(self, collection: str):
+        return sorted(
+            self.db[collection].find({}),
+            key=lambda doc: (doc["_chain"]["valid_from"], doc["_chain"]["valid_to"] or float("inf")),
+        )
+
+    async def test_reads_own_writes(self):
+        storage = self.block(1)
+        await storage.insert_one("pairs", {"id": "0x1", "reserve0": 10})
+        self.assertEqual((await storage.find_one("pairs", {"id": "0x1"}))["reserve0"], 10)
+
+        await storage.update_one("pairs", {"id": "0x1"}, {"$set": {"reserve0": 20}})
+        self.assertEqual((await storage.find_one("pairs", {"id": "0x1"}))["reserve0"], 20)
+        self.assertEqual(len(await storage.find("pairs", {})), 1)
+        # nothing is written before the flush
+        self.assertEqual(self.db["pairs"].count(), 0)
+        await storage.flush()
+        self.assertEqual([doc["reserve0"] for doc in self.versions("pairs")], [20])
+
+    async def test_supersedes_stored_versions(self):
+        await self.store(1, "pairs", {"id": "0x1", "reserve0": 10})
+
+        storage = self.block(2)
+        await storage.find_one_and_update("pairs", {"id": "0x1"}, {"$set": {"reserve0": 20}})
+        await storage.find_one_and_update("pairs", {"id": "0x1"}, {"$set": {"reserve0": 30}})
+        await storage.flush()
+
+        versions = self.versions("pairs")
+        # the intermediate version of block 2 is not written
+        self.assertEqual([doc["reserve0"] for doc in versions], [10, 30])
+        self.assertEqual(versions[0]["_chain"], {"valid_from": 1, "valid_to": 2})
+        self.assertEqual(versions[1]["_chain"], {"valid_from": 2, "valid_to": None})
+
+    async def test_deletes(self):
+        await self.store(1, "positions", {"id": "0x1"}, {"id": "0x2"})
+
+        storage = self.block(2)
+        await storage.delete_one("positions", {"id": "0x1"})
+        self.assertIsNone(await storage.find_one("positions", {"id": "0x1"}))
+        self.assertEqual([doc["id"] for doc in await storage.find("positions", {})], ["0x2"])
+        await storage.flush()
+        self.assertEqual(
+            [(doc["id"], doc["_chain"]["valid_to"]) for doc in self.versions("positions")],
+            [("0x1", 2), ("0x2", None)],
+        )
+
+    async def test_inc_decimal128(self):
+        await self.store(1, "tokens", {"id": "0x1", "volume": Decimal128("1.5"), "count": 1})
+
+        storage = self.block(2)
+        await storage.update_one(
+            "tokens", {"id": "0x1"}, {"$inc": {"volume": Decimal128("2.25"), "count": 2}}
+        )
+        await storage.update_one("tokens", {"id": "0x1"}, {"$inc": {"volume": 1}})
+        token = await storage.find_one("tokens", {"id": "0x1"})
+        self.assertEqual(token["volume"], Decimal128("4.75"))
+        self.assertEqual(token["count"], 3)
+
+        # missing fields start from the increment
+        doc = {"volume": Decimal128("1")}
+        apply_update(doc, {"$inc": {"volume": Decimal128("0.1"), "usd": Decimal128("2")}})
+        self.assertEqual(doc, {"volume": Decimal128("1.1"), "usd": Decimal128("2")})
+
+    async def test_upsert_set_on_insert(self):
+        storage = self.block(1)
+        update = {
+            "$set": {"price": 2},
+            "$setOnInsert": {"volume": Decimal128("0")},
+            "$inc": {"count": 1},
+        }
+        await storage.update_one("day_data", {"id": "0x1", "day": 1}, update, upsert=True)
+        await storage.update_one(
+            "day_data",
+            {"id": "0x1", "day": 1},
+            {**update, "$setOnInsert": {"volume": Decimal128("5")}},
+            upsert=True,
+        )
+        docs = await storage.find("day_data", {})
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(docs[0]["id"], "0x1")
+        self.assertEqual(docs[0]["day"], 1)
+        self.assertEqual(docs[0]["price"], 2)
+        # $setOnInsert only applies to the insert
+        self.assertEqual(docs[0]["volume"], Decimal128("0"))
+        self.assertEqual(docs[0]["count"], 2)
+
+        # without upsert, nothing is inserted
+        await storage.update_one("day_data", {"id": "0x2"}, update)
+        self.assertEqual(len(await storage.find("day_data", {})), 1)
+
+    async def test_find_sort_skip_limit(self):
+        await self.store(1, "swaps", *({"id": hex(i), "amount": i % 3, "n": i} for i in range(5)))
+
+        storage = self.block(2)
+        await storage.insert_one("swaps", {"id": "0x5", "amount": 1, "n": 5})
+        await storage.update_one("swaps", {"id": "0x0"}, {"$set": {"amount": 5}})
+
+        docs = await storage.find("swaps", {}, sort={"amount": -1, "n": 1})
+        self.assertEqual([doc["n"] for doc in docs], [0, 2, 1, 4, 5, 3])
+        docs = await storage.find("swaps", {}, sort={"amount": -1, "n": 1}, skip=1, limit=3)
+        self.assertEqual([doc["n"] for doc in docs], [2, 1, 4])
+        docs = await storage.find("swaps", {"amount": {"$gte": 1}}, sort={"n": -1}, limit=2)
+        self.assertEqual([doc["n"] for doc in docs], [5, 4])
+        docs = await storage.find("swaps", {"n": 1}, projection={"amount": 1})
+        self.assertEqual(set(docs[0]), {"_id", "amount"})
+
+    async def test_find_by_id_ignores_superseded(self):
+        await self.store(1, "pairs", {"id": "0x1"}, {"id": "0x2"}, {"id": "0x3"})
+        first, second, third = self.versions("pairs")
+
+        storage = self.block(2)
+        await storage.delete_one("pairs", {"id": "0x1"})
+        # the condition on `_id` is kept next to the superseded ids
+        found = await storage.find_one("pairs", {"_id": third["_id"]})
+        self.assertEqual(found["id"], "0x3")
+        self.assertIsNone(await storage.find_one("pairs", {"_id": first["_id"]}))
+        docs = await storage.find("pairs", {"_id": {"$in": [first["_id"], second["_id"]]}})
+        self.assertEqual([doc["id"] for doc in docs], ["0x2"])
+
+    async def test_parents(self):
+        await self.store(1, "pairs", {"id": "0x1", "reserve0": 10})
+
+        # block 2 is not written yet when block 3 is handled
+        parent = self.block(2)
+        await parent.update_one("pairs", {"id": "0x1"}, {"$inc": {"reserve0": 5}})
+        await parent.insert_one("pairs", {"id": "0x2", "reserve0": 1})
+        await parent.resolve()
+
+        storage = self.block(3, parents=[parent])
+        self.assertEqual((await storage.find_one("pairs", {"id": "0x1"}))["reserve0"], 15)
+        docs = await storage.find("pairs", {}, sort={"id": 1})
+        self.assertEqual([doc["reserve0"] for doc in docs], [15, 1])
+
+        await storage.update_one("pairs", {"id": "0x1"}, {"$inc": {"reserve0": 5}})
+        await parent.flush()
+        await storage.flush()
+        self.assertEqual(
+            [(doc["reserve0"], doc["_chain"]) for doc in self.versions("pairs")],
+            [
+                (10, {"valid_from": 1, "valid_to": 2}),
+                (15, {"valid_from": 2, "valid_to": 3}),
+                (1, {"valid_from": 2, "valid_to": None}),
+                (20, {"valid_from": 3, "valid_to": None}),
+            ],
+        )
+
+
+class MatchesFilterTest(unittest.TestCase):
+    def test_matches(self):
+        doc = {"id": "0x1", "amount": Decimal128("2.5"), "chain": {"valid_to": None}, "n": 3}
+        self.assertTrue(matches_filter(doc, {"id": "0x1", "chain.valid_to": None}))
+        # null matches missing fields
+        self.assertTrue(matches_filter(doc, {"missing": None}))
+        self.assertFalse(matches_filter(doc, {"id": "0x2"}))
+        self.assertTrue(matches_filter(doc, {"amount": Decimal128("2.50")}))
+        self.assertTrue(matches_filter(doc, {"amount": {"$gt": Decimal128("2")}}))
+        self.assertFalse(matches_filter(doc, {"missing": {"$gt": 0}}))
+        self.assertTrue(matches_filter(doc, {"n": {"$in": [1, 3]}, "id": {"$nin": ["0x2"]}}))
+        self.assertTrue(matches_filter(doc, {"$or": [{"id": "0x2"}, {"n": {"$lte": 3}}]}))
+        self.assertFalse(matches_filter(doc, {"$and": [{"id": "0x1"}, {"n": {"$ne": 3}}]}))
+        self.assertTrue(matches_filter({"_id": ObjectId()}, {}))
+
+    def test_apply_update(self):
+        doc = {"a": {"b": 1}, "c": 1}
+        shared = doc["a"]
+        apply_update(doc, {"$set": {"a.b": 2, "a.d": Decimal("1")}, "$unset": {"c": ""}})
+        self.assertEqual(doc, {"a": {"b": 2, "d": Decimal("1")}})
+        # embedded documents are copied, older versions are not modified
+        self.assertEqual(shared, {"b": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()